@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class BarsysConfig(AppConfig):
     name = 'barsys'
+
+    def ready(self):
+        # connect signal receivers
+        from . import signals
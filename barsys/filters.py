@@ -40,6 +40,16 @@ class PurchaseFilter(django_filters.FilterSet):
         fields = ["user", "is_free_item_purchase", ]
 
 
+class PurchaseFeedFilter(PurchaseFilter):
+    """ Filters of the purchase feed in the REST API """
+    since = django_filters.IsoDateTimeFilter(field_name="created_date", lookup_expr="gte")
+    until = django_filters.IsoDateTimeFilter(field_name="created_date", lookup_expr="lt")
+    category = django_filters.CharFilter(field_name="product_category")
+
+    class Meta(PurchaseFilter.Meta):
+        pass
+
+
 class ProductAutochangeSetFilter(django_filters.FilterSet):
     title = django_filters.CharFilter(lookup_expr='icontains')
     description = django_filters.CharFilter(lookup_expr='icontains')
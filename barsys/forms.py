@@ -292,7 +292,7 @@ class SingleUserSinglePurchaseForm(SinglePurchaseForm):
 
 class MultiUserSinglePurchaseForm(SinglePurchaseForm):
     comment = forms.CharField(max_length=50, required=False, initial="MultiBuy")
-    users_qs = None  # has to be filled in manually
+    users = None  # list of users, has to be filled in manually
 
     def clean(self):
         super(MultiUserSinglePurchaseForm, self).clean()
@@ -300,7 +300,7 @@ class MultiUserSinglePurchaseForm(SinglePurchaseForm):
 
         if self.is_free_item_purchase and not self.has_error("product_id"):
             free_item = FreeItem.objects.get(pk=cleaned_data.get('product_id'))
-            needed_quantity = cleaned_data.get('quantity') * self.users_qs.count()
+            needed_quantity = cleaned_data.get('quantity') * len(self.users)
             if free_item.leftover_quantity < needed_quantity:
                 raise ValidationError({"quantity": "There are only {} items left, so you cannot purchase {}!".format(
                     free_item.leftover_quantity,
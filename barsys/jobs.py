@@ -0,0 +1,80 @@
+import traceback
+
+from django.contrib import messages
+from django.db.models import F
+from django.utils import timezone
+
+from . import view_helpers
+from .models import Job, JobResult, User, Invoice
+
+
+class JobReporter:
+    """ Persist the outcome of actions run by a background job so that it can be followed in the admin area """
+    LEVEL_NAMES = {messages.DEBUG: "DEBUG", messages.INFO: "INFO", messages.SUCCESS: "SUCCESS",
+                   messages.WARNING: "WARNING", messages.ERROR: "ERROR"}
+
+    def __init__(self, job):
+        self.job = job
+
+    def message(self, level, text):
+        self.job.append_log("{}: {}".format(self.LEVEL_NAMES.get(level, level), text))
+
+    def set_total(self, num_total):
+        Job.objects.filter(pk=self.job.pk).update(num_total=F("num_total") + num_total,
+                                                 heartbeat_date=timezone.now())
+
+    def step_done(self):
+        Job.objects.filter(pk=self.job.pk).update(num_done=F("num_done") + 1, heartbeat_date=timezone.now())
+
+    def result(self, recipient, description, error=None):
+        JobResult.objects.create(job=self.job, recipient=recipient, description=description,
+                                 success=error is None, error="" if error is None else str(error))
+        Job.objects.filter(pk=self.job.pk).update(heartbeat_date=timezone.now())
+
+
+def _create_invoices(reporter, user_ids, **kwargs):
+    users = User.objects.filter(pk__in=user_ids).order_by("display_name")
+    view_helpers.create_invoices(reporter, users, **kwargs)
+
+
+def _send_invoice_mails(reporter, invoice_ids, send_dependant_notifications=False):
+    invoices = list(Invoice.objects.filter(pk__in=invoice_ids).select_related("recipient"))
+    view_helpers.send_invoice_mails(reporter, invoices, send_dependant_notifications=send_dependant_notifications)
+
+
+def _send_reminder_mails(reporter, user_ids):
+    users = list(User.objects.filter(pk__in=user_ids))
+    view_helpers.send_reminder_mails(reporter, users)
+
+
+JOB_FUNCTIONS = {
+    Job.KIND_CREATE_INVOICES: _create_invoices,
+    Job.KIND_SEND_INVOICE_MAILS: _send_invoice_mails,
+    Job.KIND_SEND_REMINDER_MAILS: _send_reminder_mails,
+}
+
+
+def run_job(job):
+    """ Run a job which was already claimed (see JobManager.claim_next) and store its final status """
+    reporter = JobReporter(job)
+    try:
+        JOB_FUNCTIONS[job.kind](reporter, **job.get_parameters())
+        status = Job.STATUS_DONE
+    except Exception:
+        reporter.message(messages.ERROR, "Job failed:\n{}".format(traceback.format_exc()))
+        status = Job.STATUS_FAILED
+
+    job.status = status
+    job.finished_date = timezone.now()
+    Job.objects.filter(pk=job.pk).update(status=job.status, finished_date=job.finished_date)
+
+
+def run_pending_jobs():
+    """ Run pending jobs until there are none left and return the number of jobs that were run """
+    num_jobs = 0
+    while True:
+        job = Job.objects.claim_next()
+        if job is None:
+            return num_jobs
+        run_job(job)
+        num_jobs += 1
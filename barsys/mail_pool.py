@@ -0,0 +1,115 @@
+import queue
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core import mail
+
+
+class MailPoolAborted(Exception):
+    """ Raised for mails which were not sent because too many other mails failed before """
+    pass
+
+
+def is_permanent_error(e):
+    """ Whether retrying to send a mail after error e is pointless (e.g. unknown recipient) """
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, msg in e.recipients.values())
+    if isinstance(e, smtplib.SMTPResponseException):
+        return e.smtp_code >= 500
+    return isinstance(e, smtplib.SMTPNotSupportedError)
+
+
+class MailPool:
+    """ Send mails over several connections to the mail server in parallel.
+
+        send() returns a concurrent.futures.Future whose exception is set if the mail could not be sent.
+        Rendering mails (and any other database access) should stay in the calling thread - worker threads
+        only talk to the mail server.
+    """
+
+    def __init__(self, num_connections=1, max_retries=0, retry_delay=1.0, max_failures=None):
+        """
+        :param num_connections: number of connections to the mail server (and threads) to use
+        :param max_retries: how often to retry sending a mail after a temporary error
+        :param retry_delay: seconds to wait before the first retry, doubled for each further retry
+        :param max_failures: stop sending mails after this many failed (raising MailPoolAborted instead)
+        """
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_failures = max_failures
+        self.num_failures = 0
+        self._failures_lock = threading.Lock()
+        self._executor = None
+
+        # each connection is only used by one thread at a time
+        self._idle_connections = queue.Queue()
+        self._connections = []
+        try:
+            for i in range(max(1, num_connections)):
+                connection = mail.get_connection(fail_silently=False)
+                connection.open()
+                self._connections.append(connection)
+                self._idle_connections.put(connection)
+        except Exception:
+            self.close()
+            raise
+
+        self._executor = ThreadPoolExecutor(max_workers=len(self._connections))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def send(self, message):
+        return self._executor.submit(self._send, message)
+
+    def aborted(self):
+        return self.max_failures is not None and self.num_failures >= self.max_failures
+
+    def _send(self, message):
+        if self.aborted():
+            raise MailPoolAborted("Not sent due to previous errors")
+
+        connection = self._idle_connections.get()
+        try:
+            attempt = 0
+            while True:
+                try:
+                    connection.send_messages((message,))
+                    return
+                except Exception as e:
+                    if attempt >= self.max_retries or is_permanent_error(e):
+                        with self._failures_lock:
+                            self.num_failures += 1
+                        raise
+                time.sleep(self.retry_delay * 2 ** attempt)
+                attempt += 1
+                self._reconnect(connection)
+        finally:
+            self._idle_connections.put(connection)
+
+    @staticmethod
+    def _reconnect(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        try:
+            connection.open()
+        except Exception:
+            # the next attempt will fail and be retried as well
+            pass
+
+    def close(self):
+        """ Wait for all mails to be sent and close the connections """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        for connection in self._connections:
+            try:
+                connection.close()
+            except Exception:
+                pass
@@ -0,0 +1,105 @@
+import functools
+import os.path
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.template.backends.django import DjangoTemplates
+
+from pybarsys import settings as pybarsys_settings
+from pybarsys.settings import PybarsysPreferences
+from .models import Purchase, PurchaseList, Payment, Invoice
+
+
+@functools.lru_cache()
+def get_mail_template_engine():
+    """ Template engine for mails which always keeps compiled templates in memory (also with DEBUG on) """
+    config = settings.TEMPLATES[0]
+    options = dict(config.get("OPTIONS", {}))
+    loaders = options.pop("loaders", None)
+    if loaders is None:
+        loaders = ["django.template.loaders.filesystem.Loader"]
+        if config.get("APP_DIRS", False):
+            loaders.append("django.template.loaders.app_directories.Loader")
+    options["loaders"] = [("django.template.loaders.cached.Loader", loaders)]
+
+    return DjangoTemplates({"NAME": "pybarsys_mails", "DIRS": config.get("DIRS", []), "APP_DIRS": False,
+                            "OPTIONS": options})
+
+
+def get_mail_template(name):
+    return get_mail_template_engine().get_template(os.path.join(PybarsysPreferences.EMAIL.TEMPLATE_DIR, name))
+
+
+class InvoiceMailRenderer:
+    """ Render invoice mails and dependant notifications for a batch of invoices.
+        All purchases, payments and previous invoices needed by the mails are fetched up front with
+        a few queries instead of several queries per mail.
+    """
+    NUM_LAST_INVOICES = 5
+
+    def __init__(self, invoices):
+        invoices = list(invoices)
+        invoice_ids = [i.pk for i in invoices]
+        recipient_ids = set(i.recipient_id for i in invoices)
+
+        self.templates = {name: get_mail_template(name) for name in (
+            "normal_invoice.plaintext.html", "normal_invoice.html.html",
+            "dependant_notification.plaintext.html", "dependant_notification.html.html")}
+
+        self.purchases = defaultdict(PurchaseList)  # {invoice_id: [purchase, ...]}
+        for purchase in Purchase.objects.filter(invoice_id__in=invoice_ids).select_related("user"):
+            self.purchases[purchase.invoice_id].append(purchase)
+
+        self.payments = defaultdict(list)
+        for payment in Payment.objects.filter(invoice_id__in=invoice_ids):
+            self.payments[payment.invoice_id].append(payment)
+
+        self.last_invoices = defaultdict(list)  # {recipient_id: [invoice, ...]}
+        for invoice in Invoice.objects.filter(recipient_id__in=recipient_ids).order_by("recipient_id", "-created_date"):
+            if len(self.last_invoices[invoice.recipient_id]) < self.NUM_LAST_INVOICES:
+                self.last_invoices[invoice.recipient_id].append(invoice)
+
+    def own_purchases(self, invoice):
+        return PurchaseList(p for p in self.purchases[invoice.pk] if p.user_id == invoice.recipient_id)
+
+    def other_purchases_grouped(self, invoice):
+        """ Like Invoice.other_purchases_grouped, but with lists of already fetched purchases """
+        grouped = {}
+        for purchase in self.purchases[invoice.pk]:
+            if purchase.user_id != invoice.recipient_id:
+                grouped.setdefault(purchase.user_id, (purchase.user, PurchaseList()))[1].append(purchase)
+        return [grouped[user_id] for user_id in sorted(grouped)]
+
+    def has_dependant_purchases(self, invoice):
+        return any(p.user_id != invoice.recipient_id for p in self.purchases[invoice.pk])
+
+    def _render(self, name, subject, recipient, context):
+        content_plain = self.templates[name + ".plaintext.html"].render(context)
+        content_html = self.templates[name + ".html.html"].render(context)
+        msg = EmailMultiAlternatives(subject, content_plain, pybarsys_settings.EMAIL_FROM_ADDRESS,
+                                     [recipient.email], reply_to=[PybarsysPreferences.EMAIL.CONTACT_EMAIL])
+        msg.attach_alternative(content_html, "text/html")
+        return msg
+
+    def render_invoice(self, invoice):
+        context = {}
+        context["pybarsys_preferences"] = PybarsysPreferences
+        context["invoice"] = invoice
+        context["recipient"] = invoice.recipient
+        context["own_purchases"] = self.own_purchases(invoice)
+        context["other_purchases_grouped"] = self.other_purchases_grouped(invoice)
+        context["last_invoices"] = self.last_invoices[invoice.recipient_id]
+        context["payments"] = self.payments[invoice.pk]
+
+        return self._render("normal_invoice", PybarsysPreferences.EMAIL.INVOICE_SUBJECT, invoice.recipient, context)
+
+    def render_dependant_notification(self, invoice, dependant, purchases):
+        context = {}
+        context["pybarsys_preferences"] = PybarsysPreferences
+        context["invoice"] = invoice
+        context["dependant"] = dependant
+        context["purchases"] = purchases
+
+        return self._render("dependant_notification", PybarsysPreferences.EMAIL.PURCHASE_NOTIFICATION_SUBJECT,
+                            dependant, context)
@@ -0,0 +1,44 @@
+import locale
+import random
+import time
+from decimal import Decimal
+
+import babel.numbers
+from django.core.management.base import BaseCommand
+
+from barsys.templatetags.barsys_helpers import currency, get_locale_str
+
+
+def currency_uncached(value):
+    """ The currency filter like before get_currency_formatter existed, for comparison """
+    if not value:
+        value = 0
+
+    locale.setlocale(locale.LC_ALL, get_locale_str())
+    currency_symbol = locale.localeconv()["currency_symbol"]
+    return babel.numbers.format_currency(value, currency=currency_symbol, locale=get_locale_str())
+
+
+class Command(BaseCommand):
+    help = "Measure how many amounts the currency template filter formats per second"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--values", type=int, default=100000,
+                            help="Number of random amounts to format (default: 100000)")
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        values = [Decimal(rng.randint(-1000000, 1000000)) / 100 for i in range(options["values"])]
+
+        previous_locale = locale.setlocale(locale.LC_ALL)
+        try:
+            for name, format_value in (("Per call (setlocale + format_currency)", currency_uncached),
+                                       ("Cached formatter", currency)):
+                start = time.perf_counter()
+                for value in values:
+                    format_value(value)
+                duration = time.perf_counter() - start
+                self.stdout.write("{}: {} values in {:.2f} s ({:.0f} values/s)".format(
+                    name, len(values), duration, len(values) / duration))
+        finally:
+            locale.setlocale(locale.LC_ALL, previous_locale)
@@ -0,0 +1,238 @@
+import http.cookiejar
+import json
+import math
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import Resolver404, resolve, reverse
+
+
+def percentile(sorted_values, p):
+    """ Nearest-rank percentile of an already sorted list """
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+class NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """ Redirects after form posts are requested as separate steps, so they are measured on their own """
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class Recorder:
+    """ Collects the duration and status of every request, grouped by method and URL name """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, key, duration, is_error):
+        with self.lock:
+            self.durations[key].append(duration)
+            if is_error:
+                self.errors[key] += 1
+
+    def summary(self, elapsed):
+        rows = []
+        for key in sorted(self.durations):
+            durations = sorted(self.durations[key])
+            rows.append({"endpoint": key, "requests": len(durations), "errors": self.errors[key],
+                         "throughput": len(durations) / elapsed,
+                         "p50": percentile(durations, 50) * 1000, "p95": percentile(durations, 95) * 1000,
+                         "p99": percentile(durations, 99) * 1000})
+        return rows
+
+
+class Client:
+    """ One guest at the bar: an own session (and CSRF cookie) against the server """
+
+    def __init__(self, base_url, recorder, timeout):
+        self.base_url = base_url.rstrip("/")
+        self.recorder = recorder
+        self.timeout = timeout
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies),
+                                                  NoRedirectHandler)
+
+    def csrf_token(self):
+        return next((c.value for c in self.cookies if c.name == "csrftoken"), "")
+
+    def request(self, method, path, form=None, data=None, ok_statuses=()):
+        """ Returns (status, body). Statuses >= 400 which are not in ok_statuses count as errors """
+        headers = {}
+        body = None
+        if form is not None:
+            form = dict(form, csrfmiddlewaretoken=self.csrf_token())
+            body = urllib.parse.urlencode(form, doseq=True).encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        elif data is not None:
+            body = json.dumps(data).encode()
+            headers["Content-Type"] = "application/json"
+        headers["Referer"] = self.base_url + path
+        request = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+
+        try:
+            url_name = resolve(urllib.parse.urlsplit(path).path).url_name
+        except Resolver404:
+            url_name = path
+
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                status, content = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, content = e.code, e.read()
+        except OSError:
+            status, content = 0, b""
+        duration = time.perf_counter() - start
+
+        is_error = status == 0 or (status >= 400 and status not in ok_statuses)
+        self.recorder.add("{} {}".format(method, url_name), duration, is_error)
+        return status, content
+
+
+class FridayNight:
+    """ Purchase pattern of a busy evening: mostly single purchases on the main page, some multibuys and rounds of
+        free items that everyone rushes to take, kiosks uploading purchases through the API and guests looking at
+        their history.
+    """
+    ACTIONS = (("single_buy", 50), ("multibuy", 12), ("free_item_rush", 10), ("api_purchase", 15),
+               ("kiosk_upload", 8), ("history", 5))
+
+    def __init__(self, client, rng):
+        self.client = client
+        self.rng = rng
+        self.snapshot = None
+
+    def refresh_snapshot(self):
+        status, content = self.client.request("GET", reverse("main_kiosk_api"))
+        if status == 200:
+            self.snapshot = json.loads(content.decode())
+
+    def users(self):
+        return [u for u in self.snapshot["users"] if not u["is_autolocked"]]
+
+    def products(self):
+        return [p for c in self.snapshot["categories"] for p in c["products"]]
+
+    def run_action(self):
+        if self.snapshot is None or self.rng.random() < 0.05:
+            self.refresh_snapshot()
+        if self.snapshot is None or not self.users() or not self.products():
+            return
+        names, weights = zip(*self.ACTIONS)
+        getattr(self, self.rng.choices(names, weights)[0])()
+
+    def single_buy(self):
+        user = self.rng.choice(self.users())
+        path = reverse("main_user_purchase", kwargs={"user_id": user["id"]})
+        self.client.request("GET", reverse("main_user_list"))
+        self.client.request("GET", path)
+        self.client.request("POST", path, form={
+            "user_id": user["id"], "product_id": self.rng.choice(self.products())["id"],
+            "quantity": self.rng.choice([1, 1, 1, 2]), "comment": ""})
+
+    def multibuy(self):
+        users = self.rng.sample(self.users(), min(len(self.users()), self.rng.randint(2, 6)))
+        self.client.request("GET", reverse("main_user_list_multibuy"))
+        self.client.request("POST", reverse("main_user_list_multibuy"), form={"users": [u["id"] for u in users]})
+        path = reverse("main_user_purchase_multibuy",
+                       kwargs={"user_pkey_str": "/".join(str(u["id"]) for u in users)})
+        self.client.request("GET", path)
+        self.client.request("POST", path, form={"product_id": self.rng.choice(self.products())["id"], "quantity": 1,
+                                                "comment": "MultiBuy"})
+
+    def free_item_rush(self):
+        if not self.snapshot["free_items"]:
+            # give away a round, everyone else takes from it until it is sold out
+            self.client.request("POST", reverse("main_purchase_api"), data={
+                "user_id": self.rng.choice(self.users())["id"], "product_id": self.rng.choice(self.products())["id"],
+                "quantity": self.rng.randint(5, 20), "comment": "Round", "give_away_free": True})
+            self.refresh_snapshot()
+            return
+        free_item = self.rng.choice(self.snapshot["free_items"])
+        status, content = self.client.request("POST", reverse("main_purchase_api"), data={
+            "user_id": self.rng.choice(self.users())["id"], "product_id": free_item["id"], "quantity": 1},
+            ok_statuses=(400, 409))
+        if status != 201:
+            # sold out, others were faster
+            self.refresh_snapshot()
+
+    def api_purchase(self):
+        self.client.request("POST", reverse("main_purchase_api"), data={
+            "user_id": self.rng.choice(self.users())["id"], "product_id": self.rng.choice(self.products())["id"],
+            "quantity": 1})
+
+    def kiosk_upload(self):
+        purchases = [{"user_id": self.rng.choice(self.users())["id"],
+                      "product_id": self.rng.choice(self.products())["id"], "quantity": 1,
+                      "idempotency_key": "load-{:x}".format(self.rng.getrandbits(64))}
+                     for i in range(self.rng.randint(1, 10))]
+        self.client.request("POST", reverse("main_purchase_bulk_api"), data=purchases)
+
+    def history(self):
+        self.client.request("GET", reverse("main_user_history", kwargs={"user_id": self.rng.choice(self.users())["id"]}))
+
+
+class Command(BaseCommand):
+    help = "Replay a busy Friday night against a running pybarsys server (e.g. gunicorn on a database filled with " \
+           "./manage.py seed) and report latency percentiles and throughput per endpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000",
+                            help="Base URL of the server (default: http://127.0.0.1:8000)")
+        parser.add_argument("--duration", type=float, default=60, help="Duration in seconds (default: 60)")
+        parser.add_argument("--concurrency", type=int, default=8,
+                            help="Number of guests sending requests at the same time (default: 8)")
+        parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator (default: 0)")
+        parser.add_argument("--timeout", type=float, default=30, help="Timeout per request in seconds (default: 30)")
+        parser.add_argument("--json", dest="json_file",
+                            help="Also write the results to this JSON file, e.g. to compare releases")
+
+    def handle(self, *args, **options):
+        if options["concurrency"] < 1 or options["duration"] <= 0:
+            raise CommandError("Concurrency and duration must be positive")
+
+        recorder = Recorder()
+        end = time.monotonic() + options["duration"]
+
+        def guest(index):
+            client = Client(options["url"], recorder, options["timeout"])
+            night = FridayNight(client, random.Random("{}-{}".format(options["seed"], index)))
+            while time.monotonic() < end:
+                night.run_action()
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=guest, args=(i,), daemon=True) for i in range(options["concurrency"])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        rows = recorder.summary(elapsed)
+        if not rows:
+            raise CommandError("No requests were sent")
+        if all(row["requests"] == row["errors"] for row in rows):
+            raise CommandError("All requests to {} failed, is the server running?".format(options["url"]))
+
+        self.stdout.write("{:<42} {:>8} {:>7} {:>8} {:>9} {:>9} {:>9}".format(
+            "Endpoint", "Requests", "Errors", "Req/s", "p50 (ms)", "p95 (ms)", "p99 (ms)"))
+        for row in rows:
+            self.stdout.write("{endpoint:<42} {requests:>8} {errors:>7} {throughput:>8.1f} {p50:>9.1f} {p95:>9.1f} "
+                              "{p99:>9.1f}".format(**row))
+        num_requests = sum(row["requests"] for row in rows)
+        self.stdout.write("Total: {} requests in {:.1f} s ({:.1f} requests/s, {} errors)".format(
+            num_requests, elapsed, num_requests / elapsed, sum(row["errors"] for row in rows)))
+
+        if options["json_file"]:
+            with open(options["json_file"], "w") as f:
+                json.dump({"url": options["url"], "duration": elapsed, "concurrency": options["concurrency"],
+                           "seed": options["seed"], "endpoints": rows}, f, indent=2)
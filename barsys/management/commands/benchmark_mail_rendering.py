@@ -0,0 +1,62 @@
+import os.path
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.template.loader import render_to_string
+from django.test.utils import CaptureQueriesContext
+
+from barsys.mail_rendering import InvoiceMailRenderer
+from barsys.models import Invoice
+from pybarsys.settings import PybarsysPreferences
+
+
+def render_invoice_uncached(invoice):
+    """ Render an invoice mail like before InvoiceMailRenderer existed, for comparison """
+    context = {}
+    context["pybarsys_preferences"] = PybarsysPreferences
+    context["invoice"] = invoice
+    context["recipient"] = invoice.recipient
+    context["own_purchases"] = invoice.own_purchases()
+    context["other_purchases_grouped"] = invoice.other_purchases_grouped()
+    context["last_invoices"] = invoice.recipient.invoices()[:5]
+    context["payments"] = invoice.payments()
+
+    return (render_to_string(os.path.join(PybarsysPreferences.EMAIL.TEMPLATE_DIR, "normal_invoice.plaintext.html"),
+                             context),
+            render_to_string(os.path.join(PybarsysPreferences.EMAIL.TEMPLATE_DIR, "normal_invoice.html.html"),
+                             context))
+
+
+class Command(BaseCommand):
+    help = "Measure how many invoice mails of existing invoices can be rendered per second (no mails are sent)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--invoices", type=int, default=100,
+                            help="Number of most recent invoices to render (default: 100)")
+
+    def handle(self, *args, **options):
+        invoices = list(Invoice.objects.select_related("recipient")[:options["invoices"]])
+        if not invoices:
+            raise CommandError("There are no invoices to render")
+
+        def render_uncached():
+            for invoice in invoices:
+                render_invoice_uncached(invoice)
+
+        def render_batch():
+            renderer = InvoiceMailRenderer(invoices)
+            for invoice in invoices:
+                renderer.render_invoice(invoice)
+
+        # the first run compiles the templates of the mail template engine
+        render_batch()
+
+        for name, render in (("Per invoice (render_to_string)", render_uncached),
+                             ("InvoiceMailRenderer", render_batch)):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                render()
+                duration = time.perf_counter() - start
+            self.stdout.write("{}: {} mails in {:.2f} s ({:.1f} mails/s, {} queries)".format(
+                name, len(invoices), duration, len(invoices) / duration, len(queries)))
@@ -0,0 +1,43 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction
+from django.db.models import F
+
+from barsys.models import User, Invoice
+
+
+class Command(BaseCommand):
+    help = "Recalculate the stored account balance of all users from their invoice history"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--verify-only", action="store_true",
+                            help="Only report users whose stored balance is wrong, do not change anything")
+
+    def handle(self, *args, **options):
+        verify_only = options["verify_only"]
+
+        with transaction.atomic():
+            totals = Invoice.objects.values("recipient_id").order_by("recipient_id").annotate(
+                total_amount=models.Sum(F("amount_purchases") - F("amount_payments")))
+            # users without invoices have a balance of zero
+            expected = {t["recipient_id"]: -round(t["total_amount"], 2) for t in totals}
+
+            wrong_users = []
+            for user in User.objects.select_for_update().only("pk", "display_name", "balance"):
+                expected_balance = expected.get(user.pk, Decimal('0'))
+                if user.balance != expected_balance:
+                    wrong_users.append((user, expected_balance))
+
+            for user, expected_balance in wrong_users:
+                self.stdout.write("{}: stored balance {}, calculated from invoices {}".format(
+                    user.display_name, user.balance, expected_balance))
+                if not verify_only:
+                    User.objects.filter(pk=user.pk).update(balance=expected_balance)
+
+        if not wrong_users:
+            self.stdout.write(self.style.SUCCESS("All stored account balances are correct"))
+        elif verify_only:
+            raise CommandError("{} stored account balance(s) are wrong".format(len(wrong_users)))
+        else:
+            self.stdout.write(self.style.SUCCESS("Fixed {} stored account balance(s)".format(len(wrong_users))))
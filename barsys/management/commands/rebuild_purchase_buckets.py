@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from barsys.models import PurchaseBucket, UserProductCount
+
+
+class Command(BaseCommand):
+    help = "Recalculate the hourly purchase buckets used for StatsDisplays and the purchase counts used to " \
+           "preselect favorite products from all purchases"
+
+    def handle(self, *args, **options):
+        num_buckets = PurchaseBucket.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS("Created {} purchase bucket(s)".format(num_buckets)))
+
+        num_counts = UserProductCount.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS("Created {} user product count(s)".format(num_counts)))
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from barsys.jobs import run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = "Run background jobs (e.g. invoice creation and mail sending) which were queued in the admin area"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true",
+                            help="Run all pending jobs and exit instead of waiting for new ones")
+        parser.add_argument("--interval", type=float, default=2.0,
+                            help="Seconds to wait before checking for new jobs again (default: 2)")
+
+    def handle(self, *args, **options):
+        while True:
+            num_jobs = run_pending_jobs()
+            if num_jobs > 0:
+                self.stdout.write("Finished {} job(s)".format(num_jobs))
+            if options["once"]:
+                return
+            time.sleep(options["interval"])
+            # do not keep using database connections which were closed by the server in the meantime
+            close_old_connections()
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from barsys.models import User, Purchase
+from barsys.seeding import create_dataset
+
+
+class Command(BaseCommand):
+    help = "Fill an empty database with a reproducible synthetic data set (users, dependants, products, " \
+           "Stats Displays, months of purchases, payments and invoices), e.g. for benchmark_load"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=300, help="Number of users (default: 300)")
+        parser.add_argument("--purchases", type=int, default=50000, help="Number of purchases (default: 50000)")
+        parser.add_argument("--payments", type=int, default=1000, help="Number of payments (default: 1000)")
+        parser.add_argument("--days", type=int, default=180,
+                            help="Number of days the purchases are spread over (default: 180)")
+        parser.add_argument("--seed", type=int, default=0,
+                            help="Seed of the random generator, the same seed creates the same data (default: 0)")
+        parser.add_argument("--admin-email", default="admin@example.com",
+                            help="Email of the created admin user (default: admin@example.com)")
+        parser.add_argument("--admin-password", default="password",
+                            help="Password of the created admin user (default: password)")
+
+    def handle(self, *args, **options):
+        if User.objects.exists() or Purchase.objects.exists():
+            raise CommandError("The database is not empty, run ./manage.py flush first")
+        if options["users"] < 10 or options["days"] < 1:
+            raise CommandError("At least 10 users and 1 day are needed")
+
+        start = time.perf_counter()
+        with transaction.atomic():
+            create_dataset(options["users"], options["purchases"], options["payments"], num_days=options["days"],
+                           seed=options["seed"], admin_email=options["admin_email"],
+                           admin_password=options["admin_password"])
+        self.stdout.write(self.style.SUCCESS(
+            "Created {} users, {} purchases and {} payments over {} days in {:.1f} s, admin login: {}".format(
+                options["users"], options["purchases"], options["payments"], options["days"],
+                time.perf_counter() - start, options["admin_email"])))
@@ -0,0 +1,276 @@
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django.db import connection
+from django.template.base import Template
+
+from pybarsys.settings import PybarsysPreferences
+
+logger = logging.getLogger("barsys.metrics")
+
+# upper bounds of the request duration histogram (in seconds)
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+NUM_SLOW_QUERY_SAMPLES = 10
+SLOW_QUERY_MAX_LENGTH = 200
+# how often each process copies its metrics into the cache, where the metrics endpoint sums up all processes
+FLUSH_INTERVAL = 10  # seconds
+PROCESS_TIMEOUT = 24 * 60 * 60  # seconds
+
+# views which wait for new data (long polling), their wall time is no latency and would distort the histogram
+LONG_POLL_VIEWS = ("main_event_api",)
+
+CACHE_KEY_PROCESSES = "metrics_processes"
+CACHE_KEY_PROCESS = "metrics_process_{}"
+
+_state = threading.local()
+
+
+class RequestRecorder:
+    """ SQL and template timings of a single sampled request """
+
+    def __init__(self):
+        self.sql_queries = 0
+        self.sql_duration = 0
+        self.slow_queries = []
+        self.template_duration = 0
+        self.template_depth = 0
+
+    def execute(self, execute, sql, params, many, context):
+        """ Wrapper for connection.execute_wrapper() """
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.sql_queries += 1
+            self.sql_duration += duration
+            if duration * 1000 >= PybarsysPreferences.Metrics.SLOW_QUERY_MS:
+                # without parameters, so samples of the same query look the same and contain no personal data
+                self.slow_queries.append((sql[:SLOW_QUERY_MAX_LENGTH], duration))
+
+
+def _instrument_templates():
+    """ Measure the time spent in Template.render() of the outermost template (included templates are part of it)
+        while a request is recorded. Other requests only pay for looking up the thread-local recorder.
+    """
+    original_render = Template.render
+    if getattr(original_render, "pybarsys_metrics", False):
+        return
+
+    @functools.wraps(original_render)
+    def render(self, context):
+        recorder = getattr(_state, "recorder", None)
+        if recorder is None:
+            return original_render(self, context)
+
+        recorder.template_depth += 1
+        start = time.perf_counter()
+        try:
+            return original_render(self, context)
+        finally:
+            recorder.template_depth -= 1
+            if recorder.template_depth == 0:
+                recorder.template_duration += time.perf_counter() - start
+
+    render.pybarsys_metrics = True
+    Template.render = render
+
+
+class MetricsRegistry:
+    """ Metrics of the sampled requests of this process, per view and HTTP method """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.process_id = "{}-{}".format(os.getpid(), uuid.uuid4().hex[:8])
+        self.last_flush = 0
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
+            self.slow_queries = deque(maxlen=NUM_SLOW_QUERY_SAMPLES)
+
+    def add(self, view, method, status_code, duration, recorder):
+        with self.lock:
+            metrics = self.views.setdefault("{} {}".format(view, method), {
+                "requests": 0, "errors": 0, "duration": 0, "sql_queries": 0, "sql_duration": 0,
+                "template_duration": 0, "duration_buckets": [0] * len(DURATION_BUCKETS)})
+            metrics["requests"] += 1
+            metrics["errors"] += status_code >= 500
+            metrics["duration"] += duration
+            metrics["sql_queries"] += recorder.sql_queries
+            metrics["sql_duration"] += recorder.sql_duration
+            metrics["template_duration"] += recorder.template_duration
+            for i, upper_bound in enumerate(DURATION_BUCKETS):
+                if duration <= upper_bound:
+                    metrics["duration_buckets"][i] += 1
+            for sql, sql_duration in recorder.slow_queries:
+                self.slow_queries.append({"view": view, "sql": sql, "duration": sql_duration})
+
+    def snapshot(self):
+        with self.lock:
+            return {"views": {key: dict(metrics, duration_buckets=list(metrics["duration_buckets"]))
+                              for key, metrics in self.views.items()},
+                    "slow_queries": list(self.slow_queries)}
+
+    def flush(self, force=False):
+        """ Copy the metrics of this process into the cache (at most every FLUSH_INTERVAL seconds) """
+        now = time.monotonic()
+        if not force and now - self.last_flush < FLUSH_INTERVAL:
+            return
+        self.last_flush = now
+
+        cache.set(CACHE_KEY_PROCESS.format(self.process_id), self.snapshot(), PROCESS_TIMEOUT)
+        process_ids = cache.get(CACHE_KEY_PROCESSES, [])
+        if self.process_id not in process_ids:
+            # processes which stopped are removed in collect() once their metrics expired
+            cache.set(CACHE_KEY_PROCESSES, process_ids + [self.process_id], None)
+
+    def collect(self):
+        """ Sum of the metrics of all processes which flushed them into the cache """
+        self.flush(force=True)
+        process_ids = cache.get(CACHE_KEY_PROCESSES, [])
+        snapshots = cache.get_many([CACHE_KEY_PROCESS.format(p) for p in process_ids])
+        if len(snapshots) < len(process_ids):
+            cache.set(CACHE_KEY_PROCESSES, [p for p in process_ids if CACHE_KEY_PROCESS.format(p) in snapshots], None)
+
+        views = {}
+        slow_queries = []
+        for snapshot in snapshots.values():
+            for key, metrics in snapshot["views"].items():
+                if key not in views:
+                    views[key] = dict(metrics, duration_buckets=list(metrics["duration_buckets"]))
+                else:
+                    for name, value in metrics.items():
+                        if name == "duration_buckets":
+                            views[key][name] = [a + b for a, b in zip(views[key][name], value)]
+                        else:
+                            views[key][name] += value
+            slow_queries.extend(snapshot["slow_queries"])
+        slow_queries.sort(key=lambda q: q["duration"], reverse=True)
+        return {"views": views, "slow_queries": slow_queries[:NUM_SLOW_QUERY_SAMPLES]}
+
+
+registry = MetricsRegistry()
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render_prometheus(metrics):
+    """ Render collected metrics in the Prometheus text exposition format """
+    lines = []
+
+    def add(name, metric_type, help_text, samples):
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        for suffix, labels, value in samples:
+            label_str = ",".join('{}="{}"'.format(k, _label_value(v)) for k, v in labels)
+            lines.append("{}{}{{{}}} {}".format(name, suffix, label_str, value))
+
+    views = sorted((key.rsplit(" ", 1), metrics) for key, metrics in metrics["views"].items())
+
+    def per_view(field):
+        return [("", (("view", view), ("method", method)), m[field]) for (view, method), m in views]
+
+    lines.append("# HELP pybarsys_metrics_sample_rate Fraction of the requests which are recorded")
+    lines.append("# TYPE pybarsys_metrics_sample_rate gauge")
+    lines.append("pybarsys_metrics_sample_rate {}".format(PybarsysPreferences.Metrics.SAMPLE_RATE))
+    add("pybarsys_requests_total", "counter", "Number of sampled requests", per_view("requests"))
+    add("pybarsys_request_errors_total", "counter", "Number of sampled requests with a status code >= 500",
+        per_view("errors"))
+
+    histogram = []
+    for (view, method), m in views:
+        if view in LONG_POLL_VIEWS:
+            continue
+        labels = (("view", view), ("method", method))
+        for upper_bound, count in zip(DURATION_BUCKETS, m["duration_buckets"]):
+            histogram.append(("_bucket", labels + (("le", upper_bound),), count))
+        histogram.append(("_bucket", labels + (("le", "+Inf"),), m["requests"]))
+        histogram.append(("_sum", labels, m["duration"]))
+        histogram.append(("_count", labels, m["requests"]))
+    add("pybarsys_request_duration_seconds", "histogram",
+        "Wall time of sampled requests until the response is sent (without long polling views)", histogram)
+
+    add("pybarsys_sql_queries_total", "counter", "Number of SQL queries of sampled requests", per_view("sql_queries"))
+    add("pybarsys_sql_duration_seconds_total", "counter", "Time spent in SQL queries of sampled requests",
+        per_view("sql_duration"))
+    add("pybarsys_template_duration_seconds_total", "counter", "Time spent rendering templates of sampled requests",
+        per_view("template_duration"))
+    add("pybarsys_slow_query_duration_seconds", "gauge",
+        "Slowest recent SQL queries which took at least PYBARSYS_METRICS_SLOW_QUERY_MS",
+        [("", (("view", q["view"]), ("sql", q["sql"])), q["duration"]) for q in metrics["slow_queries"]])
+    return "\n".join(lines) + "\n"
+
+
+class RequestMetricsMiddleware:
+    """ Record wall time, SQL queries and template rendering time of a sample of all requests (see
+        PYBARSYS_METRICS_SAMPLE_RATE). Each sampled request is logged as a JSON line to the "barsys.metrics" logger
+        and added to the metrics of the admin_metrics endpoint.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        _instrument_templates()
+
+    def __call__(self, request):
+        sample_rate = PybarsysPreferences.Metrics.SAMPLE_RATE
+        if sample_rate <= 0 or random.random() >= sample_rate:
+            return self.get_response(request)
+
+        recorder = RequestRecorder()
+        start = time.perf_counter()
+        with self.recording(recorder):
+            response = self.get_response(request)
+
+        if response.streaming:
+            # the queries of streamed responses (e.g. CSV exports) run while the content is sent
+            response.streaming_content = self.record_stream(response.streaming_content, request, response, recorder,
+                                                            start)
+        else:
+            self.finish(request, response, recorder, start)
+        return response
+
+    @staticmethod
+    @contextmanager
+    def recording(recorder):
+        _state.recorder = recorder
+        try:
+            with connection.execute_wrapper(recorder.execute):
+                yield
+        finally:
+            _state.recorder = None
+
+    def record_stream(self, content, request, response, recorder, start):
+        try:
+            with self.recording(recorder):
+                yield from content
+        finally:
+            # also if the client disconnected before the stream was exhausted
+            self.finish(request, response, recorder, start)
+
+    def finish(self, request, response, recorder, start):
+        duration = time.perf_counter() - start
+        resolver_match = getattr(request, "resolver_match", None)
+        view = resolver_match.url_name if resolver_match and resolver_match.url_name else "unknown"
+        registry.add(view, request.method, response.status_code, duration, recorder)
+        registry.flush()
+
+        if PybarsysPreferences.Metrics.LOG_REQUESTS:
+            logger.info(json.dumps({
+                "view": view, "method": request.method, "path": request.path, "status": response.status_code,
+                "duration_ms": round(duration * 1000, 2), "sql_queries": recorder.sql_queries,
+                "sql_ms": round(recorder.sql_duration * 1000, 2),
+                "template_ms": round(recorder.template_duration * 1000, 2),
+                "slow_queries": [{"sql": sql, "ms": round(d * 1000, 2)} for sql, d in recorder.slow_queries]}))
@@ -0,0 +1,32 @@
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models.expressions import F
+
+
+def calculate_balances(apps, schema_editor):
+    User = apps.get_model('barsys', 'User')
+    Invoice = apps.get_model('barsys', 'Invoice')
+
+    totals = Invoice.objects.values("recipient_id").order_by("recipient_id").annotate(
+        total_amount=models.Sum(F("amount_purchases") - F("amount_payments")))
+
+    for total in totals:
+        User.objects.filter(pk=total["recipient_id"]).update(balance=-round(total["total_amount"], 2))
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('barsys', '0059_invoice_comment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='balance',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0'), editable=False,
+                                      help_text='Current account balance (automatically calculated from invoices)',
+                                      max_digits=10),
+        ),
+        migrations.RunPython(calculate_balances, migrations.RunPython.noop),
+    ]
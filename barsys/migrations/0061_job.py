@@ -0,0 +1,49 @@
+# Generated by Django 2.2.28 on 2026-10-17 12:32
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('barsys', '0060_user_balance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('INV', 'Create invoices'), ('MAIL', 'Send invoice mails'), ('REM', 'Send payment reminders')], max_length=4)),
+                ('status', models.CharField(choices=[('PEND', 'Pending'), ('RUN', 'Running'), ('DONE', 'Done'), ('FAIL', 'Failed')], default='PEND', max_length=4)),
+                ('parameters', models.TextField(default='{}', help_text='JSON encoded keyword arguments of the job')),
+                ('num_total', models.PositiveIntegerField(default=0)),
+                ('num_done', models.PositiveIntegerField(default=0)),
+                ('log', models.TextField(blank=True)),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('started_date', models.DateTimeField(blank=True, null=True)),
+                ('finished_date', models.DateTimeField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='JobResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('description', models.CharField(max_length=100)),
+                ('success', models.BooleanField()),
+                ('error', models.TextField(blank=True)),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='results', to='barsys.Job')),
+                ('recipient', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['created_date', 'pk'],
+            },
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 2.2.28 on 2026-10-17 12:40
+
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils.timezone import localtime
+
+
+def fill_buckets(apps, schema_editor):
+    Purchase = apps.get_model('barsys', 'Purchase')
+    PurchaseBucket = apps.get_model('barsys', 'PurchaseBucket')
+
+    buckets = {}
+    purchases = Purchase.objects.values_list("user_id", "product_category", "product_name", "created_date",
+                                             "quantity", "product_price").order_by()
+    for user_id, product_category, product_name, created_date, quantity, product_price in purchases.iterator():
+        hour = localtime(created_date).replace(minute=0, second=0, microsecond=0)
+        key = (user_id, product_category, product_name, hour)
+        if key not in buckets:
+            buckets[key] = PurchaseBucket(user_id=user_id, product_category=product_category,
+                                          product_name=product_name, hour=hour, quantity=0, cost=Decimal('0'))
+        buckets[key].quantity += quantity
+        buckets[key].cost += quantity * product_price
+
+    PurchaseBucket.objects.bulk_create(buckets.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('barsys', '0061_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PurchaseBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_category', models.CharField(max_length=40)),
+                ('product_name', models.CharField(max_length=40)),
+                ('hour', models.DateTimeField(help_text='Start of the (local) hour in which the purchases were made')),
+                ('quantity', models.IntegerField(default=0)),
+                ('cost', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=10)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('hour', 'user', 'product_category', 'product_name')},
+            },
+        ),
+        migrations.RunPython(fill_buckets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-17 12:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('barsys', '0062_purchasebucket'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['recipient', '-created_date'], name='invoice_recipient_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['user', 'invoice'], name='payment_user_invoice_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchase',
+            index=models.Index(condition=models.Q(invoice__isnull=True), fields=['user', 'product_name', 'product_amount'], name='purchase_unbilled_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchase',
+            index=models.Index(fields=['created_date', 'user'], name='purchase_created_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchase',
+            index=models.Index(fields=['user', '-created_date'], name='purchase_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchase',
+            index=models.Index(fields=['product_name', 'product_amount'], name='purchase_product_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-17 12:42
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def count_purchases(apps, schema_editor):
+    Purchase = apps.get_model('barsys', 'Purchase')
+    UserProductCount = apps.get_model('barsys', 'UserProductCount')
+
+    counts = Purchase.objects.values("user_id", "product_name", "product_amount").order_by().annotate(
+        num_purchases=models.Count("pk"))
+    UserProductCount.objects.bulk_create((UserProductCount(**c) for c in counts.iterator()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('barsys', '0063_purchase_payment_invoice_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserProductCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_name', models.CharField(max_length=40)),
+                ('product_amount', models.CharField(max_length=12)),
+                ('num_purchases', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'product_name', 'product_amount')},
+            },
+        ),
+        migrations.RunPython(count_purchases, migrations.RunPython.noop),
+    ]
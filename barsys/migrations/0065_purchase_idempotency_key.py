@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 12:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('barsys', '0064_userproductcount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='purchase',
+            name='idempotency_key',
+            field=models.CharField(blank=True, editable=False, help_text='Key chosen by API clients so that uploading the same purchase again does not create it twice', max_length=64, null=True, unique=True),
+        ),
+    ]
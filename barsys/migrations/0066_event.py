@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-17 12:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('barsys', '0065_purchase_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Event',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('purchase', 'New purchase'), ('free_item', 'Free item changed'), ('stats', 'Stats Display changed')], max_length=10)),
+                ('data', models.TextField(default='{}', help_text='JSON')),
+                ('created_date', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'ordering': ['pk'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('barsys', '0066_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='heartbeat_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
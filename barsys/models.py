@@ -1,4 +1,7 @@
 import datetime
+import functools
+import json
+import operator
 from collections import defaultdict
 from decimal import Decimal
 
@@ -6,18 +9,29 @@ from django.contrib.auth.models import (
     BaseUserManager, AbstractBaseUser
 )
 from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MinValueValidator
 from django.db import IntegrityError
 from django.db import models
+from django.db import connection
+from django.db import transaction
 from django.db.models import DecimalField
-from django.db.models import F
+from django.db.models import F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Concat
+from django.dispatch import Signal
 from django.urls import reverse
 from django.utils import formats
 from django.utils import timezone
+from django.utils.text import Truncator
 from django.utils.timezone import localtime
 
 from barsys.templatetags.barsys_helpers import currency
 
+# Sent by PurchaseManager.create_many_from_product, as bulk_create does not send post_save for the purchases
+purchases_bulk_created = Signal(providing_args=["purchases"])
+# Sent by FreeItemManager.take, as the leftover quantity is changed without saving the free item
+free_items_taken = Signal(providing_args=["free_item", "quantity"])
+
 
 class DefaultSelectOrPrefetchManager(models.Manager):
     # https://stackoverflow.com/a/21291161/997151
@@ -54,6 +68,22 @@ class UserQuerySet(models.QuerySet):
     def purchases(self):
         return Purchase.objects.filter(user__in=self)
 
+    def with_financials(self):
+        """ Annotate the total cost of unbilled purchases and the total amount of unbilled payments
+            with subqueries, so they do not have to be queried separately for each user.
+            The account balance is a stored field of each user anyway.
+        """
+        unbilled_purchases = Purchase.objects.unbilled().filter(user=OuterRef("pk")).order_by().values("user") \
+            .annotate(total=models.Sum(F("quantity") * F("product_price"), output_field=DecimalField(decimal_places=2)))
+        unbilled_payments = Payment.objects.unbilled().filter(user=OuterRef("pk")).order_by().values("user") \
+            .annotate(total=models.Sum("amount"))
+
+        return self.annotate(
+            unbilled_purchases_cost=Coalesce(Subquery(unbilled_purchases.values("total")), Decimal('0'),
+                                             output_field=DecimalField(max_digits=10, decimal_places=2)),
+            unbilled_payments_amount=Coalesce(Subquery(unbilled_payments.values("total")), Decimal('0'),
+                                              output_field=DecimalField(max_digits=10, decimal_places=2)))
+
 
 class UserManager(BaseUserManager):
     def get_queryset(self):
@@ -111,6 +141,11 @@ class User(AbstractBaseUser):
                                                           "copy goes to the dependent as notification.",
                                                 limit_choices_to=(Q(purchases_paid_by_other=None)))
 
+    # Materialized sum of all invoices of this user - only changed by creating or deleting invoices
+    # (see InvoiceManager.create_for_user and Invoice.delete) and by `./manage.py rebuild_account_balances`
+    balance = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0'), editable=False,
+                                  help_text="Current account balance (automatically calculated from invoices)")
+
     # Dates
     created_date = models.DateTimeField(auto_now_add=True)
     modified_date = models.DateTimeField(auto_now=True)
@@ -144,7 +179,7 @@ class User(AbstractBaseUser):
             orig = User.objects.get(pk=self.pk)
             if orig.purchases_paid_by_other_id is None and self.purchases_paid_by_other_id is not None:
                 # change from self-paying to dependant
-                if self.account_balance() < 0:
+                if orig.account_balance() < 0:
                     raise ValidationError({'purchases_paid_by_other':
                                                "Cannot make user a dependant if they have a negative account balance."})
                 if self.payments().unbilled().exists():
@@ -153,6 +188,11 @@ class User(AbstractBaseUser):
 
     def save(self, *args, **kwargs):
         self.clean()  # do not call full_clean b/c password may be empty
+        if self.pk is not None and not kwargs.get("force_insert") and kwargs.get("update_fields") is None:
+            # Never write back the balance of an existing user: this instance may have been loaded before an
+            # invoice was created or deleted, which would silently overwrite the correct balance
+            kwargs["update_fields"] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name != "balance"]
         super(User, self).save(*args, **kwargs)
 
     def get_full_name(self):
@@ -197,7 +237,7 @@ class User(AbstractBaseUser):
         return reverse('admin_user_detail', kwargs={'pk': self.pk})
 
     def cannot_be_deleted(self):
-        if self.purchases().count() == 0:
+        if not self.purchases().exists():
             return False
         else:
             return "This user cannot be deleted because they have purchases."
@@ -219,21 +259,39 @@ class User(AbstractBaseUser):
         return self.purchases_paid_by_other_id is None
 
     def account_balance(self):
+        return self.balance
+
+    def calculate_account_balance(self):
+        """ Calculate the account balance from all invoices (instead of using the stored balance) """
         # rounding should NOT be necessary (and really is not), but there is
         #   a problem with SQLite not handling Decimal objects quite as it
         #   should: https://code.djangoproject.com/ticket/29823
-        #   This currently is mainly used so that a pybarsys unit test
-        #   does not fail, which is... somewhat suboptimal
         return -round(self.invoices().sum_amount(), 2)
 
+    def change_balance(self, difference):
+        """ Atomically add difference to the stored balance and refresh this instance """
+        User.objects.filter(pk=self.pk).update(balance=F("balance") + difference)
+        self.refresh_from_db(fields=["balance"])
+
+
+class CategoryQuerySet(models.QuerySet):
+    def with_num_products(self):
+        """ Annotate the number of products, so it does not have to be counted separately for each category """
+        return self.annotate(num_products=models.Count("product"))
+
 
 class Category(models.Model):
     name = models.CharField(max_length=40, unique=True, blank=False)
 
+    objects = CategoryQuerySet.as_manager()
+
     def __str__(self):
         return "{}".format(self.name)
 
     def get_number_products(self):
+        if hasattr(self, "num_products"):
+            # annotated by CategoryQuerySet.with_num_products
+            return self.num_products
         return self.get_products().count()
 
     get_number_products.short_description = "Number of products"
@@ -248,8 +306,7 @@ class Category(models.Model):
         return reverse('admin_category_detail', kwargs={'pk': self.pk})
 
     def cannot_be_deleted(self):
-        product_count = Product.objects.filter(category=self).count()
-        if product_count > 0:
+        if self.get_products().exists():
             return "There is at least one product in this category"
         else:
             return False
@@ -302,6 +359,7 @@ class InvoiceQuerySet(models.QuerySet):
 
 
 class InvoiceManager(models.Manager):
+    @transaction.atomic
     def create_for_user(self, user, comment = ""):
         if not user.pays_themselves():
             raise IntegrityError("Cannot create an invoice for someone who does not pay for themselves")
@@ -335,8 +393,71 @@ class InvoiceManager(models.Manager):
 
         invoice.save()
 
+        user.change_balance(-invoice.due())
+
         return invoice
 
+    @transaction.atomic
+    def create_for_users(self, users, comment=""):
+        """ Create invoices for all users who have unbilled purchases (including purchases of their dependants)
+            or unbilled payments, with a constant number of set-based queries instead of several per user.
+            Returns the list of new invoices.
+        """
+        users = {u.pk: u for u in users}
+        if any(not u.pays_themselves() for u in users.values()):
+            raise IntegrityError("Cannot create an invoice for someone who does not pay for themselves")
+
+        purchases_to_bill = Purchase.objects.unbilled().filter(
+            Q(user_id__in=users.keys()) | Q(user__purchases_paid_by_other_id__in=users.keys()))
+        payments_to_bill = Payment.objects.unbilled().filter(user_id__in=users.keys())
+
+        # users who pay for at least one purchase or have at least one payment
+        payer_ids = set(purchases_to_bill.annotate(payer=Coalesce("user__purchases_paid_by_other_id", "user_id"))
+                        .values_list("payer", flat=True).order_by().distinct())
+        payer_ids.update(payments_to_bill.values_list("user_id", flat=True).order_by().distinct())
+
+        if not payer_ids:
+            return []
+
+        invoices = [Invoice(recipient=users[pk], amount_purchases=0, amount_payments=0, comment=comment)
+                    for pk in sorted(payer_ids, key=lambda pk: users[pk].display_name)]
+        if connection.features.can_return_ids_from_bulk_insert:
+            self.bulk_create(invoices)
+        else:
+            # primary keys of the new invoices are needed below
+            for invoice in invoices:
+                invoice.save()
+        invoice_ids = [i.pk for i in invoices]
+
+        # Attach purchases and payments to the new invoice of their payer, then sum up what was attached.
+        # Summing afterwards makes sure that the amounts always match the attached purchases and payments.
+        new_invoices = Invoice.objects.filter(pk__in=invoice_ids).order_by()
+        purchases_to_bill.filter(Q(user_id__in=payer_ids) | Q(user__purchases_paid_by_other_id__in=payer_ids)).update(
+            invoice_id=Coalesce(
+                Subquery(new_invoices.filter(recipient_id=OuterRef("user_id")).values("pk")),
+                Subquery(new_invoices.filter(recipient__user=OuterRef("user_id")).values("pk"))))
+        payments_to_bill.update(
+            invoice_id=Subquery(new_invoices.filter(recipient_id=OuterRef("user_id")).values("pk")))
+
+        purchase_sums = dict(Purchase.objects.filter(invoice_id__in=invoice_ids).values("invoice_id").order_by()
+                             .annotate(total_cost=models.Sum(F("quantity") * F("product_price"),
+                                                             output_field=DecimalField(decimal_places=2)))
+                             .values_list("invoice_id", "total_cost"))
+        payment_sums = dict(Payment.objects.filter(invoice_id__in=invoice_ids).values("invoice_id").order_by()
+                            .annotate(total_amount=models.Sum("amount"))
+                            .values_list("invoice_id", "total_amount"))
+
+        for invoice in invoices:
+            invoice.amount_purchases = round(purchase_sums.get(invoice.pk, Decimal('0')), 2)
+            invoice.amount_payments = round(payment_sums.get(invoice.pk, Decimal('0')), 2)
+        self.bulk_update(invoices, ["amount_purchases", "amount_payments"])
+
+        User.objects.filter(pk__in=payer_ids).update(balance=F("balance") - Subquery(
+            new_invoices.filter(recipient_id=OuterRef("pk")).values("recipient_id").order_by()
+                .annotate(due=models.Sum(F("amount_purchases") - F("amount_payments"))).values("due")))
+
+        return invoices
+
 
 class Invoice(models.Model):
     recipient = models.ForeignKey(User, on_delete=models.PROTECT)
@@ -355,6 +476,10 @@ class Invoice(models.Model):
 
     class Meta:
         ordering = ["-created_date"]
+        indexes = [
+            # last invoices of a user
+            models.Index(fields=["recipient", "-created_date"], name="invoice_recipient_created_idx"),
+        ]
 
     def purchases(self):
         return Purchase.objects.filter(invoice=self)
@@ -374,6 +499,14 @@ class Invoice(models.Model):
     def cannot_be_deleted(self):
         return False
 
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        """ Delete invoice and give the due amount back to the recipient's stored balance """
+        recipient = self.recipient
+        result = super(Invoice, self).delete(*args, **kwargs)
+        recipient.change_balance(self.due())
+        return result
+
     def own_purchases(self):
         return self.purchases().paid_as_self(self.recipient)
 
@@ -381,26 +514,24 @@ class Invoice(models.Model):
         return self.purchases().paid_as_other(self.recipient)
 
     def has_dependant_purchases(self):
-        if self.own_purchases().count() == self.purchases().count():
-            return False
-        else:
-            return True
+        return self.other_purchases().exists()
 
-    def other_purchases_grouped(self):
-        """ Create a list of tuples in the format (User, PurchaseQuerySet) of purchases
-            that the recipient paid for other users
+    def other_purchases_grouped(self, use_cache=True):
+        """ Create a list of tuples in the format (User, PurchaseList) of purchases
+            that the recipient paid for other users.
+            As invoiced purchases cannot be changed, the result is kept on this instance unless use_cache is False.
         """
-        other_purchases = self.other_purchases()
-
-        other_users = other_purchases.values("user").order_by("user").distinct()
+        if use_cache and getattr(self, "_other_purchases_grouped", None) is not None:
+            return self._other_purchases_grouped
 
         other_purchases_grouped = []
 
-        for u in other_users:
-            user_id = u["user"]
-            other_purchases_grouped.append(
-                (User.objects.get(pk=user_id), other_purchases.filter(user=user_id).order_by("-created_date")))
+        for purchase in self.other_purchases().select_related("user").order_by("user_id", "-created_date"):
+            if not other_purchases_grouped or other_purchases_grouped[-1][0].pk != purchase.user_id:
+                other_purchases_grouped.append((purchase.user, PurchaseList()))
+            other_purchases_grouped[-1][1].append(purchase)
 
+        self._other_purchases_grouped = other_purchases_grouped
         return other_purchases_grouped
 
     def get_absolute_url(self):
@@ -497,6 +628,50 @@ class PurchaseManager(models.Manager):
         p.save()
         return p
 
+    def create_many_from_product(self, product, users, quantity, comment="", free_item=None):
+        """ Create one purchase of product for each of users with a single INSERT and return them.
+            If free_item is given, the purchases are free and quantity * len(users) is subtracted from its
+            leftover quantity (raises FreeItemSoldOut if not enough are left).
+
+            Unlike Purchase.save(), all purchases are validated together.
+        """
+        users = list(users)
+        if not users:
+            return []
+
+        purchase_data = dict(product_amount=product.amount, product_category=product.category.name,
+                             product_name=product.name, product_price=product.price, quantity=quantity,
+                             comment=comment)
+        if free_item is not None:
+            purchase_data.update(product_price=Decimal(0), is_free_item_purchase=True)
+
+        with transaction.atomic():
+            if free_item is not None:
+                FreeItem.objects.take(free_item, quantity * len(users))
+                purchase_data["free_item_description"] = Truncator(free_item.verbose_str()).chars(120)
+
+            # the purchases only differ in their user, so validating one of them is enough
+            Purchase(user=users[0], **purchase_data).full_clean(exclude=["user"])
+
+            purchases = self.bulk_create([Purchase(user=user, **purchase_data) for user in users])
+            if any(purchase.pk is None for purchase in purchases):
+                # the database did not return the primary keys (SQLite). This transaction holds the only write
+                # lock since the INSERT, so the new purchases are the last ones.
+                purchases = list(self.select_related("user").order_by("-pk")[:len(purchases)])[::-1]
+            purchases_bulk_created.send(sender=Purchase, purchases=purchases)
+
+        return purchases
+
+
+class PurchaseList(list):
+    """ Purchases which were already fetched, usable in templates instead of a PurchaseQuerySet """
+
+    def sum_cost(self):
+        return sum((p.cost() for p in self), Decimal('0'))
+
+    def sum_quantity(self):
+        return sum(p.quantity for p in self)
+
 
 class Purchase(models.Model):
     user = models.ForeignKey(User, on_delete=models.PROTECT, null=False)
@@ -518,6 +693,10 @@ class Purchase(models.Model):
     free_item_description = models.CharField(max_length=120, blank=True,
                                              help_text="Description of free item (only if this was purchased for free)")
 
+    idempotency_key = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False,
+                                       help_text="Key chosen by API clients so that uploading the same purchase "
+                                                 "again does not create it twice")
+
     # Dates
     created_date = models.DateTimeField(auto_now_add=True)
     modified_date = models.DateTimeField(auto_now=True)
@@ -526,6 +705,17 @@ class Purchase(models.Model):
 
     class Meta:
         ordering = ["-created_date"]
+        indexes = [
+            # unbilled purchases of a user (also grouped by product for the most bought product)
+            models.Index(fields=["user", "product_name", "product_amount"], name="purchase_unbilled_user_idx",
+                         condition=Q(invoice__isnull=True)),
+            # purchases in a time period grouped by user, and the latest purchases of all users
+            models.Index(fields=["created_date", "user"], name="purchase_created_user_idx"),
+            # purchase history of a user
+            models.Index(fields=["user", "-created_date"], name="purchase_user_created_idx"),
+            # grouping by product
+            models.Index(fields=["product_name", "product_amount"], name="purchase_product_idx"),
+        ]
 
     def __str__(self):
         return "{}x {} ({}, {})".format(self.quantity, self.product_name, self.user.display_name, currency(self.cost()))
@@ -562,6 +752,175 @@ class Purchase(models.Model):
         super(Purchase, self).save(*args, **kw)
 
 
+def add_to_counters(manager, key_fields, changes):
+    """ Add increments to the counter fields of rows with unique key_fields, creating missing rows first.
+        Safe to use concurrently as the additions happen in the database.
+
+        :param changes: dict {tuple of key_fields values: {counter field name: increment}}
+    """
+    # rows that get the same increments (e.g. one purchase by several users) are updated together
+    keys_by_increments = defaultdict(list)
+    for key, increments in changes.items():
+        keys_by_increments[tuple(sorted(increments.items()))].append(key)
+
+    for increments, keys in keys_by_increments.items():
+        condition = functools.reduce(operator.or_, (Q(**dict(zip(key_fields, key))) for key in keys))
+        rows = manager.filter(condition)
+
+        existing_keys = set(rows.values_list(*key_fields))
+        missing_keys = [key for key in keys if key not in existing_keys]
+        if missing_keys:
+            # rows created concurrently in the meantime are kept
+            manager.bulk_create([manager.model(**dict(zip(key_fields, key))) for key in missing_keys],
+                                ignore_conflicts=True)
+
+        rows.update(**{name: F(name) + value for name, value in increments})
+
+
+def get_bucket_hour(date):
+    """ Start of the local hour of date, i.e. of the PurchaseBucket that a purchase at date belongs to """
+    return localtime(date).replace(minute=0, second=0, microsecond=0)
+
+
+class PurchaseBucketManager(models.Manager):
+    def add_purchases(self, purchases, sign=1):
+        """ Add purchases to their buckets (or remove them with sign=-1) """
+        changes = defaultdict(lambda: [0, Decimal('0')])
+        for p in purchases:
+            change = changes[(p.user_id, p.product_category, p.product_name, get_bucket_hour(p.created_date))]
+            change[0] += sign * p.quantity
+            change[1] += sign * p.cost()
+
+        add_to_counters(self, ("user_id", "product_category", "product_name", "hour"),
+                        {key: {"quantity": quantity, "cost": cost} for key, (quantity, cost) in changes.items()})
+
+    @transaction.atomic
+    def rebuild(self):
+        """ Recalculate all buckets from the purchases """
+        self.all().delete()
+        purchases = Purchase.objects.only("user_id", "product_category", "product_name", "created_date", "quantity",
+                                          "product_price").order_by()
+        buckets = {}
+        for p in purchases.iterator(chunk_size=5000):
+            key = (p.user_id, p.product_category, p.product_name, get_bucket_hour(p.created_date))
+            if key not in buckets:
+                buckets[key] = PurchaseBucket(user_id=p.user_id, product_category=p.product_category,
+                                              product_name=p.product_name, hour=key[3])
+            buckets[key].quantity += p.quantity
+            buckets[key].cost += p.cost()
+        self.bulk_create(buckets.values())
+        return len(buckets)
+
+    def stats_by_user(self, since, categories=None, products=None, by_cost=False, limit=5):
+        """ Users with the most purchases (or highest total cost) since a point in time as list of tuples
+            [(user_id, display_name, total), ...]. Like PurchaseQuerySet.stats_purchases_by_user and
+            stats_cost_by_user, but reads buckets instead of all single purchases.
+        """
+        # buckets only cover whole hours, the purchases before the first whole hour are counted separately
+        first_hour = get_bucket_hour(since)
+        if first_hour < since:
+            first_hour += datetime.timedelta(hours=1)
+
+        buckets = self.filter(hour__gte=first_hour)
+        purchases = Purchase.objects.filter(created_date__gte=since, created_date__lt=first_hour)
+        if categories:
+            buckets = buckets.filter(product_category__in=categories)
+            purchases = purchases.filter(product_category__in=categories)
+        if products:
+            buckets = buckets.filter(product_name__in=products)
+            purchases = purchases.filter(product_name__in=products)
+
+        if by_cost:
+            bucket_total = models.Sum("cost")
+            purchase_total = models.Sum(F("quantity") * F("product_price"), output_field=DecimalField(decimal_places=2))
+        else:
+            bucket_total = purchase_total = models.Sum("quantity")
+
+        totals = defaultdict(int)
+        for user_id, total in buckets.values("user_id").order_by().annotate(total=bucket_total).values_list(
+                "user_id", "total"):
+            totals[user_id] += total
+        if first_hour > since:
+            for user_id, total in purchases.values("user_id").order_by().annotate(total=purchase_total).values_list(
+                    "user_id", "total"):
+                totals[user_id] += total
+
+        display_names = dict(User.objects.filter(pk__in=[u for u, t in totals.items() if t > 0])
+                             .values_list("pk", "display_name"))
+        ranking = sorted(((total, display_names[user_id], user_id) for user_id, total in totals.items()
+                          if user_id in display_names), key=lambda r: (-r[0], r[1]))
+        return [(user_id, display_name, total) for total, display_name, user_id in ranking[:limit]]
+
+
+class PurchaseBucket(models.Model):
+    """ Purchases summed up per user, product and hour to calculate statistics over long time periods quickly.
+        Kept up to date by signal receivers in barsys/signals.py.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    product_category = models.CharField(max_length=40)
+    product_name = models.CharField(max_length=40)
+    hour = models.DateTimeField(help_text="Start of the (local) hour in which the purchases were made")
+
+    quantity = models.IntegerField(default=0)
+    cost = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0'))
+
+    objects = PurchaseBucketManager()
+
+    class Meta:
+        unique_together = ("hour", "user", "product_category", "product_name")
+
+    def __str__(self):
+        return "{}x {} by user {} at {}".format(self.quantity, self.product_name, self.user_id, self.hour)
+
+
+class UserProductCountManager(models.Manager):
+    def add_purchases(self, purchases, sign=1):
+        """ Count purchases for their users and products (or stop counting them with sign=-1) """
+        changes = defaultdict(int)
+        for p in purchases:
+            changes[(p.user_id, p.product_name, p.product_amount)] += sign
+
+        add_to_counters(self, ("user_id", "product_name", "product_amount"),
+                        {key: {"num_purchases": num_purchases} for key, num_purchases in changes.items()})
+
+    @transaction.atomic
+    def rebuild(self):
+        """ Recount all purchases """
+        self.all().delete()
+        counts = Purchase.objects.values("user_id", "product_name", "product_amount").order_by().annotate(
+            num_purchases=models.Count("pk"))
+        return len(self.bulk_create([UserProductCount(**c) for c in counts.iterator()]))
+
+    def most_bought_product(self, users):
+        """ The currently available product that users bought most often as dict with product_name and
+            product_amount, or None if they have not bought any of them yet
+        """
+        available = Product.objects.active().filter(name=OuterRef("product_name"), amount=OuterRef("product_amount"))
+        return self.filter(user__in=users).values("product_name", "product_amount").annotate(
+            total_purchases=models.Sum("num_purchases"), available=models.Exists(available)).filter(
+            available=True, total_purchases__gt=0).values("product_name", "product_amount").order_by(
+            "-total_purchases").first()
+
+
+class UserProductCount(models.Model):
+    """ Number of purchases of each product by each user, used to preselect the favorite product of a user.
+        Kept up to date by signal receivers in barsys/signals.py.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    product_name = models.CharField(max_length=40)
+    product_amount = models.CharField(max_length=12)
+    num_purchases = models.IntegerField(default=0)
+
+    objects = UserProductCountManager()
+
+    class Meta:
+        unique_together = ("user", "product_name", "product_amount")
+
+    def __str__(self):
+        return "{} ({}) bought {} times by user {}".format(self.product_name, self.product_amount,
+                                                           self.num_purchases, self.user_id)
+
+
 class PaymentQuerySet(models.QuerySet):
     def sum_amount(self):
         """ Total amount of all payments """
@@ -606,6 +965,10 @@ class Payment(models.Model):
 
     class Meta:
         ordering = ["-created_date"]
+        indexes = [
+            # unbilled payments of a user
+            models.Index(fields=["user", "invoice"], name="payment_user_invoice_idx"),
+        ]
 
     def __str__(self):
         return "Payment of {} by {}".format(currency(self.amount), self.user.display_name)
@@ -747,6 +1110,26 @@ class StatsDisplay(models.Model):
 
             return last4pm
 
+    def next_time_period_change(self):
+        """ When time_period_begin() changes next or None if it changes continuously (fixed duration) """
+        now = localtime(timezone.now())
+        today = now.date()
+        if self.time_period_method == self.SINCE_MONDAY:
+            next_change = today + datetime.timedelta(days=7 - now.weekday())
+        elif self.time_period_method == self.SINCE_1ST:
+            next_change = (today.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        elif self.time_period_method == self.SINCE_JAN_1ST:
+            next_change = today.replace(year=today.year + 1, month=1, day=1)
+        elif self.time_period_method == self.SINCE_TODAY_MIDNIGHT:
+            next_change = today + datetime.timedelta(days=1)
+        elif self.time_period_method == self.SINCE_4pm:
+            day = today if now.hour < 16 else today + datetime.timedelta(days=1)
+            return timezone.make_aware(datetime.datetime.combine(day, datetime.time(hour=16)))
+        else:
+            return None
+
+        return timezone.make_aware(datetime.datetime.combine(next_change, datetime.time()))
+
 
 class ProductAutochange(models.Model):
     """ Set of changes that can be applied to one product """
@@ -821,8 +1204,14 @@ class ProductAutochangeSet(models.Model):
     def cannot_be_deleted(self):
         return False
 
+    def get_number_products(self):
+        if hasattr(self, "num_products"):
+            # annotated in ProductAutochangeSetListView
+            return self.num_products
+        return self.products.count()
+
     def __str__(self):
-        return "{} ({} product(s) specified)".format(self.title, self.products.count())
+        return "{} ({} product(s) specified)".format(self.title, self.get_number_products())
 
     def execute(self):
         unspecified_products = Product.objects.exclude(pk__in=self.products.all())
@@ -876,6 +1265,26 @@ class ProductAutochangeSet(models.Model):
         ProductAutochange.objects.bulk_create(new_pacs)
 
 
+class FreeItemSoldOut(IntegrityError):
+    """ Raised if fewer free items are left than should be purchased """
+    pass
+
+
+class FreeItemManager(models.Manager):
+    def take(self, free_item, quantity):
+        """ Subtract quantity from the leftover quantity of free_item with a single conditional UPDATE, so that
+            concurrent purchases can never take more items than are left. Raises FreeItemSoldOut if there are not
+            enough left. Should be called in the transaction which creates the purchases.
+        """
+        num_updated = self.filter(pk=free_item.pk, leftover_quantity__gte=quantity).update(
+            leftover_quantity=F("leftover_quantity") - quantity, modified_date=timezone.now())
+        free_item.refresh_from_db(fields=["leftover_quantity", "modified_date"])
+        if num_updated == 0:
+            raise FreeItemSoldOut("There are only {} free items left, so you cannot purchase {}!".format(
+                free_item.leftover_quantity, quantity))
+        free_items_taken.send(sender=FreeItem, free_item=free_item, quantity=quantity)
+
+
 class FreeItem(models.Model):
     """ Model to describe products which are free, but only for a limited number of purchases """
     giver = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL,
@@ -895,6 +1304,8 @@ class FreeItem(models.Model):
     created_date = models.DateTimeField(auto_now_add=True)
     modified_date = models.DateTimeField(auto_now=True)
 
+    objects = FreeItemManager()
+
     def __str__(self):
         return "Free {} ({} item(s) leftover)".format(self.product.name, self.leftover_quantity)
 
@@ -922,3 +1333,166 @@ class FreeItem(models.Model):
 
     def get_absolute_url(self):
         return reverse('admin_freeitem_list')
+
+
+class JobManager(models.Manager):
+    def enqueue(self, kind, created_by=None, **parameters):
+        """ Create a pending job which will be run by the next free worker (see run_jobs management command) """
+        return self.create(kind=kind, created_by=created_by, parameters=json.dumps(parameters))
+
+    def claim_next(self):
+        """ Return the oldest pending job after marking it as running or None if there is no pending job.
+            Safe to use from several workers at once as only one of them can claim a job.
+        """
+        while True:
+            job = self.filter(status=Job.STATUS_PENDING).order_by("created_date", "pk").first()
+            if job is None:
+                return None
+            now = timezone.now()
+            if self.filter(pk=job.pk, status=Job.STATUS_PENDING).update(status=Job.STATUS_RUNNING, started_date=now,
+                                                                         heartbeat_date=now) == 1:
+                job.status = Job.STATUS_RUNNING
+                job.started_date = now
+                job.heartbeat_date = now
+                return job
+            # another worker was faster, try the next job
+
+
+class Job(models.Model):
+    """ Long-running action (e.g. sending many mails) which is run by a background worker """
+    KIND_CREATE_INVOICES = "INV"
+    KIND_SEND_INVOICE_MAILS = "MAIL"
+    KIND_SEND_REMINDER_MAILS = "REM"
+    KIND_CHOICES = ((KIND_CREATE_INVOICES, "Create invoices"),
+                    (KIND_SEND_INVOICE_MAILS, "Send invoice mails"),
+                    (KIND_SEND_REMINDER_MAILS, "Send payment reminders"))
+    kind = models.CharField(max_length=4, choices=KIND_CHOICES)
+
+    STATUS_PENDING = "PEND"
+    STATUS_RUNNING = "RUN"
+    STATUS_DONE = "DONE"
+    STATUS_FAILED = "FAIL"
+    STATUS_CHOICES = ((STATUS_PENDING, "Pending"),
+                      (STATUS_RUNNING, "Running"),
+                      (STATUS_DONE, "Done"),
+                      (STATUS_FAILED, "Failed"))
+    status = models.CharField(max_length=4, choices=STATUS_CHOICES, default=STATUS_PENDING)
+
+    # a running job whose worker showed no progress for this long was probably killed (e.g. by a restart). It is
+    # shown as interrupted and not run again, as e.g. the invoices of a part of the users may already exist.
+    HEARTBEAT_TIMEOUT = datetime.timedelta(minutes=10)
+
+    parameters = models.TextField(default="{}", help_text="JSON encoded keyword arguments of the job")
+
+    # progress, e.g. number of mails to send and already sent
+    num_total = models.PositiveIntegerField(default=0)
+    num_done = models.PositiveIntegerField(default=0)
+
+    log = models.TextField(blank=True)
+
+    created_by = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+
+    # Dates
+    created_date = models.DateTimeField(auto_now_add=True)
+    started_date = models.DateTimeField(null=True, blank=True)
+    finished_date = models.DateTimeField(null=True, blank=True)
+    # updated by the worker whenever the job makes progress
+    heartbeat_date = models.DateTimeField(null=True, blank=True)
+
+    objects = JobManager()
+
+    class Meta:
+        ordering = ["-created_date"]
+
+    def __str__(self):
+        return "{} ({})".format(self.get_kind_display(), self.get_status_display())
+
+    def get_absolute_url(self):
+        return reverse('admin_job_detail', kwargs={'pk': self.pk})
+
+    def get_parameters(self):
+        return json.loads(self.parameters)
+
+    def is_finished(self):
+        return self.status in (Job.STATUS_DONE, Job.STATUS_FAILED)
+
+    def is_interrupted(self):
+        return self.status == Job.STATUS_RUNNING and \
+               (self.heartbeat_date or self.started_date) < timezone.now() - Job.HEARTBEAT_TIMEOUT
+
+    def status_display(self):
+        return "Interrupted" if self.is_interrupted() else self.get_status_display()
+
+    def progress_percent(self):
+        if self.num_total == 0:
+            return 100 if self.is_finished() else 0
+        return min(100, round(100 * self.num_done / self.num_total))
+
+    def append_log(self, text):
+        """ Add a line to the log without overwriting other changes to the job """
+        line = "[{}] {}\n".format(formats.localize(localtime(timezone.now())), text)
+        Job.objects.filter(pk=self.pk).update(log=Concat(F("log"), Value(line)), heartbeat_date=timezone.now())
+        self.log += line
+
+
+class JobResult(models.Model):
+    """ Outcome of a job for a single recipient, e.g. whether an invoice mail was sent """
+    job = models.ForeignKey(Job, on_delete=models.CASCADE, related_name="results")
+    recipient = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+    description = models.CharField(max_length=100)
+    success = models.BooleanField()
+    error = models.TextField(blank=True)
+
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["created_date", "pk"]
+
+    def __str__(self):
+        return "{} for {}: {}".format(self.description, self.recipient, "success" if self.success else self.error)
+
+
+class EventManager(models.Manager):
+    # events are only kept for a while, clients which were offline longer should reload everything
+    MAX_AGE = datetime.timedelta(hours=1)
+
+    def add(self, kind, **data):
+        """ Add an event in the current transaction, so it is committed (or rolled back) together with the change
+            it is about. Changes which should never lose their events have to be made in a transaction.
+        """
+        self.add_many(kind, [data])
+
+    def add_many(self, kind, data_list):
+        self.bulk_create([Event(kind=kind, data=json.dumps(data, cls=DjangoJSONEncoder)) for data in data_list])
+
+    def delete_old(self):
+        return self.filter(created_date__lt=timezone.now() - self.MAX_AGE).delete()[0]
+
+    def last_id(self):
+        return self.aggregate(last_id=Coalesce(models.Max("pk"), 0))["last_id"]
+
+
+class Event(models.Model):
+    """ Notification for clients of the event API (see docs/api.md), e.g. about a new purchase """
+    KIND_PURCHASE = "purchase"
+    KIND_FREE_ITEM = "free_item"
+    KIND_STATS = "stats"
+    KIND_CHOICES = ((KIND_PURCHASE, "New purchase"),
+                    (KIND_FREE_ITEM, "Free item changed"),
+                    (KIND_STATS, "Stats Display changed"))
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    data = models.TextField(default="{}", help_text="JSON")
+
+    created_date = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = EventManager()
+
+    class Meta:
+        ordering = ["pk"]
+
+    def __str__(self):
+        return "{} #{}".format(self.get_kind_display(), self.pk)
+
+    def get_data(self):
+        return json.loads(self.data)
@@ -0,0 +1,95 @@
+import datetime
+import json
+import random
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import User, Category, Product, Purchase, Payment, Invoice, FreeItem, StatsDisplay, \
+    ProductAutochangeSet, ProductAutochange, Job, JobResult, PurchaseBucket, UserProductCount
+
+CATEGORY_NAMES = ("Softdrinks", "Beer", "Coffee", "Snacks")
+NUM_PRODUCTS_PER_CATEGORY = 10
+# purchases per hour of the day, most of them in the evening
+HOUR_WEIGHTS = [2, 1, 1, 0, 0, 0, 0, 0, 1, 1, 2, 2, 3, 2, 2, 2, 3, 4, 6, 8, 10, 10, 8, 5]
+
+
+def create_dataset(num_users, num_purchases, num_payments, num_days=90, seed=0, admin_email="admin@example.com",
+                   admin_password="password"):
+    """ Fill an empty database with a reproducible data set: users in groups of ten where the first one pays for
+        the last two, categories and products, purchases spread over the last num_days days (mostly in the evening),
+        payments, invoices for half of the payers, free items, Stats Displays, a product autochange set and a job.
+        Returns a dict with some of the created objects.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+
+    admin = User.objects.create_superuser(admin_email, "admin", admin_password)
+    User.objects.bulk_create([User(email="user{}@example.com".format(i), display_name="user{}".format(i),
+                                   is_favorite=i % 20 == 0) for i in range(num_users)])
+    users = list(User.objects.exclude(pk=admin.pk).order_by("pk"))
+    for i, user in enumerate(users):
+        if i % 10 >= 8:
+            user.purchases_paid_by_other = users[i - i % 10]
+    User.objects.bulk_update(users, ["purchases_paid_by_other"])
+    payers = [u for u in users if u.purchases_paid_by_other_id is None]
+
+    categories = [Category.objects.create(name=name) for name in CATEGORY_NAMES]
+    Product.objects.bulk_create([Product(category=category, name="{} {}".format(category.name, i),
+                                         price=Decimal(rng.randint(50, 300)) / 100, amount="0.5 l",
+                                         is_bold=i == 0)
+                                 for category in categories for i in range(NUM_PRODUCTS_PER_CATEGORY)])
+    products = list(Product.objects.select_related("category"))
+
+    purchases = []
+    for i in range(num_purchases):
+        product = rng.choice(products)
+        purchases.append(Purchase(user=rng.choice(users), product_category=product.category.name,
+                                  product_name=product.name, product_amount=product.amount,
+                                  product_price=product.price, quantity=rng.randint(1, 3)))
+    Purchase.objects.bulk_create(purchases)
+    # bulk_create sets the creation date to now, spread them over the last days instead (one update per hour)
+    purchase_ids = list(Purchase.objects.order_by("pk").values_list("pk", flat=True))
+    hours = sorted(rng.choices(range(num_days * 24), k=len(purchase_ids),
+                               weights=[HOUR_WEIGHTS[h % 24] for h in range(num_days * 24)]))
+    start = now.replace(minute=0, second=0, microsecond=0) - datetime.timedelta(days=num_days)
+    first = 0
+    for i in range(1, len(hours) + 1):
+        if i == len(hours) or hours[i] != hours[first]:
+            Purchase.objects.filter(pk__gte=purchase_ids[first], pk__lte=purchase_ids[i - 1]).update(
+                created_date=start + datetime.timedelta(hours=hours[first], minutes=rng.randint(0, 59)))
+            first = i
+
+    Payment.objects.bulk_create([Payment(user=rng.choice(payers), amount=Decimal(rng.randint(1, 50)))
+                                 for i in range(num_payments)])
+    invoices = Invoice.objects.create_for_users(payers[:len(payers) // 2])
+
+    free_items = [FreeItem.objects.create(product=products[i], giver=payers[i % len(payers)], leftover_quantity=20)
+                  for i in range(10)]
+
+    drinker = StatsDisplay.objects.create(title="Drinker", row_string="drinks by", show_by_default=True)
+    drinker.filter_by_category.add(categories[0], categories[1])
+    StatsDisplay.objects.create(title="Spender", sort_by_and_show=StatsDisplay.SORT_BY_TOTAL_COST_SHOW_RANK,
+                                time_period_method=StatsDisplay.FIXED_DURATION)
+
+    autochange_set = ProductAutochangeSet.objects.create(title="Happy hour")
+    for product in products[:5]:
+        ProductAutochange.objects.create(pc_set=autochange_set, product=product, set_price=Decimal('1'))
+
+    # an already finished job, so that running workers do not pick it up
+    job = Job.objects.create(kind=Job.KIND_CREATE_INVOICES, created_by=admin, status=Job.STATUS_DONE,
+                             parameters=json.dumps({"user_ids": [u.pk for u in payers[:10]]}),
+                             num_total=10, num_done=10, started_date=now, finished_date=now,
+                             log="Created 10 invoices (seed data)")
+    JobResult.objects.bulk_create([JobResult(job=job, recipient=user, description="Invoice", success=True)
+                                   for user in payers[:10]])
+
+    PurchaseBucket.objects.rebuild()
+    UserProductCount.objects.rebuild()
+    cache.clear()
+
+    return {"admin": admin, "user": payers[0], "users": payers[:3], "dependant": users[9], "category": categories[0],
+            "product": products[0], "purchase": Purchase.objects.filter(invoice=None).first(),
+            "payment": Payment.objects.filter(invoice=None).first(), "invoice": invoices[0] if invoices else None,
+            "free_item": free_items[0], "stats_display": drinker, "autochange_set": autochange_set, "job": job}
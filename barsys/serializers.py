@@ -23,3 +23,14 @@ class ProductSerializer(serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = '__all__'
+
+
+class BulkPurchaseSerializer(serializers.Serializer):
+    """ One purchase of a bulk upload. Only the format is checked here, users and products are checked by
+        view_helpers.create_purchases_in_bulk for all purchases at once.
+    """
+    user_id = serializers.IntegerField()
+    product_id = serializers.RegexField(r'^(free_item_)?[0-9]+$', max_length=30)  # "free_item_N" for free items
+    quantity = serializers.IntegerField(min_value=1)
+    comment = serializers.CharField(max_length=50, required=False, allow_blank=True, default="")
+    idempotency_key = serializers.CharField(max_length=64, required=False)
@@ -0,0 +1,119 @@
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from . import view_helpers
+from .models import purchases_bulk_created, free_items_taken, Purchase, PurchaseBucket, UserProductCount, StatsDisplay, Category, Product, User, FreeItem, \
+    ProductAutochangeSet, ProductAutochange, Event
+
+
+@receiver(pre_save, sender=Purchase)
+def remember_purchase_before_change(sender, instance, **kwargs):
+    if instance.pk is not None:
+        instance._purchase_before_change = Purchase.objects.filter(pk=instance.pk).first()
+
+
+@receiver(post_save, sender=Purchase)
+def count_purchase(sender, instance, created, **kwargs):
+    previous = getattr(instance, "_purchase_before_change", None)
+    if previous is not None:
+        PurchaseBucket.objects.add_purchases([previous], sign=-1)
+        UserProductCount.objects.add_purchases([previous], sign=-1)
+        instance._purchase_before_change = None
+    PurchaseBucket.objects.add_purchases([instance])
+    UserProductCount.objects.add_purchases([instance])
+
+
+@receiver(post_delete, sender=Purchase)
+def uncount_purchase(sender, instance, **kwargs):
+    PurchaseBucket.objects.add_purchases([instance], sign=-1)
+    UserProductCount.objects.add_purchases([instance], sign=-1)
+
+
+@receiver(purchases_bulk_created, sender=Purchase)
+def count_bulk_created_purchases(sender, purchases, **kwargs):
+    PurchaseBucket.objects.add_purchases(purchases)
+    UserProductCount.objects.add_purchases(purchases)
+
+
+@receiver([post_save, post_delete], sender=Purchase)
+@receiver(purchases_bulk_created, sender=Purchase)
+@receiver([post_save, post_delete], sender=StatsDisplay)
+@receiver(m2m_changed, sender=StatsDisplay.filter_by_category.through)
+@receiver(m2m_changed, sender=StatsDisplay.filter_by_product.through)
+@receiver(post_save, sender=Category)  # StatsDisplays filter by category and product names
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=User)  # display names are shown
+def invalidate_stats_elements(sender, **kwargs):
+    view_helpers.invalidate_stats_elements()
+
+
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=FreeItem)
+@receiver([post_save, post_delete], sender=ProductAutochangeSet)
+@receiver([post_save, post_delete], sender=ProductAutochange)
+@receiver(free_items_taken, sender=FreeItem)
+def invalidate_purchase_menu(sender, **kwargs):
+    view_helpers.invalidate_purchase_menu()
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_user_api_data(sender, **kwargs):
+    view_helpers.invalidate_api_data("users")
+
+
+@receiver([post_save, post_delete], sender=Category)  # category names are part of the products
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_product_api_data(sender, **kwargs):
+    view_helpers.invalidate_api_data("products")
+
+
+@receiver([post_save, post_delete], sender=User)
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=FreeItem)
+@receiver([post_save, post_delete], sender=ProductAutochangeSet)
+@receiver([post_save, post_delete], sender=ProductAutochange)
+@receiver(free_items_taken, sender=FreeItem)
+def invalidate_kiosk_api_data(sender, **kwargs):
+    view_helpers.invalidate_api_data("kiosk")
+
+
+def purchase_event_data(purchase):
+    return {"id": purchase.pk, "user_id": purchase.user_id, "user": purchase.user.display_name,
+            "product_name": purchase.product_name, "product_amount": purchase.product_amount,
+            "quantity": purchase.quantity, "is_free_item_purchase": purchase.is_free_item_purchase,
+            "created_date": purchase.created_date}
+
+
+@receiver(post_save, sender=Purchase)
+def add_purchase_event(sender, instance, created, **kwargs):
+    if created:
+        Event.objects.add(Event.KIND_PURCHASE, **purchase_event_data(instance))
+
+
+@receiver(purchases_bulk_created, sender=Purchase)
+def add_bulk_purchase_events(sender, purchases, **kwargs):
+    Event.objects.add_many(Event.KIND_PURCHASE, [purchase_event_data(p) for p in purchases])
+
+
+@receiver(post_save, sender=FreeItem)
+@receiver(free_items_taken, sender=FreeItem)
+def add_free_item_event(sender, free_item=None, instance=None, **kwargs):
+    free_item = free_item or instance
+    Event.objects.add(Event.KIND_FREE_ITEM, id=free_item.pk, product_id=free_item.product_id,
+                      leftover_quantity=free_item.leftover_quantity, purchasable=free_item.purchasable)
+
+
+@receiver(post_delete, sender=FreeItem)
+def add_deleted_free_item_event(sender, instance, **kwargs):
+    Event.objects.add(Event.KIND_FREE_ITEM, id=instance.pk, product_id=instance.product_id, leftover_quantity=0,
+                      purchasable=False)
+
+
+@receiver([post_save, post_delete], sender=StatsDisplay)
+@receiver(m2m_changed, sender=StatsDisplay.filter_by_category.through)
+@receiver(m2m_changed, sender=StatsDisplay.filter_by_product.through)
+def add_stats_event(sender, action="post_save", **kwargs):
+    if action.startswith("post_"):
+        Event.objects.add(Event.KIND_STATS)
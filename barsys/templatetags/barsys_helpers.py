@@ -1,5 +1,6 @@
+import functools
 import locale
-import babel.numbers
+import babel
 from re import sub as re_sub
 
 from bootstrap3.templatetags.bootstrap3 import bootstrap_icon
@@ -25,27 +26,49 @@ def bool_to_icon(value):
         return bicon("remove")
 
 
-def get_locale_str():
+def get_locale_str(language_code=None):
     """ Please tell me how to do this the right way """
-    l = settings.LANGUAGE_CODE
+    l = settings.LANGUAGE_CODE if language_code is None else language_code
     l_split = l.split('-')
     l = l_split[0].lower() + "_" + l_split[1].upper() + ".UTF-8"
 
     return l
 
 
+@functools.lru_cache()
+def get_currency_formatter(language_code):
+    """ Function formatting amounts in the currency of language_code, with everything except the formatting itself
+        looked up only once per process
+    """
+    locale_str = get_locale_str(language_code)
+
+    # setlocale is process-wide and not thread-safe, so it is only used once to find the currency symbol
+    previous_locale = locale.setlocale(locale.LC_ALL)
+    try:
+        locale.setlocale(locale.LC_ALL, locale_str)
+        currency_symbol = locale.localeconv()["currency_symbol"]  # $/€/...
+    finally:
+        locale.setlocale(locale.LC_ALL, previous_locale)
+
+    # use babel for actual formatting as the locale module has weird behavior
+    # in some cases (e.g. negative amounts with nl_NL)
+    # cmp. https://github.com/nspo/pybarsys/pull/23
+    babel_locale = babel.Locale.parse(locale_str)
+    pattern = babel_locale.currency_formats["standard"]
+
+    def format_currency(value):
+        return pattern.apply(value, babel_locale, currency=currency_symbol, currency_digits=True,
+                             decimal_quantization=True, group_separator=True)
+
+    return format_currency
+
+
 @register.filter(name='currency')
 def currency(value):
     if not value:
         value = 0
 
-    locale.setlocale(locale.LC_ALL, get_locale_str())
-    currency_symbol = locale.localeconv()["currency_symbol"] # $/€/...  
-    # use babel for actual formatting as the locale module has weird behavior 
-    # in some cases (e.g. negative amounts with nl_NL)
-    # cmp. https://github.com/nspo/pybarsys/pull/23
-    return babel.numbers.format_currency(value, currency=currency_symbol, locale=get_locale_str())
-
+    return get_currency_formatter(settings.LANGUAGE_CODE)(value)
 
 
 @register.filter()
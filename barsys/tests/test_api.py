@@ -1,9 +1,18 @@
+import threading
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection, transaction, IntegrityError
 from django.test import TransactionTestCase, Client
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 from rest_framework.utils import json
 
+from barsys import view_helpers
 from barsys.models import *
 from barsys.serializers import *
+from pybarsys.settings import PybarsysPreferences
 
 
 class ApiTestCase(TransactionTestCase):
@@ -91,3 +100,260 @@ class ApiTestCase(TransactionTestCase):
         response = self.client.post(reverse('main_purchase_api'), data=json.dumps(json_purchase),
                                     content_type="application/json")
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def post_bulk(self, purchases):
+        return self.client.post(reverse('main_purchase_bulk_api'), data=json.dumps(purchases),
+                                content_type="application/json")
+
+    def test_post_bulk_purchases(self):
+        free_item = FreeItem.objects.create(product=self.prod1, leftover_quantity=3)
+        u2 = User.objects.get(display_name="user2")
+        json_purchases = [
+            {"user_id": self.u1.pk, "quantity": 2, "product_id": self.prod1.pk, "idempotency_key": "t1-1"},
+            {"user_id": u2.pk, "quantity": 1, "product_id": str(self.prod1.pk), "comment": "bulk"},
+            {"user_id": -1, "quantity": 1, "product_id": self.prod1.pk},
+            {"user_id": self.u1.pk, "quantity": 0, "product_id": self.prod1.pk},
+            {"user_id": u2.pk, "quantity": 2, "product_id": "free_item_{}".format(free_item.pk)},
+            {"user_id": self.u1.pk, "quantity": 2, "product_id": "free_item_{}".format(free_item.pk)},
+            {"user_id": self.u1.pk, "quantity": 2, "product_id": self.prod1.pk, "idempotency_key": "t1-1"},
+        ]
+        response = self.post_bulk(json_purchases)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([r["status"] for r in response.data], [201, 201, 400, 400, 201, 400, 200])
+        self.assertEqual(response.data[2]["errors"], {"user_id": ["Invalid user ID"]})
+        self.assertEqual(response.data[5]["errors"],
+                         {"quantity": ["There are only 1 items left, so you cannot purchase 2!"]})
+
+        for result in response.data:
+            if "purchase" in result:
+                purchase = Purchase.objects.get(pk=result["purchase"]["id"])
+                self.assertEqual(result["purchase"], PurchaseSerializer(purchase).data)
+        self.assertEqual(response.data[6]["purchase"], response.data[0]["purchase"])
+        self.assertEqual(response.data[4]["purchase"]["comment"], "free")
+        self.assertEqual(Purchase.objects.filter(idempotency_key__isnull=False).count(), 3)
+        self.assertEqual(FreeItem.objects.get().leftover_quantity, 1)
+        self.assertEqual(UserProductCount.objects.get(user=self.u1).num_purchases, 2)
+        self.assertEqual(sorted(e.get_data()["id"] for e in Event.objects.filter(kind=Event.KIND_PURCHASE)),
+                         sorted(Purchase.objects.values_list("pk", flat=True)))
+
+        # retrying does not create the purchases again
+        response = self.post_bulk(json_purchases[:1])
+        self.assertEqual(response.data[0]["status"], 200)
+        self.assertEqual(Purchase.objects.count(), 5)
+
+    def test_post_bulk_purchases_num_queries(self):
+        users = User.objects.all()
+        num_queries = []
+        # the first upload also adds the rows of UserProductCount and PurchaseBucket
+        for num_purchases_per_user in (1, 1, 10):
+            json_purchases = [{"user_id": u.pk, "quantity": 1, "product_id": self.prod1.pk}
+                              for i in range(num_purchases_per_user) for u in users]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.post_bulk(json_purchases)
+            self.assertEqual([r["status"] for r in response.data], [201] * len(json_purchases))
+            num_queries.append(len(queries))
+        self.assertEqual(num_queries[1], num_queries[2])
+
+    def test_post_bulk_purchases_sold_out(self):
+        free_item = FreeItem.objects.create(product=self.prod1, leftover_quantity=3)
+        json_purchases = [{"user_id": self.u1.pk, "quantity": 2, "product_id": "free_item_{}".format(free_item.pk)}]
+
+        # someone else purchases free items after they were checked
+        take = FreeItem.objects.take
+        with mock.patch.object(FreeItem.objects, "take", side_effect=lambda f, q: (take(f, 2), take(f, q))):
+            response = self.post_bulk(json_purchases)
+        self.assertEqual(response.data[0]["status"], 409)
+        self.assertEqual(FreeItem.objects.get().leftover_quantity, 1)
+        self.assertEqual(Purchase.objects.count(), 2)
+
+    def test_invalid_post_bulk_purchases(self):
+        response = self.post_bulk({"user_id": self.u1.pk, "quantity": 1, "product_id": self.prod1.pk})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_purchase_feed(self):
+        now = timezone.now()
+        for i in range(5):
+            with mock.patch("django.utils.timezone.now", return_value=now + datetime.timedelta(minutes=i)):
+                Purchase.objects.create(user=self.u1, quantity=i + 1, **self.prod_data)
+        # same creation date
+        with mock.patch("django.utils.timezone.now", return_value=now + datetime.timedelta(minutes=5)):
+            Purchase.objects.create(user=self.u1, quantity=6, **self.prod_data)
+            Purchase.objects.create(user=self.u1, quantity=7, **self.prod_data)
+
+        query = {"user": self.u1.pk, "since": now.isoformat(), "limit": 3}
+        ids = []
+        cursor = None
+        for expected_quantities in ([1, 2, 3], [4, 5, 6], [7], []):
+            # the user filter checks that the user exists
+            with self.assertNumQueries(2):
+                response = self.client.get(reverse('main_purchase_feed_api'),
+                                           dict(query, cursor=cursor) if cursor else query)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual([p["quantity"] for p in response.data["results"]], expected_quantities)
+            self.assertEqual(response.data["next"] is not None, len(expected_quantities) == 3)
+            ids.extend(p["id"] for p in response.data["results"])
+            cursor = response.data["cursor"]
+        self.assertEqual(len(set(ids)), 7)
+
+        # new purchases are returned with the last cursor
+        with mock.patch("django.utils.timezone.now", return_value=now + datetime.timedelta(minutes=6)):
+            Purchase.objects.create(user=self.u1, quantity=8, **self.prod_data)
+        response = self.client.get(reverse('main_purchase_feed_api'), dict(query, cursor=cursor))
+        self.assertEqual([p["quantity"] for p in response.data["results"]], [8])
+
+        response = self.client.get(reverse('main_purchase_feed_api'),
+                                   {"until": now.isoformat(), "invoice": "false"})
+        self.assertEqual(len(response.data["results"]), 2)
+        response = self.client.get(reverse('main_purchase_feed_api'), {"category": "cat", "limit": 100})
+        self.assertEqual(len(response.data["results"]), 8)
+
+    def test_invalid_purchase_feed(self):
+        for query in ({"cursor": "invalid"}, {"limit": 0}, {"since": "yesterday"}):
+            response = self.client.get(reverse('main_purchase_feed_api'), query)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_conditional_get(self):
+        cache.clear()
+        for url_name in ('main_user_api', 'main_product_api'):
+            # products are fetched with their categories
+            with self.assertNumQueries(1):
+                response = self.client.get(reverse(url_name))
+            etag = response["ETag"]
+            self.assertNotIn("Last-Modified", response)
+
+            with self.assertNumQueries(0):
+                response = self.client.get(reverse(url_name), HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            # only the ETag decides, the data may have changed in the same second
+            response = self.client.get(reverse(url_name), HTTP_IF_MODIFIED_SINCE="Fri, 01 Jan 2100 00:00:00 GMT")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.get(reverse(url_name), HTTP_IF_NONE_MATCH='"outdated"')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response["ETag"], etag)
+
+        def get_etag(url_name):
+            return self.client.get(reverse(url_name))["ETag"]
+
+        etags = {url_name: get_etag(url_name) for url_name in ('main_user_api', 'main_product_api')}
+        self.u1.display_name = "renamed"
+        self.u1.save()
+        self.assertNotEqual(get_etag('main_user_api'), etags['main_user_api'])
+        self.assertEqual(self.client.get(reverse('main_user_api')).data, UserSerializer(User.objects.all(), many=True).data)
+
+        self.assertEqual(get_etag('main_product_api'), etags['main_product_api'])
+        category = self.prod1.category
+        category.name = "Drinks"
+        category.save()
+        response = self.client.get(reverse('main_product_api'))
+        self.assertNotEqual(response["ETag"], etags['main_product_api'])
+        self.assertEqual(response.data[0]["category"], "Drinks")
+
+    def get_events(self, **params):
+        response = self.client.get(reverse('main_event_api'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_events(self):
+        with mock.patch("django.utils.timezone.now", return_value=timezone.now() - datetime.timedelta(hours=2)):
+            Purchase.objects.create(user=self.u1, quantity=1, **self.prod_data)
+        last_id = self.get_events()["last_id"]
+        self.assertEqual(last_id, Event.objects.last_id())
+        # old events are deleted whenever a client starts
+        self.assertFalse(Event.objects.filter(created_date__lt=timezone.now() - Event.objects.MAX_AGE).exists())
+
+        Purchase.objects.create(user=self.u1, quantity=2, **self.prod_data)
+        free_item = FreeItem.objects.create(product=self.prod1, giver=self.u1, leftover_quantity=3)
+        FreeItem.objects.take(free_item, 2)
+        StatsDisplay.objects.create(title="Drinker", row_string="drinks by")
+
+        data = self.get_events(after=last_id, timeout=0)
+        self.assertEqual([e["kind"] for e in data["events"]], ["purchase", "free_item", "free_item", "stats"])
+        self.assertEqual(data["events"][0]["data"]["user"], "user1")
+        self.assertEqual(data["events"][0]["data"]["quantity"], 2)
+        self.assertEqual(data["events"][2]["data"]["leftover_quantity"], 1)
+        self.assertIn("stats_elements", data)
+        self.assertEqual(data["last_id"], data["events"][-1]["id"])
+
+        data = self.get_events(after=data["last_id"], timeout=0)
+        self.assertEqual(data["events"], [])
+        self.assertNotIn("stats_elements", data)
+
+    def test_events_long_polling(self):
+        last_id = self.get_events()["last_id"]
+
+        def purchase():
+            time.sleep(0.5)
+            Purchase.objects.create(user=self.u1, quantity=1, **self.prod_data)
+            connection.close()
+
+        thread = threading.Thread(target=purchase)
+        thread.start()
+        start = time.monotonic()
+        with mock.patch.object(PybarsysPreferences.Misc, "EVENTS_LONG_POLL_TIMEOUT", 10):
+            data = self.get_events(after=last_id, timeout=10)
+        thread.join()
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual([e["kind"] for e in data["events"]], ["purchase"])
+
+    def test_events_long_polling_disabled(self):
+        last_id = self.get_events()["last_id"]
+        start = time.monotonic()
+        data = self.get_events(after=last_id, timeout=10)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(data, {"events": [], "last_id": last_id})
+
+    def test_events_rolled_back(self):
+        last_id = Event.objects.last_id()
+        try:
+            with transaction.atomic():
+                Purchase.objects.create(user=self.u1, quantity=1, **self.prod_data)
+                raise IntegrityError
+        except IntegrityError:
+            pass
+        self.assertEqual(Event.objects.last_id(), last_id)
+
+    def test_invalid_events(self):
+        response = self.client.get(reverse('main_event_api'), {"after": "x"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_kiosk_snapshot(self):
+        u2 = User.objects.get(display_name="user2")
+        User.objects.filter(pk=u2.pk).update(is_autolocked=True)
+        free_item = FreeItem.objects.create(product=self.prod1, giver=self.u1, leftover_quantity=3)
+
+        response = self.client.get(reverse('main_kiosk_api'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        snapshot = response.data
+        # user3's purchases are paid by user2
+        self.assertEqual({u["display_name"]: u["is_autolocked"] for u in snapshot["users"]},
+                         {"user1": False, "user2": True, "user3": True, "user4": False})
+        self.assertEqual([c["name"] for c in snapshot["categories"]], ["Softdrinks"])
+        self.assertEqual([p["name"] for p in snapshot["categories"][0]["products"]], ["Club-Mate", "Cola", "OJ"])
+        self.assertEqual(snapshot["free_items"][0]["id"], "free_item_{}".format(free_item.pk))
+
+        # the snapshot changes when free items are taken, also by purchases of the kiosk itself
+        etag = response["ETag"]
+        self.assertEqual(self.client.get(reverse('main_kiosk_api'), HTTP_IF_NONE_MATCH=etag).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+        self.post_bulk([{"user_id": self.u1.pk, "quantity": 2, "product_id": snapshot["free_items"][0]["id"],
+                         "idempotency_key": "kiosk-1"}])
+        response = self.client.get(reverse('main_kiosk_api'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["free_items"][0]["leftover_quantity"], 1)
+
+    def test_kiosk_snapshot_autolock(self):
+        etag = self.client.get(reverse('main_kiosk_api'))["ETag"]
+        with mock.patch.object(PybarsysPreferences.Misc, "BALANCE_BELOW_AUTOLOCK", Decimal('100')):
+            view_helpers.create_invoices(mock.Mock(), [self.u1], send_invoices=False,
+                                         autolock_accounts=True)
+        response = self.client.get(reverse('main_kiosk_api'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue([u for u in response.data["users"] if u["id"] == self.u1.pk][0]["is_autolocked"])
+
+    def test_kiosk_page(self):
+        # the page itself does not depend on the database, users and products are loaded from the snapshot
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('main_kiosk'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("csrftoken", response.cookies)
@@ -1,6 +1,27 @@
-from django.test import TransactionTestCase
+import csv
+import tempfile
+import threading
+from io import StringIO
+from unittest import mock, skipUnless
+
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
 from barsys.models import *
+from barsys import view_helpers
+from barsys.jobs import JobReporter
+from barsys.forms import SingleUserSinglePurchaseForm
+from barsys.management.commands.benchmark_currency import currency_uncached
+from barsys.templatetags.barsys_helpers import currency
+from barsys.view_helpers import get_renderable_stats_elements
+from barsys.views import purchase_free_item, purchase_no_free_item
+from pybarsys.settings import PybarsysPreferences
 
 
 class InvoiceTestCase(TransactionTestCase):
@@ -158,6 +179,31 @@ class InvoiceTestCase(TransactionTestCase):
         self.assertEqual(u2.account_balance(), 2 * bal + Decimal('10'))
         self.assertEqual(u3.account_balance(), Decimal('0'))
 
+    def test_other_purchases_grouped(self):
+        u2 = User.objects.get(display_name="user2")
+        u3 = User.objects.get(display_name="user3")
+        u4 = User.objects.get(display_name="user4")
+        u4.purchases_paid_by_other = u2
+        u4.save()
+
+        for i in range(1, 4):
+            for u in u2, u3, u4:
+                Purchase(user=u, quantity=i, **self.prod_data).save()
+        invoice = Invoice.objects.create_for_user(u2)
+
+        with self.assertNumQueries(1):
+            grouped = invoice.other_purchases_grouped()
+        self.assertEqual([u for u, purchases in grouped], [u3, u4])
+        self.assertEqual([len(purchases) for u, purchases in grouped], [3, 3])
+        self.assertEqual(grouped[0][1].sum_cost(), Decimal('6'))
+        self.assertEqual(grouped[0][1].sum_quantity(), 6)
+
+        # invoiced purchases cannot change, so the result is cached on the invoice
+        with self.assertNumQueries(0):
+            self.assertEqual(invoice.other_purchases_grouped(), grouped)
+        with self.assertNumQueries(1):
+            invoice.other_purchases_grouped(use_cache=False)
+
     def test_switch_user_to_dependant(self):
         u1 = User.objects.get(display_name="user1")
         u4 = User.objects.get(display_name="user4")
@@ -242,6 +288,108 @@ class InvoiceTestCase(TransactionTestCase):
             u4.purchases_paid_by_other = u4
             u4.save()
 
+    def test_stored_balance(self):
+        u1 = User.objects.get(display_name="user1")
+        u2 = User.objects.get(display_name="user2")
+
+        for i in range(1, 4):
+            Purchase(user=u1, quantity=i, **self.prod_data).save()
+        Payment.objects.create(user=u1, amount=Decimal('2.5'))
+
+        # stale instance must not overwrite the balance when saved
+        u1_stale = User.objects.get(pk=u1.pk)
+
+        i1 = Invoice.objects.create_for_user(u1)
+        self.assertEqual(u1.account_balance(), Decimal('-3.5'))
+        self.assertEqual(User.objects.get(pk=u1.pk).account_balance(), Decimal('-3.5'))
+
+        u1_stale.is_favorite = True
+        u1_stale.save()
+        self.assertEqual(User.objects.get(pk=u1.pk).account_balance(), Decimal('-3.5'))
+
+        i1.delete()
+        self.assertEqual(User.objects.get(pk=u1.pk).account_balance(), Decimal('0'))
+
+        Invoice.objects.create_for_user(u1)
+        self.assertEqual(u1.account_balance(), u1.calculate_account_balance())
+
+        # corrupt stored balances and let them be rebuilt from the invoices
+        User.objects.update(balance=Decimal('42'))
+        with self.assertRaises(CommandError):
+            call_command("rebuild_account_balances", "--verify-only", stdout=StringIO())
+        call_command("rebuild_account_balances", stdout=StringIO())
+        call_command("rebuild_account_balances", "--verify-only", stdout=StringIO())
+
+        self.assertEqual(User.objects.get(pk=u1.pk).account_balance(), Decimal('-3.5'))
+        self.assertEqual(User.objects.get(pk=u2.pk).account_balance(), Decimal('0'))
+
+    def test_with_financials(self):
+        u1 = User.objects.get(display_name="user1")
+        u2 = User.objects.get(display_name="user2")
+        u3 = User.objects.get(display_name="user3")
+
+        for i in range(1, 4):
+            Purchase(user=u1, quantity=i, **self.prod_data).save()
+            Purchase(user=u3, quantity=i, **self.prod_data).save()
+        Payment.objects.create(user=u1, amount=Decimal('2.5'))
+        Payment.objects.create(user=u1, amount=Decimal('1'))
+        Invoice.objects.create_for_user(u2)
+        Purchase(user=u1, quantity=2, **self.prod_data).save()
+
+        with self.assertNumQueries(1):
+            users = {u.pk: u for u in User.objects.with_financials()}
+
+        for u in u1, u2, u3:
+            self.assertEqual(users[u.pk].unbilled_purchases_cost, u.purchases().unbilled().sum_cost())
+            self.assertEqual(users[u.pk].unbilled_payments_amount, u.payments().unbilled().sum_amount())
+            self.assertEqual(users[u.pk].account_balance(), u.calculate_account_balance())
+
+        self.assertEqual(users[u1.pk].unbilled_purchases_cost, Decimal('8'))
+        self.assertEqual(users[u1.pk].unbilled_payments_amount, Decimal('3.5'))
+        self.assertEqual(users[u2.pk].account_balance(), Decimal('-6'))
+
+    def test_bulk_invoicing(self):
+        u1 = User.objects.get(display_name="user1")
+        u2 = User.objects.get(display_name="user2")
+        u3 = User.objects.get(display_name="user3")
+        u4 = User.objects.get(display_name="user4")
+
+        for i in range(1, 10):
+            for u in u1, u2, u3:
+                Purchase(user=u, quantity=i, **self.prod_data).save()
+        Payment.objects.create(user=u1, amount=Decimal('10'))
+        Payment.objects.create(user=u2, amount=Decimal('-2.5'))
+
+        with self.assertRaises(IntegrityError):
+            Invoice.objects.create_for_users([u1, u3])
+
+        users = list(User.objects.active().pay_themselves())
+        # without bulk inserts returning IDs (e.g. SQLite), each invoice is inserted separately
+        num_inserts = 1 if connection.features.can_return_ids_from_bulk_insert else 2
+        with self.assertNumQueries(9 + num_inserts):
+            invoices = Invoice.objects.create_for_users(users, comment="bulk")
+
+        # u4 has nothing to pay
+        self.assertEqual([i.recipient for i in invoices], [u1, u2])
+        i1, i2 = Invoice.objects.filter(pk__in=[i.pk for i in invoices]).order_by("recipient__display_name")
+
+        self.assertEqual(i1.amount_purchases, Decimal('45'))
+        self.assertEqual(i1.amount_payments, Decimal('10'))
+        self.assertEqual(i2.amount_purchases, Decimal('90'))
+        self.assertEqual(i2.amount_payments, Decimal('-2.5'))
+        self.assertEqual(i2.comment, "bulk")
+        self.assertEqual(i2.other_purchases().count(), 9)
+        self.assertFalse(Purchase.objects.unbilled().exists())
+        self.assertFalse(Payment.objects.unbilled().exists())
+
+        for u in u1, u2, u3, u4:
+            u.refresh_from_db()
+            self.assertEqual(u.account_balance(), u.calculate_account_balance())
+        self.assertEqual(u1.account_balance(), Decimal('-35'))
+        self.assertEqual(u2.account_balance(), Decimal('-92.5'))
+
+        self.assertEqual(Invoice.objects.create_for_users(users), [])
+
     def test_switch_user_to_dependant2(self):
         u1 = User.objects.get(display_name="user1")
         u4 = User.objects.get(display_name="user4")
@@ -343,3 +491,642 @@ class ProductAutochangeSetTestCase(TransactionTestCase):
         self.assertEqual(prod2.is_bold, True)
         self.assertEqual(prod3.is_bold, False)
         self.assertEqual(prod4.is_bold, True)
+
+
+class ExportTestCase(TransactionTestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin@example.com", "admin", "password")
+        self.u1 = User.objects.create_user("user1@example.com", "user1")
+        u2 = User.objects.create_user("user2@example.com", "user2")
+
+        prod_data = dict(product_category="cat", product_name="prod", product_price=Decimal('1'),
+                         product_amount="1 l")
+        for i in range(1, 6):
+            Purchase.objects.create(user=self.u1, quantity=i, **prod_data)
+            Purchase.objects.create(user=u2, quantity=i, **prod_data)
+        Payment.objects.create(user=self.u1, amount=Decimal('3'))
+
+        self.client.force_login(self.admin)
+
+    def get_csv_rows(self, url_name, query=None):
+        response = self.client.get(reverse(url_name), query or {})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        content = b"".join(response.streaming_content).decode()
+        return list(csv.reader(content.splitlines()))
+
+    def test_user_export(self):
+        rows = self.get_csv_rows("admin_user_export")
+        self.assertEqual(rows[0][0], "display_name")
+        self.assertEqual(len(rows), 1 + User.objects.count())
+        user1_row = [r for r in rows if r[0] == "user1"][0]
+        self.assertEqual([Decimal(v) for v in user1_row[4:]], [Decimal("15"), Decimal("3")])
+
+    def test_payment_export(self):
+        rows = self.get_csv_rows("admin_payment_export")
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][2], "user1@example.com")
+
+    def test_purchase_export(self):
+        rows = self.get_csv_rows("admin_purchase_export")
+        self.assertEqual(len(rows), 1 + Purchase.objects.count())
+
+        rows = self.get_csv_rows("admin_purchase_export", {"user": self.u1.pk})
+        self.assertEqual(len(rows), 1 + self.u1.purchases().count())
+        self.assertEqual(sum(Decimal(r[8]) for r in rows[1:]), self.u1.purchases().sum_cost())
+
+
+class JobTestCase(TransactionTestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin@example.com", "admin", "password")
+        self.u1 = User.objects.create_user("user1@example.com", "user1")
+        self.u2 = User.objects.create_user("user2@example.com", "user2")
+        u3 = User.objects.create_user("user3@example.com", "user3")
+        u3.purchases_paid_by_other = self.u2
+        u3.save()
+
+        prod_data = dict(product_category="cat", product_name="prod", product_price=Decimal('1'),
+                         product_amount="1 l")
+        Purchase.objects.create(user=self.u1, quantity=2, **prod_data)
+        Purchase.objects.create(user=u3, quantity=3, **prod_data)
+
+        self.client.force_login(self.admin)
+
+    def test_claim_next(self):
+        job1 = Job.objects.enqueue(Job.KIND_SEND_REMINDER_MAILS, user_ids=[])
+        job2 = Job.objects.enqueue(Job.KIND_SEND_REMINDER_MAILS, user_ids=[])
+
+        self.assertEqual(Job.objects.claim_next(), job1)
+        self.assertEqual(Job.objects.claim_next(), job2)
+        self.assertIsNone(Job.objects.claim_next())
+        self.assertEqual(Job.objects.filter(status=Job.STATUS_RUNNING).count(), 2)
+
+    def test_create_invoices_job(self):
+        with mock.patch.object(PybarsysPreferences.Misc, "BACKGROUND_JOBS", True):
+            response = self.client.post(reverse("admin_invoice_new"), {
+                "users": [self.u1.pk, self.u2.pk], "send_invoices": "on", "send_dependant_notifications": "on",
+                "comment": "job test"})
+        job = Job.objects.get()
+        self.assertRedirects(response, job.get_absolute_url())
+        # nothing happens until the worker runs
+        self.assertEqual(Invoice.objects.count(), 0)
+        self.assertEqual(len(mail.outbox), 0)
+
+        call_command("run_jobs", "--once", stdout=StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_DONE, job.log)
+        self.assertEqual(Invoice.objects.count(), 2)
+        self.assertEqual(self.u2.invoices().get().amount_purchases, Decimal('3'))
+        # 2 invoices + 1 dependant notification
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual((job.num_done, job.num_total), (2, 2))
+        self.assertEqual(job.results.filter(success=True).count(), 3)
+        self.assertIn("Created 2 invoice(s)", job.log)
+
+        response = self.client.get(job.get_absolute_url())
+        self.assertContains(response, "user3")
+
+    def test_interrupted_job(self):
+        job = Job.objects.enqueue(Job.KIND_SEND_REMINDER_MAILS, user_ids=[self.u1.pk])
+        job = Job.objects.claim_next()
+        self.assertFalse(job.is_interrupted())
+
+        # the worker was killed a while ago
+        Job.objects.filter(pk=job.pk).update(heartbeat_date=timezone.now() - Job.HEARTBEAT_TIMEOUT * 2)
+        job.refresh_from_db()
+        self.assertTrue(job.is_interrupted())
+        self.assertContains(self.client.get(reverse("admin_job_list")), "Interrupted")
+        self.assertContains(self.client.get(job.get_absolute_url()), "Interrupted")
+
+        # not run again
+        call_command("run_jobs", "--once", stdout=StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_RUNNING)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_heartbeat(self):
+        job = Job.objects.enqueue(Job.KIND_SEND_REMINDER_MAILS, user_ids=[self.u1.pk])
+        job = Job.objects.claim_next()
+        Job.objects.filter(pk=job.pk).update(heartbeat_date=None)
+        JobReporter(job).step_done()
+        job.refresh_from_db()
+        self.assertIsNotNone(job.heartbeat_date)
+        self.assertFalse(job.is_interrupted())
+
+    def test_failed_job(self):
+        job = Job.objects.enqueue(Job.KIND_SEND_INVOICE_MAILS, unknown_parameter=True)
+        call_command("run_jobs", "--once", stdout=StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_FAILED)
+        self.assertIn("unknown_parameter", job.log)
+        self.assertIsNotNone(job.finished_date)
+
+
+class StatsDisplayCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.u1 = User.objects.create_user("user1@example.com", "user1")
+        self.u2 = User.objects.create_user("user2@example.com", "user2")
+        self.prod_data = dict(product_category="cat", product_name="prod", product_price=Decimal('1'),
+                              product_amount="1 l")
+
+        self.sd1 = StatsDisplay.objects.create(title="Drinker", row_string="drinks by", show_by_default=True)
+        self.sd2 = StatsDisplay.objects.create(title="Spender", sort_by_and_show=StatsDisplay.SORT_BY_TOTAL_COST_SHOW_RANK,
+                                               time_period_method=StatsDisplay.FIXED_DURATION)
+
+    def get_rows(self, stats_elements):
+        return {e["title"]: [(r["left"], r["user_name"]) for r in e["rows"]] for e in stats_elements}
+
+    def check_cache(self):
+        Purchase.objects.create(user=self.u1, quantity=2, **self.prod_data)
+        stats_elements = get_renderable_stats_elements()
+        self.assertEqual(self.get_rows(stats_elements), {"Drinker": [("2x", "user1")], "Spender": [("1.", "user1")]})
+        self.assertEqual([e["toggle_other_on"] for e in stats_elements], ["stats_{}".format(self.sd2.pk),
+                                                                          "stats_{}".format(self.sd1.pk)])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_renderable_stats_elements(), stats_elements)
+
+        # new purchases and changed StatsDisplays invalidate the cache
+        Purchase.objects.create(user=self.u2, quantity=3, **self.prod_data)
+        self.assertEqual(self.get_rows(get_renderable_stats_elements())["Drinker"], [("3x", "user2"), ("2x", "user1")])
+
+        self.sd1.filter_by_category.add(Category.objects.create(name="other"))
+        self.assertEqual(self.get_rows(get_renderable_stats_elements())["Drinker"], [])
+
+    def test_locmem_cache(self):
+        self.check_cache()
+
+    def test_invalidate_after_commit(self):
+        stats_elements = get_renderable_stats_elements()
+        purchase_menu = view_helpers.get_purchase_menu()
+        with transaction.atomic():
+            Purchase.objects.create(user=self.u1, quantity=2, **self.prod_data)
+            FreeItem.objects.create(giver=self.u1, leftover_quantity=1, product=Product.objects.create(
+                name="Beer", price=Decimal('1'), amount="0.5 l", category=Category.objects.create(name="drinks")))
+            # other requests which read the data before the commit do not cache it under the new version
+            self.assertEqual(get_renderable_stats_elements(), stats_elements)
+            self.assertEqual(view_helpers.get_purchase_menu(), purchase_menu)
+        self.assertEqual(self.get_rows(get_renderable_stats_elements())["Drinker"], [("2x", "user1")])
+        self.assertEqual(len(view_helpers.get_purchase_menu()["free_items"]), 1)
+
+    def test_file_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                                                       "LOCATION": cache_dir}}):
+                self.check_cache()
+
+    def test_timeout(self):
+        # the cache expires when the time period of a StatsDisplay starts again
+        with mock.patch("barsys.view_helpers.cache.set") as cache_set:
+            get_renderable_stats_elements()
+        timeout = cache_set.call_args[0][2]
+        self.assertLessEqual(timeout, (self.sd1.next_time_period_change() - timezone.now()).total_seconds())
+        self.assertLessEqual(timeout, PybarsysPreferences.Misc.STATSDISPLAY_CACHE_TIMEOUT)
+
+        now = localtime(timezone.now())
+        next_monday = self.sd1.next_time_period_change()
+        self.assertEqual(next_monday.weekday(), 0)
+        self.assertEqual(localtime(next_monday).time(), datetime.time())
+        self.assertLess(now, next_monday)
+        self.assertIsNone(self.sd2.next_time_period_change())
+
+
+class PurchaseBucketTestCase(TransactionTestCase):
+    def setUp(self):
+        self.u1 = User.objects.create_user("user1@example.com", "user1")
+        self.u2 = User.objects.create_user("user2@example.com", "user2")
+        self.now = timezone.now()
+
+        self.purchases = []
+        for minutes_ago, user, quantity, name, price in ((200, self.u1, 5, "Cola", '1.00'),
+                                                          (140, self.u2, 1, "Beer", '2.50'),
+                                                          (130, self.u1, 1, "Beer", '2.50'),
+                                                          (120, self.u2, 2, "Cola", '1.00'),
+                                                          (10, self.u2, 1, "Cola", '1.00')):
+            with mock.patch("django.utils.timezone.now", return_value=self.now - datetime.timedelta(minutes=minutes_ago)):
+                self.purchases.append(Purchase.objects.create(
+                    user=user, quantity=quantity, product_category="drinks", product_name=name,
+                    product_price=Decimal(price), product_amount="0.5 l"))
+
+    def check_stats(self):
+        for minutes_ago in (30, 135, 150, 300):
+            since = self.now - datetime.timedelta(minutes=minutes_ago)
+            purchases = Purchase.objects.filter(created_date__gte=since)
+            self.assertEqual(PurchaseBucket.objects.stats_by_user(since),
+                             [tuple(u) for u in purchases.stats_purchases_by_user()])
+            self.assertEqual(PurchaseBucket.objects.stats_by_user(since, by_cost=True),
+                             [tuple(u) for u in purchases.stats_cost_by_user()])
+            self.assertEqual(PurchaseBucket.objects.stats_by_user(since, products=["Beer"], limit=1),
+                             [tuple(u) for u in purchases.filter(product_name="Beer").stats_purchases_by_user(limit=1)])
+
+        # whole hours
+        since = get_bucket_hour(self.now) - datetime.timedelta(hours=3)
+        with self.assertNumQueries(2):
+            PurchaseBucket.objects.stats_by_user(since)
+
+    def test_buckets(self):
+        self.check_stats()
+
+        purchase = self.purchases[1]
+        purchase.quantity = 3
+        purchase.user = self.u1
+        purchase.save()
+        self.purchases[0].delete()
+        self.check_stats()
+
+        buckets = set(PurchaseBucket.objects.filter(quantity__gt=0).values_list(
+            "user_id", "product_name", "hour", "quantity", "cost"))
+        call_command("rebuild_purchase_buckets", stdout=StringIO())
+        self.assertEqual(set(PurchaseBucket.objects.values_list("user_id", "product_name", "hour", "quantity", "cost")),
+                         buckets)
+        self.check_stats()
+
+
+class MostBoughtProductTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.u1 = User.objects.create_user("user1@example.com", "user1")
+        self.u2 = User.objects.create_user("user2@example.com", "user2")
+        self.u3 = User.objects.create_user("user3@example.com", "user3")
+        cat = Category.objects.create(name="drinks")
+        self.cola = Product.objects.create(name="Cola", price=Decimal('1.00'), amount="0.5 l", category=cat)
+        self.beer = Product.objects.create(name="Beer", price=Decimal('2.50'), amount="0.5 l", category=cat)
+
+    def buy(self, user, product, quantity=1):
+        return Purchase.objects.create(user=user, quantity=quantity, product_category=product.category.name,
+                                       product_name=product.name, product_price=product.price,
+                                       product_amount=product.amount)
+
+    def assertMostBought(self, users, product):
+        most_bought_product = view_helpers.get_most_bought_product_for_users(users)
+        self.assertEqual((most_bought_product["product_name"], most_bought_product["product_amount"]),
+                         (product.name, product.amount))
+
+    def test_most_bought_product(self):
+        self.buy(self.u1, self.cola)
+        self.buy(self.u1, self.cola, quantity=3)
+        purchase = self.buy(self.u1, self.beer)
+        self.buy(self.u2, self.beer)
+        self.buy(self.u2, self.beer)
+
+        with self.assertNumQueries(1):
+            self.assertMostBought([self.u1], self.cola)
+        self.assertMostBought([self.u1, self.u2], self.beer)
+
+        # counted incrementally
+        purchase.quantity = 2
+        purchase.save()
+        self.assertMostBought([self.u1], self.cola)
+        self.buy(self.u1, self.beer)
+        self.buy(self.u1, self.beer)
+        self.assertMostBought([self.u1], self.beer)
+        purchase.delete()
+        self.assertEqual(UserProductCount.objects.get(user=self.u1, product_name="Beer").num_purchases, 2)
+
+        # only products that can still be bought
+        self.cola.is_active = False
+        self.cola.save()
+        self.assertMostBought([self.u1], self.beer)
+
+        counts = set(UserProductCount.objects.filter(num_purchases__gt=0).values_list(
+            "user_id", "product_name", "product_amount", "num_purchases"))
+        call_command("rebuild_purchase_buckets", stdout=StringIO())
+        self.assertEqual(set(UserProductCount.objects.values_list(
+            "user_id", "product_name", "product_amount", "num_purchases")), counts)
+
+    def test_recent_most_bought_product(self):
+        self.assertEqual(view_helpers.get_most_bought_product_for_user(self.u3),
+                         {"product_name": "", "product_amount": ""})
+        cache.clear()
+
+        self.buy(self.u1, self.cola)
+        self.buy(self.u2, self.beer)
+        self.buy(self.u2, self.beer)
+        self.assertMostBought([self.u3], self.beer)
+        # the same for all users without purchases for a while
+        with self.assertNumQueries(1):
+            self.assertMostBought([self.u3], self.beer)
+
+
+class PurchaseMenuTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("user1@example.com", "user1")
+        self.drinks = Category.objects.create(name="drinks")
+        self.snacks = Category.objects.create(name="snacks")
+        Category.objects.create(name="empty")
+        self.cola = Product.objects.create(name="Cola", price=Decimal('1.00'), amount="0.5 l", category=self.drinks)
+        self.beer = Product.objects.create(name="Beer", price=Decimal('2.50'), amount="0.5 l", category=self.drinks,
+                                           is_bold=True)
+        self.chips = Product.objects.create(name="Chips", price=Decimal('1.50'), amount="1 bag", category=self.snacks)
+        self.free_item = FreeItem.objects.create(giver=self.user, product=self.beer, leftover_quantity=2)
+
+    def get_menu(self):
+        menu = view_helpers.get_purchase_menu()
+        return ([(c.name, [p.name for p in products]) for c, products in menu["categories"]],
+                [(f.product.name, f.leftover_quantity) for f in menu["free_items"]])
+
+    def test_cache(self):
+        self.assertEqual(self.get_menu(), ([("drinks", ["Beer", "Cola"]), ("snacks", ["Chips"])], [("Beer", 2)]))
+        with self.assertNumQueries(0):
+            menu = view_helpers.get_purchase_menu()
+            self.assertEqual(menu["free_items"][0].verbose_str(), "Free Beer (giver: user1, 2 item(s) leftover)")
+
+        self.chips.is_active = False
+        self.chips.save()
+        self.assertEqual(self.get_menu()[0], [("drinks", ["Beer", "Cola"])])
+
+        self.client.post(reverse("main_user_purchase", args=[self.user.pk]), {
+            "user_id": self.user.pk, "product_id": "free_item_{}".format(self.free_item.pk), "quantity": 2})
+        self.assertEqual(self.get_menu()[1], [])
+
+        pacs = ProductAutochangeSet.objects.create(title="Happy hour",
+                                                   change_others_active=ProductAutochange.CHANGE_TO_YES)
+        pacs.execute()
+        self.assertEqual(self.get_menu()[0], [("drinks", ["Beer", "Cola"]), ("snacks", ["Chips"])])
+
+        self.drinks.name = "beverages"
+        self.drinks.save()
+        self.assertEqual(self.get_menu()[0][0][0], "beverages")
+
+    def test_purchase_pages(self):
+        u2 = User.objects.create_user("user2@example.com", "user2")
+        urls = (reverse("main_user_purchase", args=[self.user.pk]),
+                reverse("main_user_purchase_multibuy", args=["{}/{}".format(self.user.pk, u2.pk)]))
+        for url in urls:
+            response = self.client.get(url)
+            self.assertContains(response, "Chips")
+            self.assertContains(response, "2 left")
+
+        # the number of queries does not depend on the number of products
+        num_queries = []
+        for i in range(2):
+            cache.clear()
+            for url in urls:
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertEqual(self.client.get(url).status_code, 200)
+                num_queries.append(len(queries))
+            category = Category.objects.create(name="more {}".format(i))
+            for j in range(3):
+                product = Product.objects.create(name="Product {}{}".format(i, j), price=Decimal('1'), amount="1",
+                                                 category=category)
+                FreeItem.objects.create(giver=u2, product=product, leftover_quantity=1)
+        self.assertEqual(num_queries[:2], num_queries[2:])
+
+
+class MultiBuyTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = [User.objects.create_user("user{}@example.com".format(i), "user{}".format(i)) for i in range(3)]
+        self.cat = Category.objects.create(name="drinks")
+        self.beer = Product.objects.create(name="Beer", price=Decimal('2.50'), amount="0.5 l", category=self.cat)
+        self.free_item = FreeItem.objects.create(giver=self.users[0], product=self.beer, leftover_quantity=5)
+
+    def purchase(self, users, product_id, quantity):
+        user_pkey_str = "/".join(str(u.pk) for u in users)
+        return self.client.post(reverse("main_user_purchase_multibuy", args=[user_pkey_str]), {
+            "product_id": product_id, "quantity": quantity, "comment": "Round"})
+
+    def test_create_many_from_product(self):
+        purchases = Purchase.objects.create_many_from_product(self.beer, self.users, 2, comment="Round")
+        self.assertEqual([(p.pk, p.user) for p in purchases],
+                         [(p.pk, p.user) for p in Purchase.objects.order_by("pk")])
+        self.assertEqual([p.user for p in purchases], self.users)
+        self.assertEqual([e.get_data()["id"] for e in Event.objects.filter(kind=Event.KIND_PURCHASE)],
+                         [p.pk for p in purchases])
+        self.assertEqual(Purchase.objects.filter(product_name="Beer", quantity=2, comment="Round").count(), 3)
+        self.assertEqual(PurchaseBucket.objects.stats_by_user(timezone.now() - datetime.timedelta(hours=1)),
+                         [(u.pk, u.display_name, 2) for u in self.users])
+        self.assertEqual(UserProductCount.objects.filter(product_name="Beer", num_purchases=1).count(), 3)
+
+        with self.assertRaises(ValidationError):
+            Purchase.objects.create_many_from_product(self.beer, self.users, 2, comment="x" * 51)
+        with self.assertRaises(IntegrityError):
+            Purchase.objects.create_many_from_product(self.beer, self.users, 2, free_item=self.free_item)
+        self.assertEqual(Purchase.objects.count(), 3)
+        self.assertEqual(FreeItem.objects.get().leftover_quantity, 5)
+
+    def test_multibuy(self):
+        self.purchase(self.users, self.beer.pk, 2)
+        self.assertEqual(sorted(Purchase.objects.values_list("user_id", "quantity", "product_price", "comment")),
+                         [(u.pk, 2, Decimal('2.50'), "Round") for u in self.users])
+
+        self.purchase(self.users[:2], "free_item_{}".format(self.free_item.pk), 2)
+        self.assertEqual(FreeItem.objects.get().leftover_quantity, 1)
+        free_purchases = Purchase.objects.filter(is_free_item_purchase=True)
+        self.assertEqual(sorted(free_purchases.values_list("user_id", "product_price", "comment")),
+                         [(u.pk, Decimal('0'), "Round (free)") for u in self.users[:2]])
+        self.assertEqual(free_purchases[0].free_item_description, "Free Beer (giver: user0, 1 item(s) leftover)")
+        self.assertEqual(view_helpers.get_purchase_menu()["free_items"][0].leftover_quantity, 1)
+
+        # not enough free items left
+        self.purchase(self.users[:2], "free_item_{}".format(self.free_item.pk), 1)
+        self.assertEqual(FreeItem.objects.get().leftover_quantity, 1)
+
+        # the number of queries does not depend on the number of users
+        more_users = [User.objects.create_user("more{}@example.com".format(i), "more{}".format(i)) for i in range(10)]
+        with CaptureQueriesContext(connection) as few_queries:
+            self.purchase(self.users, self.beer.pk, 1)
+        with CaptureQueriesContext(connection) as many_queries:
+            self.purchase(self.users + more_users, self.beer.pk, 1)
+        self.assertEqual(Purchase.objects.filter(quantity=1).count(), 16)
+        self.assertEqual(UserProductCount.objects.get(user=self.users[0]).num_purchases, 4)
+        # only the rows for the first purchases of the new users in PurchaseBucket and UserProductCount are added
+        self.assertEqual(len(many_queries), len(few_queries) + 2)
+
+
+class FreeItemConcurrencyTestCase(TransactionTestCase):
+    NUM_THREADS = 8
+
+    def setUp(self):
+        cache.clear()
+        self.users = [User.objects.create_user("user{}@example.com".format(i), "user{}".format(i))
+                      for i in range(self.NUM_THREADS)]
+        cat = Category.objects.create(name="drinks")
+        self.beer = Product.objects.create(name="Beer", price=Decimal('2.50'), amount="0.5 l", category=cat)
+        self.free_item = FreeItem.objects.create(giver=self.users[0], product=self.beer, leftover_quantity=5)
+
+    def test_take(self):
+        FreeItem.objects.take(self.free_item, 2)
+        self.assertEqual(self.free_item.leftover_quantity, 3)
+        with self.assertRaisesMessage(FreeItemSoldOut, "There are only 3 free items left, so you cannot purchase 4!"):
+            FreeItem.objects.take(self.free_item, 4)
+        self.assertEqual(FreeItem.objects.get().leftover_quantity, 3)
+
+    def test_sold_out(self):
+        form_data = {"user_id": self.users[0].pk, "product_id": "free_item_{}".format(self.free_item.pk),
+                     "quantity": 4}
+        url = reverse("main_user_purchase", args=[self.users[0].pk])
+        # someone else takes items after the form was validated
+        with mock.patch.object(SingleUserSinglePurchaseForm, "clean", autospec=True,
+                               side_effect=lambda form: FreeItem.objects.take(self.free_item, 2)):
+            response = self.client.post(url, form_data, follow=True)
+        self.assertContains(response, "Sold out: There are only 3 free items left, so you cannot purchase 4!")
+        self.assertEqual(FreeItem.objects.get().leftover_quantity, 3)
+        self.assertEqual(Purchase.objects.count(), 0)
+
+    def test_concurrent_purchases(self):
+        barrier = threading.Barrier(self.NUM_THREADS)
+        results = []
+
+        def purchase(user):
+            try:
+                form_data = {"user_id": user.pk, "product_id": "free_item_{}".format(self.free_item.pk),
+                             "quantity": 1}
+                form = SingleUserSinglePurchaseForm(form_data)
+                self.assertTrue(form.is_valid())
+                # all threads validated the form while items were left, now they purchase at the same time
+                barrier.wait()
+                try:
+                    results.append(purchase_free_item(form)["purchase"])
+                except FreeItemSoldOut:
+                    results.append(None)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=purchase, args=(user,)) for user in self.users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), self.NUM_THREADS)
+        self.assertEqual(len([r for r in results if r is not None]), 5)
+        self.assertEqual(FreeItem.objects.get().leftover_quantity, 0)
+        self.assertEqual(Purchase.objects.filter(is_free_item_purchase=True).count(), 5)
+        self.assertEqual(view_helpers.get_purchase_menu()["free_items"], [])
+        # no events are lost because of the concurrent writers
+        self.assertEqual(Event.objects.filter(kind=Event.KIND_PURCHASE).count(), 5)
+        self.assertEqual(sorted(e.get_data()["leftover_quantity"] for e in Event.objects.filter(
+            kind=Event.KIND_FREE_ITEM))[:5], [0, 1, 2, 3, 4])
+
+    def test_concurrent_purchases_without_free_item(self):
+        barrier = threading.Barrier(self.NUM_THREADS)
+        errors = []
+
+        def purchase(user):
+            try:
+                form = SingleUserSinglePurchaseForm({"user_id": user.pk, "product_id": self.beer.pk, "quantity": 1})
+                self.assertTrue(form.is_valid())
+                barrier.wait()
+                # no retries, concurrent purchases have to wait for each other instead of failing
+                purchase_no_free_item(form)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=purchase, args=(user,)) for user in self.users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Purchase.objects.filter(is_free_item_purchase=False).count(), self.NUM_THREADS)
+        self.assertEqual(Event.objects.filter(kind=Event.KIND_PURCHASE).count(), self.NUM_THREADS)
+
+
+@skipUnless(connection.vendor in ("sqlite", "postgresql"), "EXPLAIN output is only checked for SQLite and PostgreSQL")
+class IndexTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("user1@example.com", "user1")
+
+    def assertUsesIndex(self, queryset, index_name):
+        with transaction.atomic(), connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                # the tables are tiny, so scanning them would be cheaper otherwise
+                cursor.execute("SET LOCAL enable_seqscan = off")
+            plan = queryset.explain()
+        self.assertIn(index_name, plan)
+
+    def test_purchase_indexes(self):
+        self.assertUsesIndex(self.user.purchases().unbilled().values("product_name", "product_amount")
+                             .annotate(models.Count("product_name")), "purchase_unbilled_user_idx")
+        self.assertUsesIndex(Purchase.objects.filter(created_date__gte=timezone.now()).values("user")
+                             .annotate(models.Sum("quantity")), "purchase_created_user_idx")
+        self.assertUsesIndex(Purchase.objects.order_by("-created_date")[:5], "purchase_created_user_idx")
+        self.assertUsesIndex(self.user.purchases().order_by("-created_date")[:15], "purchase_user_created_idx")
+        self.assertUsesIndex(Purchase.objects.values("product_name", "product_amount").order_by()
+                             .annotate(models.Count("product_name")), "purchase_product_idx")
+
+    def test_payment_and_invoice_indexes(self):
+        self.assertUsesIndex(self.user.payments().unbilled(), "payment_user_invoice_idx")
+        self.assertUsesIndex(self.user.invoices()[:5], "invoice_recipient_created_idx")
+
+
+class CurrencyTestCase(TransactionTestCase):
+    def test_same_as_uncached(self):
+        for value in (None, 0, 1, Decimal('-0.5'), Decimal('1.005'), Decimal('-1234567.89'), 42.1):
+            self.assertEqual(currency(value), currency_uncached(value))
+
+    def test_no_setlocale(self):
+        currency(1)
+        with mock.patch("locale.setlocale") as setlocale:
+            for i in range(10):
+                currency(Decimal(i))
+        setlocale.assert_not_called()
+
+    def test_benchmark(self):
+        out = StringIO()
+        call_command("benchmark_currency", "--values", "100", stdout=out)
+        self.assertIn("Cached formatter: 100 values", out.getvalue())
+
+
+class AdminListNumQueriesTestCase(TransactionTestCase):
+    """ Admin list pages need the same number of queries for a full page as for a single row """
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin@example.com", "admin", "password")
+        self.client.force_login(self.admin)
+        self.num_rows = 0
+        self.add_rows(1)
+
+    def add_rows(self, num_rows):
+        for i in range(self.num_rows, self.num_rows + num_rows):
+            user = User.objects.create_user("user{}@example.com".format(i), "user{}".format(i))
+            user.purchases_paid_by_other = self.admin
+            user.save()
+            category = Category.objects.create(name="cat{}".format(i))
+            product = Product.objects.create(category=category, name="prod{}".format(i), price=Decimal('1'),
+                                             amount="1 l")
+            Purchase.objects.create(user=user, quantity=1, product_category=category.name, product_name=product.name,
+                                    product_price=product.price, product_amount=product.amount)
+            Payment.objects.create(user=self.admin, amount=Decimal('1'))
+            Invoice.objects.create_for_users([self.admin])
+            FreeItem.objects.create(product=product, giver=user, leftover_quantity=1)
+            stats_display = StatsDisplay.objects.create(title="stats{}".format(i))
+            stats_display.filter_by_category.add(category)
+            stats_display.filter_by_product.add(product)
+            autochange_set = ProductAutochangeSet.objects.create(title="set{}".format(i))
+            ProductAutochange.objects.create(pc_set=autochange_set, product=product)
+            Job.objects.create(kind=Job.KIND_CREATE_INVOICES, created_by=user)
+        self.num_rows += num_rows
+
+    def test_list_views(self):
+        url_names = ["admin_user_list", "admin_purchase_list", "admin_category_list", "admin_product_list",
+                     "admin_payment_list", "admin_invoice_list", "admin_job_list", "admin_statsdisplay_list",
+                     "admin_productautochangeset_list", "admin_freeitem_list"]
+        num_queries = {}
+        for url_name in url_names:
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get(reverse(url_name)).status_code, 200)
+            num_queries[url_name] = len(queries)
+
+        self.add_rows(15)
+        for url_name in url_names:
+            with self.subTest(url_name=url_name), self.assertNumQueries(num_queries[url_name]):
+                self.assertEqual(self.client.get(reverse(url_name)).status_code, 200)
+
+    def test_annotated_counts(self):
+        category = Category.objects.with_num_products().get(name="cat0")
+        Product.objects.create(category=category, name="other", price=Decimal('1'), amount="1 l")
+        with self.assertNumQueries(0):
+            self.assertEqual(category.get_number_products(), 1)
+        self.assertEqual(Category.objects.get(name="cat0").get_number_products(), 2)
+
+        response = self.client.get(reverse("admin_productautochangeset_list"))
+        self.assertEqual([s.get_number_products() for s in response.context["object_list"]], [1])
@@ -0,0 +1,207 @@
+import socketserver
+import threading
+from io import StringIO
+from unittest import mock
+
+from django.contrib import messages
+from django.core.management import call_command
+from django.test import TransactionTestCase, override_settings
+
+from barsys import view_helpers
+from barsys.mail_rendering import InvoiceMailRenderer
+from barsys.management.commands.benchmark_mail_rendering import render_invoice_uncached
+from barsys.models import *
+from pybarsys.settings import PybarsysPreferences
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """ Minimal SMTP server session. Recipients starting with "refused" are rejected and the connection is
+        dropped once when sending to a recipient starting with "flaky".
+    """
+
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.num_connections += 1
+        self.reply("220 localhost test server")
+
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250 localhost")
+            elif verb == "MAIL":
+                recipients = []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                address = command.split(":", 1)[1].strip().strip("<>")
+                if address.startswith("refused"):
+                    self.reply("550 No such user")
+                else:
+                    recipients.append(address)
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                with server.lock:
+                    flaky = [r for r in recipients if r.startswith("flaky") and r not in server.dropped]
+                    server.dropped.update(flaky)
+                if flaky:
+                    return
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                with server.lock:
+                    server.delivered.extend(recipients)
+                self.reply("250 OK")
+            elif verb in ("RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("500 Unknown command")
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super(SMTPServer, self).__init__(("127.0.0.1", 0), SMTPHandler)
+        self.lock = threading.Lock()
+        self.num_connections = 0
+        self.delivered = []
+        self.dropped = set()
+
+
+class ListReporter(view_helpers.RequestReporter):
+    def __init__(self):
+        super(ListReporter, self).__init__(None)
+        self.messages = []
+
+    def message(self, level, text):
+        self.messages.append((level, text))
+
+
+class MailPoolTestCase(TransactionTestCase):
+    def setUp(self):
+        self.server = SMTPServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        smtp_settings = override_settings(EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend",
+                                          EMAIL_HOST="127.0.0.1", EMAIL_PORT=self.server.server_address[1],
+                                          EMAIL_HOST_USER="", EMAIL_HOST_PASSWORD="",
+                                          EMAIL_USE_TLS=False, EMAIL_USE_SSL=False)
+        smtp_settings.enable()
+        self.addCleanup(smtp_settings.disable)
+        for name, value in (("NUM_CONNECTIONS", 3), ("SEND_RETRIES", 2), ("SEND_RETRY_DELAY", 0)):
+            patcher = mock.patch.object(PybarsysPreferences.EMAIL, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.prod_data = dict(product_category="cat", product_name="prod", product_price=Decimal('1'),
+                              product_amount="1 l")
+
+    def create_invoices(self, emails):
+        users = []
+        for email in emails:
+            user = User.objects.create_user(email, email.split("@")[0])
+            Purchase.objects.create(user=user, quantity=1, **self.prod_data)
+            users.append(user)
+        return Invoice.objects.create_for_users(users)
+
+    def test_parallel_invoice_mails(self):
+        emails = ["user{}@example.com".format(i) for i in range(8)]
+        invoices = self.create_invoices(emails)
+
+        reporter = ListReporter()
+        view_helpers.send_invoice_mails(reporter, invoices)
+
+        self.assertEqual(sorted(self.server.delivered), sorted(emails))
+        self.assertEqual(self.server.num_connections, 3)
+        self.assertEqual(Invoice.objects.count(), 8)
+        self.assertIn((messages.INFO, "8 invoice mails were successfully sent. "), reporter.messages)
+
+    def test_failed_invoice_mails(self):
+        invoices = self.create_invoices(["user@example.com", "refused@example.com", "flaky@example.com"])
+
+        reporter = ListReporter()
+        view_helpers.send_invoice_mails(reporter, invoices)
+
+        # flaky recipient succeeds after reconnecting, refused recipient is not retried and loses their invoice
+        self.assertEqual(sorted(self.server.delivered), ["flaky@example.com", "user@example.com"])
+        self.assertEqual(self.server.num_connections, 4)
+        self.assertEqual(set(Invoice.objects.values_list("recipient__email", flat=True)),
+                         {"user@example.com", "flaky@example.com"})
+        self.assertEqual(User.objects.get(email="refused@example.com").account_balance(), 0)
+        self.assertEqual(reporter.messages[-1][0], messages.ERROR)
+
+    def test_too_many_failures(self):
+        with mock.patch.object(PybarsysPreferences.EMAIL, "NUM_CONNECTIONS", 1):
+            invoices = self.create_invoices(["refused{}@example.com".format(i) for i in range(6)] +
+                                            ["user@example.com"])
+            reporter = ListReporter()
+            view_helpers.send_invoice_mails(reporter, invoices)
+
+        self.assertEqual(self.server.delivered, [])
+        self.assertEqual(Invoice.objects.count(), 0)
+        self.assertIn((messages.ERROR, "Too many errors during mail transmission - deleted all remaining, "
+                                       "unsent invoices"), reporter.messages)
+
+
+class InvoiceMailRendererTestCase(TransactionTestCase):
+    def setUp(self):
+        u1 = User.objects.create_user("user1@example.com", "user1")
+        u2 = User.objects.create_user("user2@example.com", "user2")
+        for name in ("dependant1", "dependant2"):
+            dependant = User.objects.create_user("{}@example.com".format(name), name)
+            dependant.purchases_paid_by_other = u2
+            dependant.save()
+
+        prod_data = dict(product_category="cat", product_name="prod", product_price=Decimal('1.50'),
+                         product_amount="1 l")
+        for user in User.objects.all():
+            for i in range(1, 4):
+                Purchase.objects.create(user=user, quantity=i, **prod_data)
+        Payment.objects.create(user=u1, amount=Decimal('5'))
+
+        Invoice.objects.create_for_users([u1, u2])
+        Purchase.objects.create(user=u1, quantity=2, **prod_data)
+        Invoice.objects.create_for_users([u1, u2])
+        self.invoices = list(Invoice.objects.select_related("recipient"))
+
+    def test_same_content(self):
+        renderer = InvoiceMailRenderer(self.invoices)
+        for invoice in self.invoices:
+            msg = renderer.render_invoice(invoice)
+            content_plain, content_html = render_invoice_uncached(invoice)
+            self.assertEqual(msg.body, content_plain)
+            self.assertEqual(msg.alternatives[0][0], content_html)
+
+        invoice = [i for i in self.invoices if i.recipient.display_name == "user2"][0]
+        self.assertTrue(renderer.has_dependant_purchases(invoice))
+        grouped = renderer.other_purchases_grouped(invoice)
+        self.assertEqual([(u, list(p)) for u, p in grouped],
+                         [(u, list(p)) for u, p in invoice.other_purchases_grouped()])
+        self.assertEqual(grouped[0][1].sum_cost(), Decimal('9'))
+
+    def test_num_queries(self):
+        with self.assertNumQueries(3):
+            renderer = InvoiceMailRenderer(self.invoices)
+        # only the footer of the HTML mail still queries the total cost of all purchases of the recipient
+        with self.assertNumQueries(len(self.invoices)):
+            for invoice in self.invoices:
+                renderer.render_invoice(invoice)
+
+    def test_benchmark(self):
+        out = StringIO()
+        call_command("benchmark_mail_rendering", stdout=out)
+        self.assertIn("InvoiceMailRenderer: 3 mails", out.getvalue())
@@ -0,0 +1,258 @@
+import datetime
+import os
+import time
+from io import StringIO
+from unittest import mock, skipUnless
+
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import Sum
+from django.test import LiveServerTestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.utils import json
+
+from barsys import middleware, urls
+from barsys.models import User, Purchase, PurchaseBucket, Job
+from barsys.seeding import create_dataset
+from pybarsys.settings import PybarsysPreferences
+
+# The large tier takes several minutes, run it with PYBARSYS_PERFORMANCE_TESTS=large ./manage.py test
+LARGE_TIER = os.environ.get("PYBARSYS_PERFORMANCE_TESTS") == "large"
+
+
+class QueryCountTestCase(TransactionTestCase):
+    """ Request every URL of barsys/urls.py with lots of data and check that neither the number of queries nor the
+        time exceed their budgets. The query budgets must not depend on the amount of data - a view which needs
+        more queries for more data (e.g. one per row of a list) fails here.
+    """
+    num_users = 200
+    num_purchases = 5000
+    num_payments = 400
+    time_budget = 1.0  # seconds per request
+
+    # Maximum number of queries per URL name, including the session and the logged in admin user
+    QUERY_BUDGETS = {
+        "root": 16, "main_user_list": 16, "main_user_list_multibuy": 10, "main_user_purchase_multibuy": 4,
+        "main_user_purchase": 4, "main_user_history": 6, "main_kiosk": 0, "user_home": 5, "admin_purchase_list": 5,
+        "admin_purchase_export": 3, "admin_purchase_new": 3, "admin_purchase_detail": 4, "admin_purchase_update": 5,
+        "admin_purchase_delete": 4, "admin_user_list": 4, "admin_user_export": 3, "admin_user_new": 3,
+        "admin_user_detail": 13, "admin_user_update": 4, "admin_user_delete": 4, "admin_category_list": 4,
+        "admin_category_new": 2, "admin_category_detail": 4, "admin_category_update": 3, "admin_category_delete": 4,
+        "admin_product_list": 5, "admin_product_new": 3, "admin_product_detail": 4, "admin_product_update": 4,
+        "admin_product_delete": 3, "admin_payment_list": 5, "admin_payment_export": 3, "admin_payment_new": 3,
+        "admin_payment_detail": 4, "admin_payment_update": 5, "admin_payment_delete": 4, "admin_invoice_list": 5,
+        "admin_invoice_new": 3, "admin_invoice_detail": 10, "admin_invoice_resend": 8,
+        "admin_user_payment_reminder_send": 5, "admin_invoice_mail": 11, "admin_user_payment_reminder_mail": 5,
+        "admin_invoice_delete": 4, "admin_job_list": 4, "admin_job_detail": 5, "admin_statsdisplay_list": 6,
+        "admin_statsdisplay_new": 4, "admin_statsdisplay_detail": 6, "admin_statsdisplay_update": 7,
+        "admin_statsdisplay_delete": 3, "admin_purchase_statistics_by_category": 6,
+        "admin_purchase_statistics_by_product": 6, "admin_purchase_statistics_by_user": 6,
+        "admin_user_statistics_by_account_balance": 4, "admin_productautochangeset_list": 4,
+        "admin_productautochangeset_new": 4, "admin_productautochangeset_update": 12,
+        "admin_productautochangeset_execute": 11, "admin_productautochangeset_delete": 4,
+        "admin_productautochangeset_import": 11, "admin_freeitem_list": 4, "admin_freeitem_new": 4,
+        "admin_freeitem_update": 5, "admin_freeitem_delete": 4, "main_purchase_bulk_api": 16,
+        "main_purchase_feed_api": 3, "main_purchase_api": 3, "main_user_api": 3, "main_event_api": 5,
+        "main_kiosk_api": 5, "main_product_api": 3, "admin_metrics": 2,
+    }
+    # Requests which take longer because their response grows with the number of purchases (in seconds)
+    TIME_BUDGETS = {"admin_purchase_export": 3.0}
+
+    def setUp(self):
+        self.objects = create_dataset(self.num_users, self.num_purchases, self.num_payments)
+        self.client.force_login(self.objects["admin"])
+
+    def get_requests(self):
+        """ (URL name, method, URL, data) for every URL """
+        o = self.objects
+        pk_views = {
+            "admin_purchase": o["purchase"], "admin_user": o["user"], "admin_category": o["category"],
+            "admin_product": o["product"], "admin_payment": o["payment"], "admin_invoice": o["invoice"],
+            "admin_job": o["job"], "admin_statsdisplay": o["stats_display"], "admin_freeitem": o["free_item"],
+            "admin_productautochangeset": o["autochange_set"], "admin_user_payment_reminder": o["user"],
+        }
+        bulk_purchases = [{"user_id": user.pk, "product_id": str(o["product"].pk), "quantity": 1,
+                           "idempotency_key": "performance-{}".format(user.pk)} for user in o["users"]]
+
+        requests = []
+        for pattern in urls.urlpatterns:
+            name = pattern.name
+            kwargs = {}
+            if "user_id" in pattern.pattern.regex.groupindex:
+                kwargs["user_id"] = o["user"].pk
+            elif "user_pkey_str" in pattern.pattern.regex.groupindex:
+                kwargs["user_pkey_str"] = "/".join(str(u.pk) for u in o["users"])
+            elif "pk" in pattern.pattern.regex.groupindex:
+                kwargs["pk"] = [obj for prefix, obj in pk_views.items() if name.startswith(prefix + "_")][-1].pk
+
+            if name == "main_purchase_bulk_api":
+                requests.append((name, "post", reverse(name), json.dumps(bulk_purchases)))
+            else:
+                requests.append((name, "get", reverse(name, kwargs=kwargs), None))
+        return requests
+
+    def test_query_counts(self):
+        requests = self.get_requests()
+        self.assertEqual(set(name for name, method, url, data in requests), set(self.QUERY_BUDGETS),
+                         "Every URL needs a query budget")
+
+        for name, method, url, data in requests:
+            # budgets are for a cold cache, e.g. the first request after a purchase
+            cache.clear()
+            with self.subTest(url_name=name, url=url), CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                if method == "post":
+                    response = self.client.post(url, data, content_type="application/json")
+                else:
+                    response = self.client.get(url)
+                if response.streaming:
+                    b"".join(response.streaming_content)
+                duration = time.perf_counter() - start
+
+                self.assertLess(response.status_code, 400)
+                self.assertLessEqual(len(queries), self.QUERY_BUDGETS[name],
+                                     "\n".join(q["sql"] for q in queries.captured_queries))
+                self.assertLess(duration, self.TIME_BUDGETS.get(name, self.time_budget))
+
+
+@skipUnless(LARGE_TIER, "Set PYBARSYS_PERFORMANCE_TESTS=large to run the large performance tests")
+class LargeQueryCountTestCase(QueryCountTestCase):
+    num_users = 3000
+    num_purchases = 150000
+    num_payments = 6000
+    time_budget = 3.0
+    TIME_BUDGETS = {"admin_purchase_export": 40.0}
+
+
+class SeedAndLoadTestCase(LiveServerTestCase):
+    def test_seed(self):
+        out = StringIO()
+        call_command("seed", "--users", "20", "--purchases", "500", "--payments", "10", "--days", "30", stdout=out)
+        self.assertIn("Created 20 users, 500 purchases", out.getvalue())
+        self.assertEqual(User.objects.count(), 21)
+        self.assertEqual(User.objects.exclude(purchases_paid_by_other=None).count(), 4)
+        self.assertEqual(Purchase.objects.count(), 500)
+        self.assertLess(timezone.now() - Purchase.objects.earliest("created_date").created_date,
+                        datetime.timedelta(days=31))
+        self.assertEqual(PurchaseBucket.objects.aggregate(q=Sum("quantity"))["q"],
+                         Purchase.objects.aggregate(q=Sum("quantity"))["q"])
+        # no real work for running job workers
+        self.assertIsNone(Job.objects.claim_next())
+
+        with self.assertRaises(CommandError):
+            call_command("seed", stdout=out)
+
+    def test_load(self):
+        create_dataset(20, 200, 10)
+        num_purchases = Purchase.objects.count()
+
+        out = StringIO()
+        call_command("benchmark_load", "--url", self.live_server_url, "--duration", "3", "--concurrency", "1",
+                     stdout=out)
+        output = out.getvalue()
+        for endpoint in ("GET main_kiosk_api", "POST main_user_purchase", "POST main_purchase_api"):
+            self.assertIn(endpoint, output)
+        self.assertRegex(output, r"Total: \d+ requests in [0-9.]+ s \([0-9.]+ requests/s, 0 errors\)")
+        self.assertGreater(Purchase.objects.count(), num_purchases)
+
+        with self.assertRaises(CommandError):
+            call_command("benchmark_load", "--url", "http://127.0.0.1:1", "--duration", "0.5", stdout=out)
+
+
+class RequestMetricsTestCase(TransactionTestCase):
+    def setUp(self):
+        self.objects = create_dataset(20, 200, 10)
+        middleware.registry.reset()
+        for name, value in (("SAMPLE_RATE", 1.0), ("SLOW_QUERY_MS", 0), ("LOG_REQUESTS", True), ("TOKEN", "secret")):
+            patcher = mock.patch.object(PybarsysPreferences.Metrics, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_log_lines(self):
+        with self.assertLogs("barsys.metrics") as logs, CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse("main_user_list"))
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line["view"], line["method"], line["status"]), ("main_user_list", "GET", 200))
+        self.assertEqual(line["sql_queries"], len(queries))
+        self.assertGreater(line["template_ms"], 0)
+        self.assertLessEqual(line["template_ms"], line["duration_ms"])
+        # every query counts as slow here, the samples contain no parameters
+        self.assertEqual(len(line["slow_queries"]), len(queries))
+        self.assertFalse(any("user0" in q["sql"] for q in line["slow_queries"]))
+
+    def test_streaming_response(self):
+        self.client.force_login(self.objects["admin"])
+        with self.assertLogs("barsys.metrics") as logs:
+            response = self.client.get(reverse("admin_purchase_export"))
+            self.assertEqual(logs.records, [])
+            with CaptureQueriesContext(connection) as queries:
+                content = b"".join(response.streaming_content)
+        self.assertGreater(content.count(b"\n"), 200)
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line["view"], "admin_purchase_export")
+        self.assertGreaterEqual(line["sql_queries"], len(queries))
+        self.assertGreater(len(queries), 0)
+
+    def test_long_polling_not_in_histogram(self):
+        with self.assertLogs("barsys.metrics"):
+            self.client.get(reverse("main_event_api"))
+        content = middleware.render_prometheus(middleware.registry.collect())
+        self.assertIn('pybarsys_requests_total{view="main_event_api",method="GET"} 1\n', content)
+        self.assertNotIn('pybarsys_request_duration_seconds_count{view="main_event_api"', content)
+
+    def test_not_sampled(self):
+        with mock.patch.object(PybarsysPreferences.Metrics, "SAMPLE_RATE", 0):
+            self.client.get(reverse("main_user_list"))
+        self.assertEqual(middleware.registry.snapshot()["views"], {})
+
+    def test_prometheus_endpoint(self):
+        with self.assertLogs("barsys.metrics"):
+            for i in range(3):
+                self.client.get(reverse("main_user_list"))
+            self.client.get("/does-not-exist/")
+            self.client.force_login(self.objects["admin"])
+            response = self.client.get(reverse("admin_metrics"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        content = response.content.decode()
+        self.assertIn('pybarsys_requests_total{view="main_user_list",method="GET"} 3\n', content)
+        self.assertIn('pybarsys_requests_total{view="unknown",method="GET"} 1\n', content)
+        self.assertIn('pybarsys_request_duration_seconds_bucket{view="main_user_list",method="GET",le="+Inf"} 3\n',
+                      content)
+        self.assertIn('pybarsys_request_duration_seconds_count{view="main_user_list",method="GET"} 3\n', content)
+        self.assertRegex(content, r'pybarsys_sql_queries_total\{view="main_user_list",method="GET"\} \d+\n')
+        self.assertRegex(content, r'pybarsys_slow_query_duration_seconds\{view="main_user_list",sql="SELECT [^\n]*\} ')
+
+    def test_prometheus_endpoint_access(self):
+        url = reverse("admin_metrics")
+        with self.assertLogs("barsys.metrics"):
+            self.assertEqual(self.client.get(url).status_code, 302)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION="Bearer wrong").status_code, 302)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
+            with mock.patch.object(PybarsysPreferences.Metrics, "TOKEN", ""):
+                self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION="Bearer ").status_code, 302)
+
+    def test_multiple_processes(self):
+        other_process = middleware.MetricsRegistry()
+        recorder = middleware.RequestRecorder()
+        recorder.slow_queries.append(('SELECT "quoted"\nFROM x', 0.5))
+        other_process.add("main_user_list", "GET", 500, 0.2, recorder)
+        other_process.flush(force=True)
+        middleware.registry.add("main_user_list", "GET", 200, 3, middleware.RequestRecorder())
+
+        metrics = middleware.registry.collect()
+        self.assertEqual(metrics["views"]["main_user_list GET"]["requests"], 2)
+        self.assertEqual(metrics["views"]["main_user_list GET"]["errors"], 1)
+        self.assertEqual(metrics["views"]["main_user_list GET"]["duration_buckets"], [0, 0, 1, 1, 1, 1, 2, 2])
+        content = middleware.render_prometheus(metrics)
+        self.assertIn('pybarsys_slow_query_duration_seconds{view="main_user_list",sql="SELECT \\"quoted\\"\\nFROM x"} '
+                      '0.5\n', content)
+
+        # processes which stopped disappear once their metrics expired
+        cache.delete(middleware.CACHE_KEY_PROCESS.format(other_process.process_id))
+        self.assertEqual(middleware.registry.collect()["views"]["main_user_list GET"]["requests"], 1)
+        self.assertEqual(cache.get(middleware.CACHE_KEY_PROCESSES), [middleware.registry.process_id])
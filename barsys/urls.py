@@ -14,11 +14,14 @@ urlpatterns = [
     url(r'^user/(?P<user_id>[0-9]+)/purchase/$', views.MainUserPurchaseView.as_view(), name='main_user_purchase'),
     url(r'^user/(?P<user_id>[0-9]+)/history/$', views.MainUserHistoryView.as_view(), name='main_user_history'),
 
+    url(r'^kiosk/$', views.MainKioskView.as_view(), name='main_kiosk'),
+
     # user area (user_*)
     url(r'^admin/$', views.PurchaseListView.as_view(), name='user_home'),
 
     # Purchase
     url(r'^admin/purchase/list/$', views.PurchaseListView.as_view(), name="admin_purchase_list"),
+    url(r'^admin/purchase/export/$', views.PurchaseExportView.as_view(), name='admin_purchase_export'),
     url(r'^admin/purchase/new/$', views.PurchaseCreateView.as_view(), name='admin_purchase_new'),
     url(r'^admin/purchase/(?P<pk>[0-9]+)/detail/$', views.PurchaseDetailView.as_view(), name='admin_purchase_detail'),
     url(r'^admin/purchase/(?P<pk>[0-9]+)/update/$', views.PurchaseUpdateView.as_view(), name='admin_purchase_update'),
@@ -71,6 +74,10 @@ urlpatterns = [
 
     url(r'^admin/invoice/(?P<pk>[0-9]+)/delete/$', views.InvoiceDeleteView.as_view(), name='admin_invoice_delete'),
 
+    # Job
+    url(r'^admin/job/list/$', views.JobListView.as_view(), name='admin_job_list'),
+    url(r'^admin/job/(?P<pk>[0-9]+)/detail/$', views.JobDetailView.as_view(), name='admin_job_detail'),
+
     # StatsDisplay
     url(r'^admin/statsdisplay/list/$', views.StatsDisplayListView.as_view(), name='admin_statsdisplay_list'),
     url(r'^admin/statsdisplay/new/$', views.StatsDisplayCreateView.as_view(), name='admin_statsdisplay_new'),
@@ -111,8 +118,15 @@ urlpatterns = [
     url(r'^admin/freeitem/(?P<pk>[0-9]+)/update/$', views.FreeItemUpdateView.as_view(), name='admin_freeitem_update'),
     url(r'^admin/freeitem/(?P<pk>[0-9]+)/delete/$', views.FreeItemDeleteView.as_view(), name='admin_freeitem_delete'),
 
+    # Metrics of RequestMetricsMiddleware
+    url(r'^admin/metrics/$', views.MetricsView.as_view(), name='admin_metrics'),
+
     # Rest-API
+    url(r'^api/purchase/bulk/', views.main_purchase_bulk_api, name='main_purchase_bulk_api'),
+    url(r'^api/purchase/feed/', views.main_purchase_feed_api, name='main_purchase_feed_api'),
     url(r'^api/purchase/', views.main_purchase_api, name='main_purchase_api'),
     url(r'^api/user/', views.main_user_api, name='main_user_api'),
+    url(r'^api/event/', views.main_event_api, name='main_event_api'),
+    url(r'^api/kiosk/', views.main_kiosk_api, name='main_kiosk_api'),
     url(r'^api/product/', views.main_product_api, name='main_product_api')
 ]
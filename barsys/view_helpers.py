@@ -1,86 +1,203 @@
-import os.path
-from collections import OrderedDict
+import base64
+import hashlib
+import json
+import random
+import uuid
+from collections import OrderedDict, defaultdict
+from decimal import Decimal
 from itertools import groupby
 
 from django.contrib import messages
-from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.mail import EmailMultiAlternatives
-from django.db import models
-from django.template.loader import render_to_string
+from django.db import models, transaction
+from django.db.models import Q
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.text import Truncator
 
 from pybarsys import settings as pybarsys_settings
 from pybarsys.settings import PybarsysPreferences
-from .models import StatsDisplay, Purchase, Invoice, Product
+from .mail_pool import MailPool, MailPoolAborted
+from .mail_rendering import InvoiceMailRenderer, get_mail_template
+from .models import StatsDisplay, Purchase, PurchaseBucket, UserProductCount, Invoice, Product, FreeItem, User, \
+    FreeItemSoldOut, purchases_bulk_created
+from .templatetags.barsys_helpers import currency
 
 
-def get_renderable_stats_elements():
-    """Create a list of dicts for all StatsDisplays that can be rendered by view more easily"""
+class RequestReporter:
+    """ Report the outcome of long-running actions (e.g. sending mails) as messages of a request """
+
+    def __init__(self, request):
+        self.request = request
+
+    def message(self, level, text):
+        messages.add_message(self.request, level, text)
+
+    def set_total(self, num_total):
+        """ Called with the number of steps (e.g. invoices) before the first one is processed """
+        pass
+
+    def step_done(self):
+        pass
+
+    def result(self, recipient, description, error=None):
+        """ Called once per mail, error is None if it was sent successfully """
+        pass
+
+
+class Echo:
+    """ Pseudo-buffer for csv.writer which returns written rows instead of storing them (for streaming responses) """
+
+    def write(self, value):
+        return value
+
+
+def get_cache_version(version_key):
+    """ Current version of cached data, which is part of the cache keys of the data. Setting a new version
+        invalidates the data in all processes that share the cache, without any race condition with processes that
+        are still calculating data of the old version.
+    """
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, uuid.uuid4().hex, None)
+        version = cache.get(version_key)
+    return version
+
+
+STATS_ELEMENTS_CACHE_KEY = "pybarsys:stats_elements"
+STATS_ELEMENTS_VERSION_CACHE_KEY = "pybarsys:stats_elements_version"
+
+
+def invalidate_stats_elements():
+    """ Make get_renderable_stats_elements() calculate the statistics again, e.g. after a new purchase.
+        Works for all gunicorn workers if the cache is shared (file or database cache).
+    """
+    # a new version instead of deleting the entry, so that a calculation which is still running in another
+    # request cannot store outdated statistics. Only once the change is committed, before that other requests
+    # would still calculate the statistics from the old data and store them under the new version.
+    transaction.on_commit(lambda: cache.set(STATS_ELEMENTS_VERSION_CACHE_KEY, uuid.uuid4().hex, None))
+
+
+def calculate_stats_elements():
+    """ Calculate the rows of all StatsDisplays. Returns the list of stats elements and the number of seconds
+        until the time period of one of them changes (None if they only change by new purchases)
+    """
     stats_elements = []
+    seconds_until_change = None
+    now = timezone.now()
 
     all_displays = StatsDisplay.objects.prefetch_related("filter_by_category", "filter_by_product").order_by(
         "-show_by_default")
-    if PybarsysPreferences.Misc.SHUFFLE_STATSDISPLAY_ORDER:
-        all_displays = all_displays.order_by("?")
 
-    for index, stat in enumerate(all_displays):
+    for stat in all_displays:
         stats_element = {"stats_id": "stats_{}".format(stat.pk),
                          "show_by_default": stat.show_by_default,
                          "title": stat.title}
 
-        if PybarsysPreferences.Misc.SHUFFLE_STATSDISPLAY_ORDER:
-            # always show the StatsDisplay that is at the start first, irrespective of show_by_default, b/c
-            # result has been shuffled already
-            if index == 0:
-                stats_element["show_by_default"] = True
-            else:
-                stats_element["show_by_default"] = False
-
-        # construct query filters step by step
-        filters = {}
-        if stat.filter_by_category.all().exists():
-            filters["product_category__in"] = [c["name"] for c in stat.filter_by_category.values("name")]
+        # no filter if empty
+        categories = [c.name for c in stat.filter_by_category.all()]
+        products = [p.name for p in stat.filter_by_product.all()]
 
-        if stat.filter_by_product.all().exists():
-            filters["product_name__in"] = [p["name"] for p in stat.filter_by_product.values("name")]
-
-        # filter by time
-        filters["created_date__gte"] = stat.time_period_begin()
+        next_change = stat.next_time_period_change()
+        if next_change is not None:
+            seconds = max(1, (next_change - now).total_seconds())
+            if seconds_until_change is None or seconds < seconds_until_change:
+                seconds_until_change = seconds
 
         stats_element["rows"] = []
+        top_users = PurchaseBucket.objects.stats_by_user(
+            stat.time_period_begin(), categories=categories, products=products,
+            by_cost=stat.sort_by_and_show != StatsDisplay.SORT_BY_NUM_PURCHASES,
+            limit=PybarsysPreferences.Misc.NUM_MAIN_USERS_IN_STATSDISPLAY)
         if stat.sort_by_and_show == StatsDisplay.SORT_BY_NUM_PURCHASES:
-            top_users = Purchase.objects.filter(**filters).stats_purchases_by_user(
-                limit=PybarsysPreferences.Misc.NUM_MAIN_USERS_IN_STATSDISPLAY)
             for user_id, user_name, total_quantity in top_users:
                 stats_element["rows"].append({"left": "{}x".format(total_quantity),
                                               "row_string": stat.row_string,
                                               "user_name": user_name,
                                               "user_id": user_id})
         else:
-            top_users = Purchase.objects.filter(**filters).stats_cost_by_user(
-                limit=PybarsysPreferences.Misc.NUM_MAIN_USERS_IN_STATSDISPLAY)
             for u_index, (user_id, user_name, total_cost) in enumerate(top_users):
                 stats_element["rows"].append({"left": "{}.".format(u_index + 1),
                                               "row_string": stat.row_string,
                                               "user_name": user_name,
                                               "user_id": user_id})
 
-        if index + 1 < len(all_displays):
-            # toggle next one on
-            stats_element["toggle_other_on"] = "stats_{}".format(all_displays[index + 1].pk)
-        else:
-            # toggle first one on
-            stats_element["toggle_other_on"] = "stats_{}".format(all_displays[0].pk)
-        # if there is only one display, it's toggled off and on again with one click
-
         stats_elements.append(stats_element)
 
+    return stats_elements, seconds_until_change
+
+
+def get_cached_stats_elements():
+    """ Stats elements from the cache or newly calculated if they are outdated """
+    max_timeout = PybarsysPreferences.Misc.STATSDISPLAY_CACHE_TIMEOUT
+    if max_timeout <= 0:
+        return calculate_stats_elements()[0]
+
+    key = "{}:{}".format(STATS_ELEMENTS_CACHE_KEY, get_cache_version(STATS_ELEMENTS_VERSION_CACHE_KEY))
+
+    stats_elements = cache.get(key)
+    if stats_elements is None:
+        stats_elements, seconds_until_change = calculate_stats_elements()
+        timeout = max_timeout if seconds_until_change is None else min(max_timeout, seconds_until_change)
+        cache.set(key, stats_elements, timeout)
+    return stats_elements
+
+
+def get_renderable_stats_elements():
+    """Create a list of dicts for all StatsDisplays that can be rendered by view more easily"""
+    stats_elements = get_cached_stats_elements()
+
+    if PybarsysPreferences.Misc.SHUFFLE_STATSDISPLAY_ORDER:
+        random.shuffle(stats_elements)
+        for index, stats_element in enumerate(stats_elements):
+            # always show the StatsDisplay that is at the start first, irrespective of show_by_default, b/c
+            # result has been shuffled already
+            stats_element["show_by_default"] = index == 0
+
+    for index, stats_element in enumerate(stats_elements):
+        # toggle next one on, or the first one after the last one
+        # if there is only one display, it's toggled off and on again with one click
+        stats_element["toggle_other_on"] = stats_elements[(index + 1) % len(stats_elements)]["stats_id"]
+
     return stats_elements
 
 
-def send_invoice_mails(request, invoices, send_dependant_notifications=False):
+# Stop sending mails after this many errors
+MAIL_CONNECTION_FAILURE_COUNT_LIMIT = 4
+
+
+def get_mail_pool():
+    """ Open connections to the mail server as configured in PybarsysPreferences.EMAIL """
+    return MailPool(num_connections=PybarsysPreferences.EMAIL.NUM_CONNECTIONS,
+                    max_retries=PybarsysPreferences.EMAIL.SEND_RETRIES,
+                    retry_delay=PybarsysPreferences.EMAIL.SEND_RETRY_DELAY,
+                    max_failures=MAIL_CONNECTION_FAILURE_COUNT_LIMIT)
+
+
+def render_reminder_mail(user):
+    context = {}
+    context["pybarsys_preferences"] = PybarsysPreferences
+    context["user"] = user
+    context["recipient"] = user
+    context["last_invoices"] = user.invoices()[:5]
+    context["last_payments"] = user.payments()[:5]
+    content_plain = get_mail_template("payment_reminder.plaintext.html").render(context)
+    content_html = get_mail_template("payment_reminder.html.html").render(context)
+    msg = EmailMultiAlternatives(PybarsysPreferences.EMAIL.PAYMENT_REMINDER_SUBJECT, content_plain,
+                                 pybarsys_settings.EMAIL_FROM_ADDRESS, [user.email],
+                                 reply_to=[PybarsysPreferences.EMAIL.CONTACT_EMAIL])
+    msg.attach_alternative(content_html, "text/html")
+    return msg
+
+
+def send_invoice_mails(reporter, invoices, send_dependant_notifications=False):
     """ Send invoice mails to invoice recipients with a list of all purchases of that invoice.
         Optionally send purchase notifications to users whose purchases are paid by someone else.
+        Invoices whose mail could not be sent are deleted again.
+        The outcome is reported to reporter (e.g. a RequestReporter).
     """
     num_invoice_mail_success = 0
     invoice_mail_failure = []  # [(username, error), ...]
@@ -88,150 +205,197 @@ def send_invoice_mails(request, invoices, send_dependant_notifications=False):
     num_purchase_notif_mail_success = 0
     purchase_notif_mail_failure = []
 
-    # open connection only once to avoid repeated unnecessary connections for multiple mails
+    num_aborted = 0  # mails not sent because of too many errors before
+
+    # open connections only once to avoid repeated unnecessary connections for multiple mails
     try:
-        mail_connection = mail.get_connection(fail_silently=False)
-        mail_connection.open()
-        mail_connection_error_count = 0 # keep track or errors below and abort after a few
+        pool = get_mail_pool()
     except Exception as e:
         for invoice in invoices:
             invoice.delete()
-        messages.error(request, "Deleted new invoices because connection to mail server could not be "
-                                "established: {}".format(e))
+        reporter.message(messages.ERROR, "Deleted new invoices because connection to mail server could not be "
+                                         "established: {}".format(e))
         return
 
-    for invoice in invoices:
-        # first, check whether we already had too many failures sending mails. If yes, just delete the remaining invoices
-        MAIL_CONNECTION_FAILURE_COUNT_LIMIT = 4
-        if mail_connection_error_count >= MAIL_CONNECTION_FAILURE_COUNT_LIMIT:
-            invoice.delete()
-            if mail_connection_error_count == MAIL_CONNECTION_FAILURE_COUNT_LIMIT:
-                messages.error(request,
-                               "Too many errors during mail transmission - deleted all remaining, unsent invoices")
-            mail_connection_error_count += 1
-            continue
+    reporter.set_total(len(invoices))
+
+    with pool:
+        renderer = InvoiceMailRenderer(invoices)
+        # mails are rendered here while the pool is already sending the previous ones
+        invoice_futures = [(invoice, pool.send(renderer.render_invoice(invoice))) for invoice in invoices]
+        notification_futures = []  # [(dependant, future), ...]
+
+        for invoice, future in invoice_futures:
+            error = future.exception()
+            if error is not None:
+                if isinstance(error, MailPoolAborted):
+                    num_aborted += 1
+                else:
+                    invoice_mail_failure.append((invoice.recipient, error))
+                invoice.delete()
+                reporter.result(invoice.recipient, "Invoice mail", "{}, deleted invoice".format(error))
+                reporter.step_done()
+                continue
 
-        context = {}
-        context["pybarsys_preferences"] = PybarsysPreferences
-        context["invoice"] = invoice
-        context["recipient"] = invoice.recipient
-        context["own_purchases"] = invoice.own_purchases()
-        context["other_purchases_grouped"] = invoice.other_purchases_grouped()
-        context["last_invoices"] = invoice.recipient.invoices()[:5]
-        context["payments"] = invoice.payments()
-
-        content_plain = render_to_string(
-            os.path.join(PybarsysPreferences.EMAIL.TEMPLATE_DIR, "normal_invoice.plaintext.html"
-                         ), context)
-        content_html = render_to_string(
-            os.path.join(PybarsysPreferences.EMAIL.TEMPLATE_DIR, "normal_invoice.html.html"),
-            context)
-        msg = EmailMultiAlternatives(PybarsysPreferences.EMAIL.INVOICE_SUBJECT, content_plain,
-                                     pybarsys_settings.EMAIL_FROM_ADDRESS, [invoice.recipient.email],
-                                     reply_to=[PybarsysPreferences.EMAIL.CONTACT_EMAIL])
-        msg.attach_alternative(content_html, "text/html")
-        try:
-            mail_connection.send_messages((msg, ))
             num_invoice_mail_success += 1
-        except Exception as e:
-            invoice_mail_failure.append((invoice.recipient, e))
-            invoice.delete()
-            mail_connection_error_count += 1
-            continue
+            reporter.result(invoice.recipient, "Invoice mail")
 
-        if send_dependant_notifications and invoice.has_dependant_purchases():
-            # send purchase notifications to dependants
-            for dependant, purchases in invoice.other_purchases_grouped():
-                notif_context = {}
-                notif_context["pybarsys_preferences"] = PybarsysPreferences
-                notif_context["invoice"] = invoice
-                notif_context["dependant"] = dependant
-                notif_context["purchases"] = purchases
-                content_plain = render_to_string(os.path.join(PybarsysPreferences.EMAIL.TEMPLATE_DIR,
-                                                              "dependant_notification.plaintext.html"), notif_context)
-                content_html = render_to_string(os.path.join(PybarsysPreferences.EMAIL.TEMPLATE_DIR,
-                                                             "dependant_notification.html.html"), notif_context)
-                msg = EmailMultiAlternatives(PybarsysPreferences.EMAIL.PURCHASE_NOTIFICATION_SUBJECT, content_plain,
-                                             pybarsys_settings.EMAIL_FROM_ADDRESS, [dependant.email],
-                                             reply_to=[PybarsysPreferences.EMAIL.CONTACT_EMAIL])
-                msg.attach_alternative(content_html, "text/html")
-                try:
-                    mail_connection.send_messages((msg,))
-                    num_purchase_notif_mail_success += 1
-                except Exception as e:
-                    purchase_notif_mail_failure.append((dependant, e))
-                    # do not delete invoice due to this, but count as error
-                    mail_connection_error_count += 1
-
-    mail_connection.close()
+            if send_dependant_notifications and renderer.has_dependant_purchases(invoice):
+                # send purchase notifications to dependants
+                for dependant, purchases in renderer.other_purchases_grouped(invoice):
+                    msg = renderer.render_dependant_notification(invoice, dependant, purchases)
+                    notification_futures.append((dependant, pool.send(msg)))
+
+            reporter.step_done()
+
+        for dependant, future in notification_futures:
+            error = future.exception()
+            if error is None:
+                num_purchase_notif_mail_success += 1
+                reporter.result(dependant, "Dependant notification mail")
+            else:
+                # do not delete invoice due to this, but count as error
+                purchase_notif_mail_failure.append((dependant, error))
+                reporter.result(dependant, "Dependant notification mail", error)
+
+    if num_aborted > 0:
+        reporter.message(messages.ERROR,
+                         "Too many errors during mail transmission - deleted all remaining, unsent invoices")
 
     if num_invoice_mail_success > 0:
-        messages.info(request, "{} invoice mails were successfully sent. ".format(num_invoice_mail_success))
+        reporter.message(messages.INFO, "{} invoice mails were successfully sent. ".format(num_invoice_mail_success))
     if len(invoice_mail_failure) > 0:
-        messages.error(request,
-                       "Sending invoice mail(s) to the following user(s) failed, deleted the invoice again: {}".
-                       format(", ".join(["{} ({})".format(u, err) for u, err in invoice_mail_failure])))
+        reporter.message(messages.ERROR,
+                         "Sending invoice mail(s) to the following user(s) failed, deleted the invoice again: {}".
+                         format(", ".join(["{} ({})".format(u, err) for u, err in invoice_mail_failure])))
 
     if num_purchase_notif_mail_success > 0:
-        messages.info(request, "{} dependant notification mails were successfully sent. ".format(
+        reporter.message(messages.INFO, "{} dependant notification mails were successfully sent. ".format(
             num_purchase_notif_mail_success))
     if len(purchase_notif_mail_failure) > 0:
-        messages.error(request, "Sending dependant notification mail(s) to the following user(s) failed: {}".
-                       format(", ".join(["{} ({})".format(u, err) for u, err in purchase_notif_mail_failure])))
+        reporter.message(messages.ERROR, "Sending dependant notification mail(s) to the following user(s) failed: {}".
+                         format(", ".join(["{} ({})".format(u, err) for u, err in purchase_notif_mail_failure])))
 
 
-def send_reminder_mails(request, users):
-    """ Send payment reminder mails to users """
+def send_reminder_mails(reporter, users):
+    """ Send payment reminder mails to users and report the outcome to reporter """
     num_reminder_mail_success = 0
     reminder_mail_failure = []  # [(username, error), ...]
+    num_aborted = 0  # mails not sent because of too many errors before
 
-    # open connection only once to avoid repeated unnecessary connections for multiple mails
+    # open connections only once to avoid repeated unnecessary connections for multiple mails
     try:
-        mail_connection = mail.get_connection(fail_silently=False)
-        mail_connection.open()
-        mail_connection_error_count = 0  # keep track or errors below and abort after a few
+        pool = get_mail_pool()
     except Exception as e:
-        messages.error(request, "Did not send payment reminders because connection to mail server could not be "
-                                "established: {}".format(e))
+        reporter.message(messages.ERROR, "Did not send payment reminders because connection to mail server could "
+                                         "not be established: {}".format(e))
         return
 
-    for user in users:
-        # first, check whether we already had too many failures sending mails. If yes, just abort
-        MAIL_CONNECTION_FAILURE_COUNT_LIMIT = 4
-        if mail_connection_error_count >= MAIL_CONNECTION_FAILURE_COUNT_LIMIT:
-            messages.error(request,
-                           "Too many errors during mail transmission - stopped sending payment reminders")
-            return
-
-        context = {}
-        context["pybarsys_preferences"] = PybarsysPreferences
-        context["user"] = user
-        context["recipient"] = user
-        context["last_invoices"] = user.invoices()[:5]
-        context["last_payments"] = user.payments()[:5]
-        content_plain = render_to_string(
-            os.path.join(PybarsysPreferences.EMAIL.TEMPLATE_DIR, "payment_reminder.plaintext.html"),
-            context)
-        content_html = render_to_string(
-            os.path.join(PybarsysPreferences.EMAIL.TEMPLATE_DIR, "payment_reminder.html.html"),
-            context)
-        msg = EmailMultiAlternatives(PybarsysPreferences.EMAIL.PAYMENT_REMINDER_SUBJECT, content_plain,
-                                     pybarsys_settings.EMAIL_FROM_ADDRESS, [user.email],
-                                     reply_to=[PybarsysPreferences.EMAIL.CONTACT_EMAIL])
-        msg.attach_alternative(content_html, "text/html")
-        try:
-            mail_connection.send_messages((msg,))
-            num_reminder_mail_success += 1
-        except Exception as e:
-            reminder_mail_failure.append((user, e))
-            mail_connection_error_count += 1
-    mail_connection.close()
+    reporter.set_total(len(users))
+
+    with pool:
+        reminder_futures = [(user, pool.send(render_reminder_mail(user))) for user in users]
+
+        for user, future in reminder_futures:
+            error = future.exception()
+            if error is None:
+                num_reminder_mail_success += 1
+                reporter.result(user, "Payment reminder mail")
+            else:
+                if isinstance(error, MailPoolAborted):
+                    num_aborted += 1
+                else:
+                    reminder_mail_failure.append((user, error))
+                reporter.result(user, "Payment reminder mail", error)
+            reporter.step_done()
+
+    if num_aborted > 0:
+        reporter.message(messages.ERROR,
+                         "Too many errors during mail transmission - stopped sending payment reminders")
 
     if num_reminder_mail_success > 0:
-        messages.info(request, "{} payment reminders were successfully sent. ".format(num_reminder_mail_success))
+        reporter.message(messages.INFO, "{} payment reminders were successfully sent. ".format(
+            num_reminder_mail_success))
     if len(reminder_mail_failure) > 0:
-        messages.error(request, "Sending payment reminder mail(s) to the following user(s) failed: {}". \
-                       format(", ".join(["{} ({})".format(u, err) for u, err in reminder_mail_failure])))
+        reporter.message(messages.ERROR, "Sending payment reminder mail(s) to the following user(s) failed: {}". \
+                         format(", ".join(["{} ({})".format(u, err) for u, err in reminder_mail_failure])))
+
+
+def create_invoices(reporter, users, send_invoices=True, send_dependant_notifications=False,
+                    send_payment_reminders=False, autolock_accounts=False, comment=""):
+    """ Create invoices for users, update their autolock state and optionally send invoice and payment reminder
+        mails. The outcome is reported to reporter (e.g. a RequestReporter).
+    """
+    users = list(users)
+    balances_before = {u.pk: u.account_balance() for u in users}
+
+    invoices = Invoice.objects.create_for_users(users, comment)
+
+    # fetch all new balances at once
+    balances_after = dict(User.objects.filter(pk__in=balances_before.keys()).values_list("pk", "balance"))
+    invoiced_user_pks = set(i.recipient_id for i in invoices)
+
+    skipped_users = []
+    users_to_remind = []
+    users_unlocked = []
+    users_autolocked = []
+
+    for user in users:
+        user.balance = balances_after[user.pk]
+
+        if user.pk not in invoiced_user_pks:
+            # user has no purchases to pay for
+            if send_payment_reminders and user.account_balance() < PybarsysPreferences.Misc.BALANCE_BELOW_TRANSFER_MONEY:
+                users_to_remind.append(user)
+            skipped_users.append(user)
+
+        # remove autolock if new balance is adequate
+        if user.is_autolocked and user.account_balance() > PybarsysPreferences.Misc.BALANCE_BELOW_AUTOLOCK:
+            user.is_autolocked = False
+            users_unlocked.append(user)
+
+        if autolock_accounts:
+            # autolock user if necessary
+            if balances_before[user.pk] < PybarsysPreferences.Misc.BALANCE_BELOW_AUTOLOCK and user.account_balance() < PybarsysPreferences.Misc.BALANCE_BELOW_AUTOLOCK:
+                # user has surpassed autolock threshold twice
+                user.is_autolocked = True
+                users_autolocked.append(user)
+
+    User.objects.filter(pk__in=[u.pk for u in users_unlocked if not u.is_autolocked]).update(is_autolocked=False)
+    User.objects.filter(pk__in=[u.pk for u in users_autolocked]).update(is_autolocked=True)
+    if users_unlocked or users_autolocked:
+        # the updates above do not send signals
+        invalidate_api_data("kiosk")
+
+    if len(invoices) > 0:
+        created_str = "Created {} invoice(s) for the following user(s): {}. ".format(len(invoices), ", ".join(
+            ["{} ({})".format(i.recipient.display_name, currency(i.amount_purchases - i.amount_payments)) for i in
+             invoices]))
+    else:
+        created_str = "No invoices were created. "
+    reporter.message(messages.INFO, created_str)
+
+    if len(skipped_users) > 0:
+        skipped_str = "Skipped {} user(s) because they did not need new invoices.".format(len(skipped_users))
+        reporter.message(messages.INFO, skipped_str)
+
+    if len(users_autolocked) > 0:
+        autolocked_str = "The following users were autolocked: {}".format(
+            ', '.join([u.__str__() for u in users_autolocked])
+        )
+        reporter.message(messages.WARNING, autolocked_str)
+
+    # Send invoice mails if wanted
+    if send_invoices and len(invoices) > 0:
+        send_invoice_mails(reporter, invoices, send_dependant_notifications=send_dependant_notifications)
+    else:
+        reporter.message(messages.INFO, "No invoice mails were sent.")
+
+    # Send payment reminder mails
+    if len(users_to_remind) > 0:
+        send_reminder_mails(reporter, users_to_remind)
+
+    return invoices
 
 
 def group_users(ungrouped_users):
@@ -285,6 +449,97 @@ def get_jump_to_data_lines(all_users):
     return jump_to_data_lines
 
 
+PURCHASE_MENU_CACHE_KEY = "pybarsys:purchase_menu"
+PURCHASE_MENU_VERSION_CACHE_KEY = "pybarsys:purchase_menu_version"
+
+
+def invalidate_purchase_menu():
+    """ Make get_purchase_menu() fetch products and free items again, e.g. after a product was changed.
+        Takes effect when the current transaction is committed (see invalidate_stats_elements).
+    """
+    transaction.on_commit(lambda: cache.set(PURCHASE_MENU_VERSION_CACHE_KEY, uuid.uuid4().hex, None))
+
+
+def calculate_purchase_menu():
+    """ Everything that can be chosen on the purchase page: a list of (category, [active products]) for each
+        category with active products and the list of purchasable free items
+    """
+    products = Product.objects.active().select_related("category")
+    categories = [(category, list(category_products)) for category, category_products in
+                  groupby(products, key=lambda p: p.category)]
+    free_items = list(FreeItem.objects.filter(purchasable=True, leftover_quantity__gte=1).select_related(
+        "product", "giver"))
+    return {"categories": categories, "free_items": free_items}
+
+
+def get_purchase_menu():
+    """ Purchase menu from the cache or newly fetched if it is outdated """
+    max_timeout = PybarsysPreferences.Misc.PURCHASE_MENU_CACHE_TIMEOUT
+    if max_timeout <= 0:
+        return calculate_purchase_menu()
+
+    key = "{}:{}".format(PURCHASE_MENU_CACHE_KEY, get_cache_version(PURCHASE_MENU_VERSION_CACHE_KEY))
+
+    purchase_menu = cache.get(key)
+    if purchase_menu is None:
+        purchase_menu = calculate_purchase_menu()
+        cache.set(key, purchase_menu, max_timeout)
+    return purchase_menu
+
+
+API_DATA_CACHE_KEY = "pybarsys:api_data"
+API_DATA_VERSION_CACHE_KEY = "pybarsys:api_data_version"
+
+
+def invalidate_api_data(name):
+    """ Make get_cached_api_data(name, ...) serialize the data again, e.g. after a product was changed.
+        Takes effect when the current transaction is committed (see invalidate_stats_elements).
+    """
+    transaction.on_commit(lambda: cache.set("{}:{}".format(API_DATA_VERSION_CACHE_KEY, name), uuid.uuid4().hex, None))
+
+
+def get_cached_api_data(name, serialize):
+    """ Data of the API endpoint name from the cache, or from serialize() if it is outdated.
+        Returns a dict with the data and its ETag.
+    """
+    max_timeout = PybarsysPreferences.Misc.API_CACHE_TIMEOUT
+    if max_timeout > 0:
+        key = "{}:{}:{}".format(API_DATA_CACHE_KEY, name,
+                                get_cache_version("{}:{}".format(API_DATA_VERSION_CACHE_KEY, name)))
+        api_data = cache.get(key)
+        if api_data is not None:
+            return api_data
+
+    data = serialize()
+    content = json.dumps(data, sort_keys=True, cls=DjangoJSONEncoder)
+    api_data = {"data": data, "etag": hashlib.sha1(content.encode()).hexdigest()}
+
+    if max_timeout > 0:
+        cache.set(key, api_data, max_timeout)
+    return api_data
+
+
+def calculate_kiosk_snapshot():
+    """ Everything the kiosk page needs to take purchases while the server is unreachable: the buyers with their
+        autolock state and the purchase menu (see docs/api.md)
+    """
+    users = User.objects.buyers().active().select_related("purchases_paid_by_other")
+    purchase_menu = calculate_purchase_menu()
+    return {
+        "users": [{"id": u.pk, "display_name": u.display_name, "is_favorite": u.is_favorite,
+                   "is_autolocked": u.is_autolocked or (not u.pays_themselves() and
+                                                        u.purchases_paid_by_other.is_autolocked)}
+                  for u in users],
+        "categories": [{"name": category.name,
+                        "products": [{"id": str(p.pk), "name": p.name, "amount": p.amount, "price": str(p.price),
+                                      "price_str": currency(p.price), "is_bold": p.is_bold} for p in products]}
+                       for category, products in purchase_menu["categories"]],
+        "free_items": [{"id": "free_item_{}".format(f.pk), "name": f.product.name, "amount": f.product.amount,
+                        "leftover_quantity": f.leftover_quantity, "comment": f.comment}
+                       for f in purchase_menu["free_items"]],
+    }
+
+
 def get_most_bought_product_in_queryset(purchase_query_set):
     # Try to get the product bought most often in purchase_query_set that is currently available to buy
 
@@ -302,47 +557,185 @@ def get_most_bought_product_in_time(hours):
         Purchase.objects.filter(created_date__gte=timezone.now() - timezone.timedelta(hours=hours)))
 
 
-def get_most_bought_product_for_user(user):
-    most_bought_product = None
-    if user.purchases().unbilled().exists():
-        # most bought product of unbilled purchases
-        most_bought_product = get_most_bought_product_in_queryset(user.purchases().unbilled())
+RECENT_MOST_BOUGHT_PRODUCT_CACHE_KEY = "pybarsys:recent_most_bought_product"
+RECENT_MOST_BOUGHT_PRODUCT_CACHE_TIMEOUT = 60
 
-    if most_bought_product is None and Invoice.objects.filter(purchase__user=user).distinct().exists():
-        # most bought product by this user on last invoice that had a purchase of him/her
-        # works both when user pays themselves and when not
-        most_bought_product = get_most_bought_product_in_queryset(
-            Invoice.objects.filter(purchase__user=user).distinct()[0].purchases().filter(user=user))
-
-    if most_bought_product is None:
-        # user has no purchases yet, just use all purchases of last 4 hours
-        most_bought_product = get_most_bought_product_in_time(hours=4)
 
+def get_recent_most_bought_product():
+    """ Most bought product of the last 4 (or 24) hours for users without purchases.
+        Cached for a minute as it is the same for all of them.
+    """
+    most_bought_product = cache.get(RECENT_MOST_BOUGHT_PRODUCT_CACHE_KEY)
     if most_bought_product is None:
-        # okay, so maybe last 24 hours?
-        most_bought_product = get_most_bought_product_in_time(hours=24)
+        most_bought_product = get_most_bought_product_in_time(hours=4) or get_most_bought_product_in_time(hours=24) \
+                              or {'product_amount': '', 'product_name': ''}
+        cache.set(RECENT_MOST_BOUGHT_PRODUCT_CACHE_KEY, most_bought_product, RECENT_MOST_BOUGHT_PRODUCT_CACHE_TIMEOUT)
+    return most_bought_product
 
-    if most_bought_product is None:
-        # Found none :(
-        most_bought_product = {'product_amount': '', 'product_name': ''}
 
-    return most_bought_product
+def get_most_bought_product_for_user(user):
+    return get_most_bought_product_for_users([user])
 
 
 def get_most_bought_product_for_users(users):
-    most_bought_product = None
-    if users.purchases().unbilled().exists():
-        # most bought product of unbilled purchases
-        most_bought_product = get_most_bought_product_in_queryset(users.purchases().unbilled())
+    # counted in UserProductCount so that this is a single query on its (user, product) index
+    most_bought_product = UserProductCount.objects.most_bought_product(users)
 
     if most_bought_product is None:
-        # Show most bought product of last 4 hours
-        most_bought_product = get_most_bought_product_in_time(4)
+        # users have not bought any available product yet, just use what others bought recently
+        most_bought_product = get_recent_most_bought_product()
 
-    if most_bought_product is None:
-        most_bought_product = get_most_bought_product_in_time(24)
+    return most_bought_product
 
-    if most_bought_product is None:
-        most_bought_product = {'product_amount': '', 'product_name': ''}
 
-    return most_bought_product
+def check_bulk_purchase(item, users, products, free_items, free_items_left):
+    """ Errors of a purchase of create_purchases_in_bulk (like those of SingleUserSinglePurchaseForm)
+        or None if it is valid
+    """
+    user = users.get(item["user_id"])
+    if user is None:
+        return {"user_id": ["Invalid user ID"]}
+    if user.is_autolocked:
+        return {"user_id": ["User is currently autolocked and cannot purchase products"]}
+    if not user.pays_themselves() and user.purchases_paid_by_other.is_autolocked:
+        return {"user_id": ["The user responsible for this accounts' payments is currently autolocked"]}
+
+    product_id = item["product_id"]
+    if product_id.startswith("free_item_"):
+        free_item_id = int(product_id[len("free_item_"):])
+        if free_item_id not in free_items:
+            return {"product_id": ["Free item does not exist or is not purchasable"]}
+        if free_items_left[free_item_id] < item["quantity"]:
+            return {"quantity": ["There are only {} items left, so you cannot purchase {}!".format(
+                free_items_left[free_item_id], item["quantity"])]}
+    elif int(product_id) not in products:
+        return {"product_id": ["Invalid product ID"]}
+
+    return None
+
+
+def create_purchases_in_bulk(items):
+    """ Create purchases uploaded at once by API clients (e.g. terminals which were offline), with a few queries
+        for all of them. Purchases with an idempotency_key that already exists are not created again.
+
+        :param items: list of dicts validated by BulkPurchaseSerializer
+        :return: list with a tuple (status, purchase or errors) for each item, with the HTTP status codes
+                 201 (created), 200 (already created before), 400 (invalid) or 409 (free items sold out meanwhile)
+    """
+    results = [None] * len(items)
+
+    # items without an idempotency key get one so that they can be fetched again after bulk_create
+    keys = [item.get("idempotency_key") or uuid.uuid4().hex for item in items]
+    existing = {p.idempotency_key: p for p in Purchase.objects.filter(idempotency_key__in=keys).select_related("user")}
+
+    # everything needed to check the items
+    users = {u.pk: u for u in User.objects.active().buyers().filter(
+        pk__in=set(item["user_id"] for item in items)).select_related("purchases_paid_by_other")}
+    product_ids = [item["product_id"] for item in items]
+    products = {p.pk: p for p in Product.objects.active().filter(
+        pk__in=[int(p) for p in product_ids if not p.startswith("free_item_")]).select_related("category")}
+    free_items = {f.pk: f for f in FreeItem.objects.filter(
+        pk__in=[int(p[len("free_item_"):]) for p in product_ids if p.startswith("free_item_")],
+        purchasable=True).select_related("product__category", "giver")}
+    free_items_left = {pk: f.leftover_quantity for pk, f in free_items.items()}
+
+    new_purchases = {}  # {idempotency_key: (free item or None, purchase)}
+    first_index = {}  # {idempotency_key: index of first item with this key}
+    for index, (item, key) in enumerate(zip(items, keys)):
+        if key in existing:
+            results[index] = (200, existing[key])
+            continue
+        if key in first_index:
+            # uploaded twice at once, gets the result of the first one below
+            continue
+
+        errors = check_bulk_purchase(item, users, products, free_items, free_items_left)
+        if errors is not None:
+            results[index] = (400, errors)
+            continue
+
+        comment = item["comment"]
+        if item["product_id"].startswith("free_item_"):
+            free_item = free_items[int(item["product_id"][len("free_item_"):])]
+            free_items_left[free_item.pk] -= item["quantity"]
+            product = free_item.product
+            comment = "{} (free)".format(comment) if comment else "free"
+        else:
+            free_item = None
+            product = products[int(item["product_id"])]
+
+        purchase = Purchase(user=users[item["user_id"]], product_name=product.name, product_amount=product.amount,
+                            product_category=product.category.name, product_price=product.price,
+                            quantity=item["quantity"], comment=comment, idempotency_key=key)
+        if free_item is not None:
+            purchase.product_price = Decimal(0)
+            purchase.is_free_item_purchase = True
+        try:
+            purchase.clean_fields(exclude=["user", "idempotency_key"])
+        except ValidationError as e:
+            results[index] = (400, e.message_dict)
+            continue
+        new_purchases[key] = (free_item, purchase)
+        first_index[key] = index
+
+    with transaction.atomic():
+        taken = defaultdict(int)
+        for free_item, purchase in new_purchases.values():
+            if free_item is not None:
+                taken[free_item.pk] += purchase.quantity
+        for free_item_id, quantity in taken.items():
+            free_item = free_items[free_item_id]
+            try:
+                FreeItem.objects.take(free_item, quantity)
+            except FreeItemSoldOut as e:
+                # other purchases took some of them since they were fetched above
+                for key, (f, purchase) in list(new_purchases.items()):
+                    if f is free_item:
+                        results[first_index[key]] = (409, {"quantity": [str(e)]})
+                        del new_purchases[key]
+
+        for free_item, purchase in new_purchases.values():
+            if free_item is not None:
+                purchase.free_item_description = Truncator(free_item.verbose_str()).chars(120)
+
+        created = Purchase.objects.bulk_create([purchase for free_item, purchase in new_purchases.values()])
+        if any(purchase.pk is None for purchase in created):
+            # the database did not return the primary keys, which the receivers of purchases_bulk_created need
+            created = list(Purchase.objects.filter(idempotency_key__in=list(new_purchases))
+                           .select_related("user").order_by("pk"))
+        if created:
+            purchases_bulk_created.send(sender=Purchase, purchases=created)
+
+    for purchase in created:
+        results[first_index[purchase.idempotency_key]] = (201, purchase)
+
+    for index, key in enumerate(keys):
+        if results[index] is None:
+            status, result = results[first_index[key]]
+            results[index] = (200 if status == 201 else status, result)
+
+    return results
+
+
+def encode_purchase_cursor(purchase):
+    """ Opaque cursor of the position after purchase in a list of purchases ordered by (created_date, id) """
+    position = [purchase.created_date.isoformat(), purchase.pk]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def filter_after_purchase_cursor(purchases, cursor):
+    """ Purchases ordered by (created_date, id) which come after the position of cursor.
+        Raises ValueError if cursor is invalid.
+    """
+    try:
+        created_date, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        created_date = parse_datetime(created_date)
+        pk = int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid cursor")
+    if created_date is None:
+        raise ValueError("Invalid cursor")
+
+    # keyset pagination: as fast for deep pages as for the first one
+    return purchases.filter(Q(created_date__gt=created_date) | Q(created_date=created_date, pk__gt=pk)).order_by(
+        "created_date", "pk")
@@ -1,24 +1,33 @@
 import csv
 import os.path
+import time
 
 from django.contrib import messages
 from django.contrib.auth.mixins import UserPassesTestMixin
 from django.core import exceptions, paginator
-from django.http import HttpResponseRedirect, HttpResponseForbidden, HttpResponse, JsonResponse
+from django.db import transaction, IntegrityError
+from django.http import HttpResponseRedirect, HttpResponseForbidden, HttpResponse, JsonResponse, \
+    StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.shortcuts import render
 from django.urls import reverse_lazy
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import method_decorator
+from django.utils.http import quote_etag
 from django.utils.text import Truncator
-from django.views.generic import edit, View
+from django.views.decorators.csrf import ensure_csrf_cookie
+from django.views.generic import edit, View, ListView
 from django.views.generic.detail import DetailView
 from django_filters.views import FilterView
 from rest_framework import status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
-from barsys.serializers import PurchaseSerializer, UserSerializer, ProductSerializer
+from barsys.serializers import PurchaseSerializer, UserSerializer, ProductSerializer, BulkPurchaseSerializer
 from pybarsys.settings import PybarsysPreferences
 from . import filters
+from . import middleware
 from . import view_helpers
 from .forms import *
 from .templatetags.barsys_helpers import currency
@@ -42,33 +51,51 @@ class UserIsAdminMixin(UserPassesTestMixin):
 
 class UserListView(UserIsAdminMixin, FilterView):
     filterset_class = filters.UserFilter
+    queryset = User.objects.with_financials()
     template_name = 'barsys/admin/user_list.html'
 
     paginate_by = 10
 
 
-class UserExportView(UserIsAdminMixin, FilterView):
-    filterset_class = filters.UserFilter
+class CsvExportView(UserIsAdminMixin, FilterView):
+    """ Base view for streaming the filtered object list as CSV file without holding it in memory """
+    export_name = None  # used in file name
+    header = []
+    chunk_size = 2000  # number of rows fetched from the database at once
+
+    def get_row(self, obj):
+        raise NotImplementedError("CsvExportView subclasses need to implement get_row()")
 
     def render_to_response(self, context, **response_kwargs):
         # Could use timezone.now(), but that makes the string much longer
-        filename = "{}-pybarsys-users-export.csv".format(datetime.datetime.now().replace(microsecond=0).isoformat())
+        filename = "{}-pybarsys-{}-export.csv".format(datetime.datetime.now().replace(microsecond=0).isoformat(),
+                                                      self.export_name)
 
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+        writer = csv.writer(view_helpers.Echo())
 
-        writer = csv.writer(response)
-        writer.writerow(
-            ['display_name', 'email', 'pays_themselves', 'account_balance', 'unbilled_purchases', 'unbilled_payments'])
+        def rows():
+            yield writer.writerow(self.header)
+            for obj in self.object_list.iterator(chunk_size=self.chunk_size):
+                yield writer.writerow(self.get_row(obj))
 
-        for user in self.object_list:
-            writer.writerow(
-                [user.display_name, user.email, user.pays_themselves(), user.account_balance(),
-                 user.purchases().unbilled().sum_cost(), user.payments().unbilled().sum_amount()])
+        response = StreamingHttpResponse(rows(), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
 
         return response
 
 
+class UserExportView(CsvExportView):
+    filterset_class = filters.UserFilter
+    queryset = User.objects.with_financials()
+    export_name = "users"
+    header = ['display_name', 'email', 'pays_themselves', 'account_balance', 'unbilled_purchases',
+              'unbilled_payments']
+
+    def get_row(self, user):
+        return [user.display_name, user.email, user.pays_themselves(), user.account_balance(),
+                user.unbilled_purchases_cost, user.unbilled_payments_amount]
+
+
 class UserDetailView(UserIsAdminMixin, DetailView):
     model = User
     template_name = "barsys/admin/user_detail.html"
@@ -170,10 +197,24 @@ class UserDeleteView(UserIsAdminMixin, CheckedDeleteView):
 
 class PurchaseListView(UserIsAdminMixin, FilterView):
     filterset_class = filters.PurchaseFilter
+    queryset = Purchase.objects.select_related("user")
     template_name = "barsys/admin/purchase_list.html"
     paginate_by = 10
 
 
+class PurchaseExportView(CsvExportView):
+    filterset_class = filters.PurchaseFilter
+    queryset = Purchase.objects.select_related("user")
+    export_name = "purchases"
+    header = ['created', 'email', 'display_name', 'category', 'product', 'amount', 'price', 'quantity', 'cost',
+              'comment', 'is_free_item_purchase', 'invoice_id']
+
+    def get_row(self, obj):
+        return [obj.created_date, obj.user.email, obj.user.display_name, obj.product_category, obj.product_name,
+                obj.product_amount, obj.product_price, obj.quantity, obj.cost(), obj.comment,
+                obj.is_free_item_purchase, obj.invoice_id]
+
+
 class PurchaseDetailView(UserIsAdminMixin, DetailView):
     model = Purchase
     template_name = "barsys/admin/purchase_detail.html"
@@ -215,13 +256,14 @@ class PurchaseDeleteView(UserIsAdminMixin, CheckedDeleteView):
 
 class CategoryListView(UserIsAdminMixin, FilterView):
     filterset_class = filters.CategoryFilter
+    queryset = Category.objects.with_num_products()
     template_name = 'barsys/admin/category_list.html'
 
     paginate_by = 10
 
 
 class CategoryDetailView(UserIsAdminMixin, DetailView):
-    model = Category
+    queryset = Category.objects.with_num_products()
     template_name = "barsys/admin/category_detail.html"
 
 
@@ -247,6 +289,7 @@ class CategoryDeleteView(UserIsAdminMixin, CheckedDeleteView):
 
 class ProductListView(UserIsAdminMixin, FilterView):
     filterset_class = filters.ProductFilter
+    queryset = Product.objects.select_related("category")
     template_name = 'barsys/admin/product_list.html'
 
     paginate_by = 10
@@ -279,6 +322,7 @@ class ProductDeleteView(UserIsAdminMixin, CheckedDeleteView):
 
 class StatsDisplayListView(UserIsAdminMixin, FilterView):
     filterset_class = filters.StatsDisplayFilter
+    queryset = StatsDisplay.objects.prefetch_related("filter_by_category", "filter_by_product")
     template_name = 'barsys/admin/statsdisplay_list.html'
 
     paginate_by = 10
@@ -311,30 +355,20 @@ class StatsDisplayDeleteView(UserIsAdminMixin, CheckedDeleteView):
 
 class PaymentListView(UserIsAdminMixin, FilterView):
     filterset_class = filters.PaymentFilter
+    queryset = Payment.objects.select_related("user")
     template_name = "barsys/admin/payment_list.html"
     paginate_by = 10
 
 
-class PaymentExportView(UserIsAdminMixin, FilterView):
+class PaymentExportView(CsvExportView):
     filterset_class = filters.PaymentFilter
+    queryset = Payment.objects.select_related("user")
+    export_name = "payments"
+    header = ['created', 'value_date', 'email', 'display_name', 'amount', 'payment_method', 'comment']
 
-    def render_to_response(self, context, **response_kwargs):
-        # Could use timezone.now(), but that makes the string much longer
-        filename = "{}-pybarsys-payments-export.csv".format(datetime.datetime.now().replace(microsecond=0).isoformat())
-
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
-
-        writer = csv.writer(response)
-        writer.writerow(['created', 'value_date', 'email', 'display_name', 'amount', 'payment_method', 'comment'])
-
-        for obj in self.object_list:
-            writer.writerow(
-                [obj.created_date, obj.value_date, obj.user.email, obj.user.display_name, obj.amount,
-                 obj.get_payment_method_display(),
-                 obj.comment])
-
-        return response
+    def get_row(self, obj):
+        return [obj.created_date, obj.value_date, obj.user.email, obj.user.display_name, obj.amount,
+                obj.get_payment_method_display(), obj.comment]
 
 
 class PaymentDetailView(UserIsAdminMixin, DetailView):
@@ -378,6 +412,7 @@ class PaymentDeleteView(UserIsAdminMixin, CheckedDeleteView):
 
 class InvoiceListView(UserIsAdminMixin, FilterView):
     filterset_class = filters.InvoiceFilter
+    queryset = Invoice.objects.select_related("recipient")
     template_name = "barsys/admin/invoice_list.html"
     paginate_by = 10
 
@@ -398,14 +433,20 @@ class InvoiceDetailView(UserIsAdminMixin, DetailView):
 class InvoiceResendView(UserIsAdminMixin, View):
     def get(self, request, pk):
         invoice = get_object_or_404(Invoice, pk=pk)
-        view_helpers.send_invoice_mails(request, [invoice])
+        if PybarsysPreferences.Misc.BACKGROUND_JOBS:
+            job = Job.objects.enqueue(Job.KIND_SEND_INVOICE_MAILS, created_by=request.user, invoice_ids=[invoice.pk])
+            return redirect(job)
+        view_helpers.send_invoice_mails(view_helpers.RequestReporter(request), [invoice])
         return redirect("admin_invoice_list")
 
 
 class PaymentReminderSendView(UserIsAdminMixin, View):
     def get(self, request, pk):
         user = get_object_or_404(User, pk=pk)
-        view_helpers.send_reminder_mails(request, [user])
+        if PybarsysPreferences.Misc.BACKGROUND_JOBS:
+            job = Job.objects.enqueue(Job.KIND_SEND_REMINDER_MAILS, created_by=request.user, user_ids=[user.pk])
+            return redirect(job)
+        view_helpers.send_reminder_mails(view_helpers.RequestReporter(request), [user])
         return redirect("admin_user_detail", pk=pk)
 
 
@@ -457,78 +498,38 @@ class InvoiceCreateView(UserIsAdminMixin, edit.FormView):
     success_url = reverse_lazy("admin_invoice_list")
 
     def form_valid(self, form):
-        users = form.cleaned_data["users"]
-        send_invoices = form.cleaned_data["send_invoices"]
-        send_dependant_notifications = form.cleaned_data["send_dependant_notifications"]
-        send_payment_reminders = form.cleaned_data["send_payment_reminders"]
-        autolock_accounts = form.cleaned_data["autolock_accounts"]
-        comment = form.cleaned_data["comment"]
-
-        skipped_users = []
-        invoices = []
-        users_to_remind = []
-        users_autolocked = []
-
-        for user in users:
-
-            balance_before = user.account_balance()
-
-            if Purchase.objects.to_pay_by(user).exists() or user.payments().unbilled().exists():
-                # print("{} has {} purchases to pay for: ".format(user, purchases_to_pay.count()))
-                invoice = Invoice.objects.create_for_user(user, comment)
-                invoices.append(invoice)
-            else:
-                # print("{} has no purchases to pay for".format(user))
-                if send_payment_reminders and user.account_balance() < PybarsysPreferences.Misc.BALANCE_BELOW_TRANSFER_MONEY:
-                    users_to_remind.append(user)
-                skipped_users.append(user)
-
-            # remove autolock if new balance is adequate
-            if user.is_autolocked and user.account_balance() > PybarsysPreferences.Misc.BALANCE_BELOW_AUTOLOCK:
-                user.is_autolocked = False
-                user.save()
-
-            if autolock_accounts:
-                # autolock user if necessary
-                if balance_before < PybarsysPreferences.Misc.BALANCE_BELOW_AUTOLOCK and user.account_balance() < PybarsysPreferences.Misc.BALANCE_BELOW_AUTOLOCK:
-                    # user has surpassed autolock threshold twice
-                    user.is_autolocked = True
-                    user.save()
-                    users_autolocked.append(user)
-
-        if len(invoices) > 0:
-            created_str = "Created {} invoice(s) for the following user(s): {}. ".format(len(invoices), ", ".join(
-                ["{} ({})".format(i.recipient.display_name, currency(i.amount_purchases - i.amount_payments)) for i in
-                 invoices]))
-        else:
-            created_str = "No invoices were created. "
-        messages.info(self.request, created_str)
-
-        if len(skipped_users) > 0:
-            # skipped_str = "Skipped {} user(s): {}".format(len(skipped_users), ' ,'.join([u.__str__() for u in skipped_users]))
-            skipped_str = "Skipped {} user(s) because they did not need new invoices.".format(len(skipped_users))
-            messages.info(self.request, skipped_str)
-
-        if len(users_autolocked) > 0:
-            autolocked_str = "The following users were autolocked: {}".format(
-                ', '.join([u.__str__() for u in users_autolocked])
-            )
-            messages.warning(self.request, autolocked_str)
-
-        # Send invoice mails if wanted
-        if send_invoices and len(invoices) > 0:
-            view_helpers.send_invoice_mails(self.request, invoices,
-                                            send_dependant_notifications=send_dependant_notifications)
-        else:
-            messages.info(self.request, "No invoice mails were sent.")
+        kwargs = {name: form.cleaned_data[name] for name in
+                  ("send_invoices", "send_dependant_notifications", "send_payment_reminders", "autolock_accounts",
+                   "comment")}
+
+        if PybarsysPreferences.Misc.BACKGROUND_JOBS:
+            user_ids = list(form.cleaned_data["users"].values_list("pk", flat=True))
+            job = Job.objects.enqueue(Job.KIND_CREATE_INVOICES, created_by=self.request.user, user_ids=user_ids,
+                                      **kwargs)
+            messages.info(self.request, "Invoices will be created in the background.")
+            return redirect(job)
 
-        # Send payment reminder mails
-        if len(users_to_remind) > 0:
-            view_helpers.send_reminder_mails(self.request, users_to_remind)
+        view_helpers.create_invoices(view_helpers.RequestReporter(self.request), form.cleaned_data["users"], **kwargs)
 
         return super(InvoiceCreateView, self).form_valid(form)
 
 
+class JobListView(UserIsAdminMixin, ListView):
+    queryset = Job.objects.select_related("created_by")
+    template_name = "barsys/admin/job_list.html"
+    paginate_by = 10
+
+
+class JobDetailView(UserIsAdminMixin, DetailView):
+    model = Job
+    template_name = "barsys/admin/job_detail.html"
+
+    def get_context_data(self, **kwargs):
+        context = super(JobDetailView, self).get_context_data(**kwargs)
+        context["results"] = self.object.results.select_related("recipient")
+        return context
+
+
 class InvoiceDeleteView(UserIsAdminMixin, CheckedDeleteView):
     model = Invoice
     success_url = reverse_lazy('admin_invoice_list')
@@ -678,6 +679,8 @@ class UserStatisticsByAccountBalance(FilterView):
 
 class ProductAutochangeSetListView(UserIsAdminMixin, FilterView):
     filterset_class = filters.ProductAutochangeSetFilter
+    # only the number of products is shown, so they do not need to be prefetched
+    queryset = ProductAutochangeSet.objects.prefetch_related(None).annotate(num_products=models.Count("products"))
     template_name = "barsys/admin/productautochangeset_list.html"
     paginate_by = 10
 
@@ -756,6 +759,7 @@ class ProductAutochangeSetImportView(UserIsAdminMixin, View):
 
 class FreeItemListView(UserIsAdminMixin, FilterView):
     filterset_class = filters.FreeItemFilter
+    queryset = FreeItem.objects.select_related("product", "giver")
     template_name = "barsys/admin/freeitem_list.html"
     paginate_by = 10
 
@@ -790,6 +794,22 @@ class FreeItemDeleteView(UserIsAdminMixin, CheckedDeleteView):
 # FreeItem END
 
 
+class MetricsView(UserIsAdminMixin, View):
+    """ Metrics of RequestMetricsMiddleware in the Prometheus text format. Besides admins, scrapers which send
+        the PYBARSYS_METRICS_TOKEN as bearer token may access it.
+    """
+
+    def test_func(self):
+        token = PybarsysPreferences.Metrics.TOKEN
+        if token and constant_time_compare(self.request.META.get("HTTP_AUTHORIZATION", ""), "Bearer " + token):
+            return True
+        return super(MetricsView, self).test_func()
+
+    def get(self, request):
+        return HttpResponse(middleware.render_prometheus(middleware.registry.collect()),
+                            content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 # admin area end
 
 
@@ -809,7 +829,12 @@ class MainUserPurchaseView(View):
                                             ))
             else:
                 # free item purchase
-                result = purchase_free_item(form)
+                try:
+                    result = purchase_free_item(form)
+                except FreeItemSoldOut as e:
+                    # others were faster since the form was validated
+                    messages.error(request, "Sold out: {}".format(e))
+                    return redirect("main_user_purchase", user_id)
 
             if form.cleaned_data["purchase_more_for_same_users"]:
                 # notify user of successful purchase, so they are not confused b/c they
@@ -833,16 +858,13 @@ class MainUserPurchaseView(View):
             messages.error(request, "The payer of this users' purchases is currently autolocked: {}".format(user))
             return redirect("main_user_list")
 
-        categories = Category.objects.all()
-
         context = {}
 
         form = SingleUserSinglePurchaseForm()
 
         context["user"] = user
-        context["categories"] = categories
+        context["purchase_menu"] = view_helpers.get_purchase_menu()
         context["form"] = form
-        context["free_items"] = FreeItem.objects.filter(purchasable=True, leftover_quantity__gte=1)
 
         context["most_bought_product"] = get_most_bought_product_for_user(user)
 
@@ -851,7 +873,7 @@ class MainUserPurchaseView(View):
 
 def purchase_no_free_item(form):
     user = User.objects.get(pk=form.cleaned_data["user_id"])
-    product = Product.objects.get(pk=form.cleaned_data["product_id"])
+    product = Product.objects.select_related("category").get(pk=form.cleaned_data["product_id"])
 
     comment = form.cleaned_data["comment"]
     if form.cleaned_data["give_away_free"]:
@@ -860,17 +882,18 @@ def purchase_no_free_item(form):
         else:
             comment = "give away for free"
 
-    purchase = Purchase(user=user, product_name=product.name, product_amount=product.amount,
-                        product_category=product.category.name, product_price=product.price,
-                        quantity=form.cleaned_data["quantity"], comment=comment)
-    purchase.save()
+    with transaction.atomic():
+        purchase = Purchase(user=user, product_name=product.name, product_amount=product.amount,
+                            product_category=product.category.name, product_price=product.price,
+                            quantity=form.cleaned_data["quantity"], comment=comment)
+        purchase.save()
 
-    if form.cleaned_data["give_away_free"]:
-        # create free item
-        free_item = FreeItem.objects.create(giver=user, product=product,
-                                            leftover_quantity=form.cleaned_data["quantity"],
-                                            comment=form.cleaned_data["comment"], purchasable=True)
-        return {'purchase': purchase, 'free_item': free_item}
+        if form.cleaned_data["give_away_free"]:
+            # create free item
+            free_item = FreeItem.objects.create(giver=user, product=product,
+                                                leftover_quantity=form.cleaned_data["quantity"],
+                                                comment=form.cleaned_data["comment"], purchasable=True)
+            return {'purchase': purchase, 'free_item': free_item}
 
     return {'purchase': purchase}
     
@@ -879,7 +902,7 @@ def purchase_free_item(form):
     user = User.objects.get(pk=form.cleaned_data["user_id"])
 
     # free item purchase
-    free_item = FreeItem.objects.get(pk=form.cleaned_data["product_id"])
+    free_item = FreeItem.objects.select_related("product__category", "giver").get(pk=form.cleaned_data["product_id"])
     product = free_item.product
     quantity = form.cleaned_data["quantity"]
 
@@ -889,14 +912,15 @@ def purchase_free_item(form):
     else:
         comment = "free"
 
-    free_item.leftover_quantity -= quantity
-    free_item.save()
+    with transaction.atomic():
+        # raises FreeItemSoldOut if other purchases took the last items in the meantime
+        FreeItem.objects.take(free_item, quantity)
 
-    purchase = Purchase(user=user, product_name=product.name, product_amount=product.amount,
-                        product_category=product.category.name, product_price=Decimal(0),
-                        quantity=quantity, comment=comment, is_free_item_purchase=True,
-                        free_item_description=Truncator(free_item.verbose_str()).chars(120))
-    purchase.save()
+        purchase = Purchase(user=user, product_name=product.name, product_amount=product.amount,
+                            product_category=product.category.name, product_price=Decimal(0),
+                            quantity=quantity, comment=comment, is_free_item_purchase=True,
+                            free_item_description=Truncator(free_item.verbose_str()).chars(120))
+        purchase.save()
     return {'purchase': purchase}
 
 
@@ -918,6 +942,7 @@ class MainUserListView(View):
         context = {"favorites": favorite_users,
                    "all_users": all_users,
                    "last_purchases": last_purchases,
+                   "num_last_purchases": PybarsysPreferences.Misc.NUM_MAIN_LAST_PURCHASES,
                    "sidebar_stats_elements": sidebar_stats_elements,
                    "jump_to_data_lines": jump_to_data_lines}
         return render(request, 'barsys/main/user_list.html', context)
@@ -957,53 +982,50 @@ class MainUserListMultiBuyView(View):
 
 
 class MainUserPurchaseMultiBuyView(View):
-    def get_users_qs(self, request, user_pkey_str):
-        """ Return queryset of users in user_pkey_str if all IDs are valid, or None otherwise """
+    def get_users(self, request, user_pkey_str):
+        """ Return list of users in user_pkey_str if all IDs are valid, or None otherwise """
         try:
             user_pks = [int(n) for n in user_pkey_str.split("/")]
         except ValueError:
             messages.error(request, "Invalid format of user IDs")
             return None
 
-        all_users = User.objects.active().buyers().filter(pk__in=user_pks)
-        if all_users.count() is not len(user_pks):
+        users = list(User.objects.active().buyers().filter(pk__in=user_pks).select_related("purchases_paid_by_other"))
+        if len(users) != len(user_pks):
             # Not all users could be found
             messages.error(request, "Not all requested users are active buyers")
             return None
 
-        users = all_users.filter(is_autolocked=False)
-        if users.count() is not len(user_pks):
+        autolocked_users = [u for u in users if u.is_autolocked]
+        if autolocked_users:
             messages.error(request, "Some users are currently autolocked: {}".format(
-                ', '.join(u.__str__() for u in all_users.exclude(is_autolocked=False))
+                ', '.join(u.__str__() for u in autolocked_users)
             ))
             return None
 
-        cond_autolock2 = Q(purchases_paid_by_other=None) | Q(purchases_paid_by_other__is_autolocked=False)
-        users = all_users.filter(cond_autolock2)
-        if users.count() is not len(user_pks):
+        users_with_autolocked_payer = [u for u in users if u.purchases_paid_by_other is not None and
+                                       u.purchases_paid_by_other.is_autolocked]
+        if users_with_autolocked_payer:
             messages.error(request, "The payers of some users' purchases are currently autolocked: {}".format(
-                ', '.join(u.__str__() for u in all_users.exclude(cond_autolock2))
+                ', '.join(u.__str__() for u in users_with_autolocked_payer)
             ))
             return None
 
         return users
 
     def get(self, request, user_pkey_str):
-        users = self.get_users_qs(request, user_pkey_str)
+        users = self.get_users(request, user_pkey_str)
         if users is None:
             return redirect("main_user_list_multibuy")
 
-        # users is a valid queryset
-        categories = Category.objects.all()
-
+        # users is a valid list
         context = {}
 
         form = MultiUserSinglePurchaseForm()
 
         context["multibuy"] = True
         context["users"] = users
-        context["categories"] = categories
-        context["free_items"] = FreeItem.objects.filter(purchasable=True, leftover_quantity__gte=1)
+        context["purchase_menu"] = view_helpers.get_purchase_menu()
         context["form"] = form
 
         most_bought_product = get_most_bought_product_for_users(users)
@@ -1013,46 +1035,36 @@ class MainUserPurchaseMultiBuyView(View):
         return render(request, "barsys/main/user_purchase.html", context)
 
     def post(self, request, user_pkey_str):
-        users = self.get_users_qs(request, user_pkey_str)
+        users = self.get_users(request, user_pkey_str)
         if users is None:
             return redirect("main_user_list_multibuy")
 
         form = MultiUserSinglePurchaseForm(request.POST)
-        form.users_qs = users
+        form.users = users
 
         if form.is_valid():
+            quantity = form.cleaned_data["quantity"]
+            comment = form.cleaned_data["comment"]
             if not form.is_free_item_purchase:
-                product = Product.objects.get(pk=form.cleaned_data["product_id"])
-                quantity = form.cleaned_data["quantity"]
-                comment = form.cleaned_data["comment"]
-
-                for user in users:
-                    purchase = Purchase(user=user, product_name=product.name, product_amount=product.amount,
-                                        product_category=product.category.name, product_price=product.price,
-                                        quantity=quantity, comment=comment)
-                    purchase.save()
+                product = Product.objects.select_related("category").get(pk=form.cleaned_data["product_id"])
+                purchases = Purchase.objects.create_many_from_product(product, users, quantity, comment=comment)
             else:
                 # free item purchase
-                free_item = FreeItem.objects.get(pk=form.cleaned_data["product_id"])
-                product = free_item.product
-                quantity_per_user = form.cleaned_data["quantity"]
-                total_quantity = quantity_per_user * users.count()
+                free_item = FreeItem.objects.select_related("product__category", "giver").get(
+                    pk=form.cleaned_data["product_id"])
 
-                comment = form.cleaned_data["comment"]
                 if comment:
                     comment += " (free)"
                 else:
                     comment = "free"
 
-                free_item.leftover_quantity -= total_quantity
-                free_item.save()
-
-                for user in users:
-                    purchase = Purchase(user=user, product_name=product.name, product_amount=product.amount,
-                                        product_category=product.category.name, product_price=Decimal(0),
-                                        quantity=quantity_per_user, comment=comment, is_free_item_purchase=True,
-                                        free_item_description=Truncator(free_item.verbose_str()).chars(120))
-                    purchase.save()
+                try:
+                    purchases = Purchase.objects.create_many_from_product(free_item.product, users, quantity,
+                                                                          comment=comment, free_item=free_item)
+                except FreeItemSoldOut as e:
+                    messages.error(request, "Sold out: {}".format(e))
+                    return redirect("main_user_purchase_multibuy", user_pkey_str=user_pkey_str)
+            purchase = purchases[0]
             if form.cleaned_data["purchase_more_for_same_users"]:
                 messages.info(request, "Successfully purchased {}x {} ({}) for the following users: {}".format(
                     purchase.quantity, purchase.product_name, currency(purchase.cost()),
@@ -1089,10 +1101,20 @@ class MainUserHistoryView(View):
         return render(request, "barsys/main/user_history.html", context)
 
 
+class MainKioskView(View):
+    """ Purchase page which works from a snapshot kept in the browser and uploads purchases in the background,
+        so it does not need the server for rendering or purchasing (see main_kiosk_api)
+    """
+
+    @method_decorator(ensure_csrf_cookie)
+    def get(self, request):
+        return render(request, "barsys/main/kiosk.html", {})
+
+
 @api_view(['GET', 'POST'])
 def main_purchase_api(request):
     if request.method == 'GET':
-        purchases = Purchase.objects.all()[:PybarsysPreferences.Misc.NUM_MAIN_LAST_PURCHASES]
+        purchases = Purchase.objects.select_related("user")[:PybarsysPreferences.Misc.NUM_MAIN_LAST_PURCHASES]
         serializer = PurchaseSerializer(purchases, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
     elif request.method == 'POST':
@@ -1103,24 +1125,163 @@ def main_purchase_api(request):
             if not form.is_free_item_purchase:
                 result = purchase_no_free_item(form)
             else:
-                result = purchase_free_item(form)
+                try:
+                    result = purchase_free_item(form)
+                except FreeItemSoldOut as e:
+                    return Response({"quantity": [str(e)]}, status=status.HTTP_409_CONFLICT)
 
             serializer = PurchaseSerializer(result['purchase'])
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(form.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(['POST'])
+def main_purchase_bulk_api(request):
+    """ Create a list of purchases at once, e.g. from a terminal that was offline. Returns a list with the
+        status and the purchase (or the errors) for each of them.
+    """
+    if not isinstance(request.data, list):
+        return Response({"non_field_errors": ["Expected a list of purchases"]}, status=status.HTTP_400_BAD_REQUEST)
+
+    item_serializers = [BulkPurchaseSerializer(data=data) for data in request.data]
+    valid_serializers = [s for s in item_serializers if s.is_valid()]
+    try:
+        results = iter(view_helpers.create_purchases_in_bulk([s.validated_data for s in valid_serializers]))
+    except IntegrityError:
+        # purchases with the same idempotency keys were uploaded at the same time
+        return Response({"non_field_errors": ["Conflicting upload, please try again"]},
+                        status=status.HTTP_409_CONFLICT)
+
+    response_data = []
+    for serializer in item_serializers:
+        if serializer.errors:
+            response_data.append({"status": status.HTTP_400_BAD_REQUEST, "errors": serializer.errors})
+            continue
+        item_status, result = next(results)
+        if status.is_success(item_status):
+            response_data.append({"status": item_status, "purchase": PurchaseSerializer(result).data})
+        else:
+            response_data.append({"status": item_status, "errors": result})
+    return Response(response_data, status=status.HTTP_200_OK)
+
+
+PURCHASE_FEED_DEFAULT_LIMIT = 100
+PURCHASE_FEED_MAX_LIMIT = 1000
+
+
+@api_view(['GET'])
+def main_purchase_feed_api(request):
+    """ Filtered purchases ordered by creation, one page at a time. The cursor in the response can be used to get
+        the next page, and also to get only new purchases later on if there are none yet.
+    """
+    purchase_filter = filters.PurchaseFeedFilter(request.query_params,
+                                                 queryset=Purchase.objects.select_related("user"))
+    if not purchase_filter.is_valid():
+        return Response(purchase_filter.errors, status=status.HTTP_400_BAD_REQUEST)
+    purchases = purchase_filter.qs.order_by("created_date", "pk")
+
+    cursor = request.query_params.get("cursor")
+    if cursor:
+        try:
+            purchases = view_helpers.filter_after_purchase_cursor(purchases, cursor)
+        except ValueError as e:
+            return Response({"cursor": [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        limit = min(int(request.query_params.get("limit", PURCHASE_FEED_DEFAULT_LIMIT)), PURCHASE_FEED_MAX_LIMIT)
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        return Response({"limit": ["Has to be a number between 1 and {}".format(PURCHASE_FEED_MAX_LIMIT)]},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    page = list(purchases[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    if page:
+        cursor = view_helpers.encode_purchase_cursor(page[-1])
+
+    next_url = None
+    if has_more:
+        params = request.query_params.copy()
+        params["cursor"] = cursor
+        next_url = request.build_absolute_uri("?" + params.urlencode())
+
+    return Response({"results": PurchaseSerializer(page, many=True).data, "cursor": cursor, "next": next_url})
+
+
+EVENTS_POLL_INTERVAL = 1
+EVENTS_MAX_NUMBER = 100
+
+
+@api_view(['GET'])
+def main_event_api(request):
+    """ New purchases, free item and Stats Display changes after the event ID in the parameter "after". Without
+        "after", only the ID of the last event is returned to start with. If long polling is enabled
+        (PYBARSYS_MISC_EVENTS_LONG_POLL_TIMEOUT), waits up to "timeout" seconds until there are events.
+    """
+    try:
+        timeout = min(float(request.query_params.get("timeout", 0)),
+                      PybarsysPreferences.Misc.EVENTS_LONG_POLL_TIMEOUT)
+        after = request.query_params.get("after")
+        after = None if after is None else int(after)
+    except ValueError:
+        return Response({"non_field_errors": ["after has to be an event ID and timeout a number of seconds"]},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    if after is None:
+        # clients start like this whenever the main page is loaded, which happens often enough for cleaning up
+        Event.objects.delete_old()
+        return Response({"events": [], "last_id": Event.objects.last_id()})
+
+    # the events are in the database so that all gunicorn workers see them
+    deadline = time.monotonic() + timeout
+    while True:
+        events = list(Event.objects.filter(pk__gt=after)[:EVENTS_MAX_NUMBER])
+        if events or time.monotonic() + EVENTS_POLL_INTERVAL > deadline:
+            break
+        time.sleep(EVENTS_POLL_INTERVAL)
+
+    response_data = {"events": [{"id": e.pk, "kind": e.kind, "created_date": e.created_date, "data": e.get_data()}
+                                for e in events],
+                     "last_id": events[-1].pk if events else after}
+    if any(e.kind in (Event.KIND_PURCHASE, Event.KIND_STATS) for e in events):
+        response_data["stats_elements"] = view_helpers.get_cached_stats_elements()
+    return Response(response_data)
+
+
+def conditional_api_response(request, api_data):
+    """ Response with data from view_helpers.get_cached_api_data, or 304 Not Modified if the client already has it """
+    # no Last-Modified: changes within the same second as an earlier response would be reported as not modified
+    etag = quote_etag(api_data["etag"])
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = Response(api_data["data"])
+    response["ETag"] = etag
+    return response
+
+
 @api_view(['GET'])
 def main_user_api(request):
     if request.method == 'GET':
-        users = User.objects.buyers().active()
-        serializer = UserSerializer(users, many=True)
-        return Response(serializer.data)
+        api_data = view_helpers.get_cached_api_data(
+            "users", lambda: list(UserSerializer(User.objects.buyers().active(), many=True).data))
+        return conditional_api_response(request, api_data)
 
 
 @api_view(['GET'])
 def main_product_api(request):
     if request.method == 'GET':
-        products = Product.objects.all()
-        serializer = ProductSerializer(products, many=True)
-        return Response(serializer.data)
+        api_data = view_helpers.get_cached_api_data(
+            "products", lambda: list(ProductSerializer(Product.objects.select_related("category"), many=True).data))
+        return conditional_api_response(request, api_data)
+
+
+@api_view(['GET'])
+def main_kiosk_api(request):
+    """ Snapshot of users and products for the kiosk page, which takes purchases offline and uploads them to
+        main_purchase_bulk_api
+    """
+    api_data = view_helpers.get_cached_api_data("kiosk", view_helpers.calculate_kiosk_snapshot)
+    return conditional_api_response(request, api_data)
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from decimal import Decimal
 import environ # https://django-environ.readthedocs.io/en/latest/
 
@@ -29,6 +30,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'debug_toolbar.middleware.DebugToolbarMiddleware',
+    'barsys.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -62,6 +64,17 @@ WSGI_APPLICATION = 'pybarsys.wsgi.application'
 DATABASES = {
     'default': env.db()
 }
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    # transactions wait for concurrent writers (e.g. other gunicorn threads) instead of failing, see the backend
+    DATABASES['default']['ENGINE'] = 'pybarsys.sqlite3'
+    # the tests use a file like in production, the default in-memory database does not wait for concurrent writers
+    DATABASES['default'].setdefault('TEST', {}).setdefault(
+        'NAME', os.path.join(tempfile.gettempdir(), 'pybarsys_test.sqlite3'))
+
+# A file or database cache is shared by all gunicorn workers, the default local-memory cache is not
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://')
+}
 
 AUTH_USER_MODEL = 'barsys.User'  # custom Barsys user model
 
@@ -135,13 +148,31 @@ if DEBUG:
             'debug_toolbar.panels.profiling.ProfilingPanel',
         ]
 
+# Log the JSON lines of RequestMetricsMiddleware (see PybarsysPreferences.Metrics) to the console
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'metrics_console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'barsys.metrics': {
+            'handlers': ['metrics_console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
 # Email
 # Encode special characters with urllib.parse.quote("@:xyz?!")!
 EMAIL_CONFIG = env.email_url('EMAIL_URL')
 
 vars().update(EMAIL_CONFIG)
-if env("EMAIL_FROM_ADDRESS", default="") != "":
-    EMAIL_FROM_ADDRESS = env("EMAIL_FROM_ADDRESS")
+# None makes Django use DEFAULT_FROM_EMAIL
+EMAIL_FROM_ADDRESS = env("EMAIL_FROM_ADDRESS", default="") or None
 
 
 class PybarsysPreferences:
@@ -169,6 +200,17 @@ class PybarsysPreferences:
         CONTACT_EMAIL = env("PYBARSYS_EMAIL_CONTACT_EMAIL",
                             default="bar@example.com")
 
+        # Number of parallel connections to the mail server when sending many mails
+        NUM_CONNECTIONS = env.int("PYBARSYS_EMAIL_NUM_CONNECTIONS",
+                                  default=4)
+
+        # How often to retry sending a mail after a temporary error and how many seconds to wait before
+        # the first retry (doubled for each further retry)
+        SEND_RETRIES = env.int("PYBARSYS_EMAIL_SEND_RETRIES",
+                               default=2)
+        SEND_RETRY_DELAY = env.float("PYBARSYS_EMAIL_SEND_RETRY_DELAY",
+                                     default=1.0)
+
         # Name of bar in default templates
         NAME_OF_BAR = env("PYBARSYS_EMAIL_NAME_OF_BAR",
                           default="Barsys bar")
@@ -201,6 +243,18 @@ class PybarsysPreferences:
         # Number of users to show in a StatsDisplay on main page
         NUM_MAIN_USERS_IN_STATSDISPLAY = env.int("PYBARSYS_MISC_NUM_MAIN_USERS_IN_STATSDISPLAY",
                                                  default=5)
+        # Maximum number of seconds for which StatsDisplays on main page are cached (0: no caching).
+        # The cache is also cleared after purchases and whenever the time period of a StatsDisplay changes.
+        STATSDISPLAY_CACHE_TIMEOUT = env.int("PYBARSYS_MISC_STATSDISPLAY_CACHE_TIMEOUT",
+                                             default=300)
+        # Maximum number of seconds for which the products and free items of the purchase page are cached
+        # (0: no caching). The cache is also cleared whenever they are changed.
+        PURCHASE_MENU_CACHE_TIMEOUT = env.int("PYBARSYS_MISC_PURCHASE_MENU_CACHE_TIMEOUT",
+                                              default=60)
+        # Maximum number of seconds for which the user and product lists of the REST API are cached
+        # (0: no caching). The cache is also cleared whenever users, products or categories are changed.
+        API_CACHE_TIMEOUT = env.int("PYBARSYS_MISC_API_CACHE_TIMEOUT",
+                                    default=60)
         # Whether to randomize order of StatsDisplays and show a random one first
         # (irrespective of show_by_default setting)
         SHUFFLE_STATSDISPLAY_ORDER = env.bool("PYBARSYS_MISC_SHUFFLE_STATSDISPLAY_ORDER",
@@ -209,3 +263,28 @@ class PybarsysPreferences:
         # Automatically lock account when balance is below this threshold before and after creating invoices
         BALANCE_BELOW_AUTOLOCK = Decimal(env("PYBARSYS_MISC_BALANCE_BELOW_AUTOLOCK",
                                              default='-100'))
+
+        # Create invoices and send mails in background jobs instead of during the request.
+        # Requires a worker process running "./manage.py run_jobs".
+        BACKGROUND_JOBS = env.bool("PYBARSYS_MISC_BACKGROUND_JOBS",
+                                   default=False)
+
+        # Maximum number of seconds an event API request waits for new events (0: always return at once).
+        # Each waiting request occupies a gunicorn thread, so only enable this with enough threads for all clients.
+        EVENTS_LONG_POLL_TIMEOUT = env.int("PYBARSYS_MISC_EVENTS_LONG_POLL_TIMEOUT",
+                                           default=0)
+
+    class Metrics:
+        # Fraction of requests for which wall time, SQL queries and template rendering time are recorded
+        # (0: off, 1: all requests). See RequestMetricsMiddleware.
+        SAMPLE_RATE = env.float("PYBARSYS_METRICS_SAMPLE_RATE",
+                                default=0.0)
+        # SQL queries of sampled requests which take at least this many milliseconds are kept as slow query samples
+        SLOW_QUERY_MS = env.float("PYBARSYS_METRICS_SLOW_QUERY_MS",
+                                  default=100.0)
+        # Whether to log a JSON line for each sampled request to the "barsys.metrics" logger
+        LOG_REQUESTS = env.bool("PYBARSYS_METRICS_LOG_REQUESTS",
+                                default=True)
+        # Bearer token with which the metrics endpoint can be accessed without logging in (empty: admins only)
+        TOKEN = env("PYBARSYS_METRICS_TOKEN",
+                    default="")
@@ -0,0 +1,13 @@
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """ SQLite backend which starts transactions with BEGIN IMMEDIATE instead of BEGIN.
+
+        A transaction started with BEGIN which first reads and then writes has to upgrade its read lock to a write
+        lock. If another connection is writing at the same time, SQLite fails with "database is locked" at once
+        instead of waiting for the busy timeout. With BEGIN IMMEDIATE, concurrent transactions wait for each other.
+    """
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute("BEGIN IMMEDIATE")
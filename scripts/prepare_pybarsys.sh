@@ -11,6 +11,8 @@ cd "${0%/*}/.."
 echo "- Collecting static files in STATIC_ROOT and migrating database"
 ./manage.py collectstatic --no-input
 ./manage.py migrate
+# only does something if CACHE_URL is a database cache
+./manage.py createcachetable
 
 # create admin account if no user exists yet
 read -r -d '' CMD_CREATE_ADMIN_IF_NONE <<- EOM
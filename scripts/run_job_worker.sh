@@ -0,0 +1,9 @@
+#!/bin/bash
+
+# Run the worker for background jobs (only needed if PYBARSYS_MISC_BACKGROUND_JOBS is on)
+set -eux
+
+# cd to root folder
+cd "${0%/*}/.."
+
+./manage.py run_jobs
@@ -7,4 +7,6 @@ set -eux
 cd "${0%/*}/.."
 
 scripts/prepare_pybarsys.sh
-gunicorn --bind :8000 pybarsys.wsgi:application
+# threaded workers, so that slow requests (e.g. long polling of the event API) do not block all purchases
+gunicorn --bind :8000 --workers "${GUNICORN_WORKERS:-1}" --worker-class gthread --threads "${GUNICORN_THREADS:-8}" \
+    pybarsys.wsgi:application